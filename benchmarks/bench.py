@@ -0,0 +1,252 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from fake_appwrite import CallStats, FakeFunctions, FakeTablesDB, install
+
+# Runs both functions against the in-memory TablesDB stand-in and reports
+# executions, Appwrite round-trips, wall time and peak memory.
+#
+#   python benchmarks/bench.py --meters 1000 --readings 24 --latency-ms 5
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCUMULATE_DIR = os.path.join(ROOT, 'functions', 'accumulate_measurements', 'src')
+TRIGGER_DIR = os.path.join(ROOT, 'functions', 'trigger_accumulation_for_all_meters', 'src')
+
+DATABASE_ID = 'bench_db'
+ACCUMULATE_FUNCTION_ID = 'accumulate_fn'
+
+ENVIRONMENT = {
+    'APPWRITE_DATABASE_ID': DATABASE_ID,
+    'APPWRITE_RAW_COLLECTION_ID': 'raw',
+    'APPWRITE_DAILY_COLLECTION_ID': 'daily',
+    'APPWRITE_METERS_COLLECTION_ID': 'meters',
+    'APPWRITE_RUNS_COLLECTION_ID': 'runs',
+    'APPWRITE_JOBS_COLLECTION_ID': 'jobs',
+    'ACCUMULATE_FUNCTION_ID': ACCUMULATE_FUNCTION_ID,
+    'APPWRITE_FUNCTION_ENDPOINT': 'http://localhost/v1',
+    'APPWRITE_FUNCTION_PROJECT_ID': 'bench',
+    'APPWRITE_API_KEY': 'bench'
+}
+
+
+class BenchResponse:
+    def json(self, data, status_code=200):
+        return {"data": data, "status_code": status_code}
+
+
+class BenchRequest:
+    def __init__(self, body):
+        self.body = body
+        self.headers = {}
+
+
+class BenchContext:
+    def __init__(self, body):
+        self.req = BenchRequest(body)
+        self.res = BenchResponse()
+        self.logs = 0
+        self.errors = []
+
+    def log(self, message):
+        self.logs += 1
+
+    def error(self, message):
+        self.errors.append(str(message))
+
+
+def load_main(name, src_dir):
+    if src_dir not in sys.path:
+        sys.path.insert(0, src_dir)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(src_dir, 'main.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def seed(tables_db, meters, readings, days, start_date):
+    tables_db.seed(DATABASE_ID, 'meters', [
+        {'$id': f'meter_{i:06d}', 'device-id': f'dev_{i:06d}', 'active': True}
+        for i in range(meters)
+    ])
+
+    step = timedelta(days=1) / readings
+    raw = []
+    for i in range(meters):
+        value = i % 100
+        for day in range(days):
+            start = datetime.combine(start_date + timedelta(days=day), datetime.min.time(), tzinfo=timezone.utc)
+            for reading in range(readings):
+                value += 1 + (reading % 3)
+                raw.append({
+                    'meters': f'meter_{i:06d}',
+                    'timestamp': (start + step * reading).isoformat(timespec='milliseconds'),
+                    'current_consumption_hca': value,
+                    'consumption_at_set_date_17_hca': i,
+                    'set_date_17': '2025-12-15T00:00:00.000+00:00'
+                })
+    tables_db.seed(DATABASE_ID, 'raw', raw)
+    return len(raw)
+
+
+def period_payload(args, **extra):
+    # {"date"} for one day, else a {"from", "to"} range
+    if args.days == 1:
+        return dict({"date": args.date}, **extra)
+    start_date = datetime.strptime(args.date, '%Y-%m-%d')
+    return dict({"from": args.date, "to": (start_date + timedelta(days=args.days - 1)).strftime('%Y-%m-%d')}, **extra)
+
+
+def run_scenario(name, run, args):
+    stats = CallStats()
+    latency = args.latency_ms / 1000
+    tables_db = FakeTablesDB(latency=latency, stats=stats)
+    functions = FakeFunctions(latency=latency, stats=stats)
+    install(tables_db, functions)
+
+    start_date = datetime.strptime(args.date, '%Y-%m-%d').date()
+    raw_rows = seed(tables_db, args.meters, args.readings, args.days, start_date)
+
+    # Fresh modules per scenario, so no warm caches carry over between scenarios
+    for module in ('accumulation', 'meter_cache', 'dispatch', 'instrumentation', 'client_pool', 'runs', 'jobs', 'job_queue', 'rollups', 'plan'):
+        sys.modules.pop(module, None)
+    accumulate = load_main('accumulate_main', ACCUMULATE_DIR)
+    trigger = load_main('trigger_main', TRIGGER_DIR)
+
+    def execute(function_id, body):
+        return accumulate.main(BenchContext(json.loads(body)))
+
+    functions.handler = execute
+
+    # The trigger's dry run for the same request, priced before the run it predicts
+    plan = None
+    if args.plan and name in PLAN_OPTIONS:
+        body = period_payload(args, dry_run=True, latency_ms=args.latency_ms, **PLAN_OPTIONS[name](args))
+        plan = trigger.main(BenchContext(body))['data']
+        stats.calls.clear()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    run(accumulate, trigger, functions)
+    wall_time = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    daily_rows = len(tables_db.table(DATABASE_ID, 'daily'))
+    return {
+        'scenario': name,
+        'raw_rows': raw_rows,
+        'daily_rows': daily_rows,
+        'executions': len(functions.executions),
+        'round_trips': stats.total(),
+        'calls': dict(sorted(stats.calls.items())),
+        'wall_time_s': round(wall_time, 3),
+        'peak_memory_mb': round(peak / 1024 / 1024, 2),
+        'planned': plan and {
+            'executions': plan['executions'],
+            'round_trips': plan['round_trips']['total'],
+            'wall_time_s': round(plan['projected_wall_ms'] / 1000, 3)
+        }
+    }
+
+
+def per_device(args):
+    # One execution per meter and day, as the trigger originally dispatched them
+    def run(accumulate, trigger, functions):
+        start_date = datetime.strptime(args.date, '%Y-%m-%d')
+        for day in range(args.days):
+            date_str = (start_date + timedelta(days=day)).strftime('%Y-%m-%d')
+            for i in range(args.meters):
+                functions.create_execution(ACCUMULATE_FUNCTION_ID, body=json.dumps({"device-id": f"dev_{i:06d}", "date": date_str}))
+    return run
+
+
+def triggered(args):
+    # The trigger function end to end, with every execution run in-process
+    def run(accumulate, trigger, functions):
+        result = trigger.main(BenchContext(period_payload(args)))
+        if result['status_code'] != 200:
+            raise RuntimeError(f"Trigger failed: {result}")
+    return run
+
+
+def sharded(args):
+    # The trigger as a coordinator: one worker execution per shard, then collect
+    def run(accumulate, trigger, functions):
+        result = trigger.main(BenchContext(period_payload(args, shards=args.shards)))
+        if result['status_code'] != 200:
+            raise RuntimeError(f"Sharded trigger failed: {result}")
+        summary = trigger.main(BenchContext({"collect": result['data']['run_id']}))
+        if summary['data']['status'] != 'done':
+            raise RuntimeError(f"Sharded run did not complete: {summary}")
+    return run
+
+
+def queued(args):
+    # The trigger enqueues (device, date) jobs and starts queue workers that claim them
+    def run(accumulate, trigger, functions):
+        result = trigger.main(BenchContext(period_payload(args, queue=True)))
+        if result['status_code'] != 200:
+            raise RuntimeError(f"Queue trigger failed: {result}")
+        status = trigger.main(BenchContext({"queue_status": True}))
+        if status['data']['left'] or status['data']['jobs']['failed']:
+            raise RuntimeError(f"Jobs left after the queue workers finished: {status}")
+    return run
+
+
+SCENARIOS = {
+    'per-device': per_device,
+    'queue': queued,
+    'sharded': sharded,
+    'trigger': triggered
+}
+
+# Trigger options of the scenarios a dry run can price
+PLAN_OPTIONS = {
+    'queue': lambda args: {"queue": True},
+    'sharded': lambda args: {"shards": args.shards},
+    'trigger': lambda args: {}
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the accumulation functions against an in-memory TablesDB.")
+    parser.add_argument('--meters', type=int, default=200, help="Number of active meters")
+    parser.add_argument('--readings', type=int, default=24, help="Raw readings per meter per day")
+    parser.add_argument('--days', type=int, default=1, help="Number of days to accumulate")
+    parser.add_argument('--date', default='2026-01-05', help="First day (YYYY-MM-DD)")
+    parser.add_argument('--shards', type=int, default=4, help="Worker executions in the sharded scenario")
+    parser.add_argument('--rollups', action='store_true', help="Maintain monthly and billing-period rollups")
+    parser.add_argument('--plan', action='store_true', help="Compare each trigger scenario with its dry-run estimate")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Simulated latency per Appwrite call")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append', help="Scenario to run (default: all)")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    os.environ.update(ENVIRONMENT)
+    if args.rollups:
+        os.environ['APPWRITE_ROLLUPS_COLLECTION_ID'] = 'rollups'
+    results = [run_scenario(name, SCENARIOS[name](args), args) for name in (args.scenario or sorted(SCENARIOS))]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.meters} meters x {args.readings} readings/day x {args.days} days, {args.latency_ms} ms per call")
+    print(f"{'scenario':<12} {'executions':>10} {'round-trips':>12} {'daily rows':>10} {'wall s':>8} {'peak MB':>8}")
+    for r in results:
+        print(f"{r['scenario']:<12} {r['executions']:>10} {r['round_trips']:>12} {r['daily_rows']:>10} {r['wall_time_s']:>8} {r['peak_memory_mb']:>8}")
+        for call, count in r['calls'].items():
+            print(f"    {call:<36} {count:>8}")
+        if r['planned']:
+            p = r['planned']
+            print(f"    planned: {p['executions']} executions, {p['round_trips']} round-trips, {p['wall_time_s']} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import json
+import sys
+import threading
+import time
+import types
+import uuid
+from datetime import datetime, timezone
+
+# In-memory stand-in for the parts of the Appwrite SDK the functions use.
+# Queries are rendered to the same JSON strings as the real SDK and parsed
+# back by FakeTablesDB, so the functions run unmodified against it.
+
+
+class AppwriteException(Exception):
+    def __init__(self, message, code=0, type=None, response=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.type = type
+        self.response = response
+
+
+def _query(method, attribute=None, values=None):
+    query = {'method': method}
+    if attribute is not None:
+        query['attribute'] = attribute
+    if values is not None:
+        query['values'] = values if isinstance(values, list) else [values]
+    return json.dumps(query)
+
+
+class Query:
+    equal = staticmethod(lambda attribute, value: _query('equal', attribute, value))
+    not_equal = staticmethod(lambda attribute, value: _query('notEqual', attribute, value))
+    less_than = staticmethod(lambda attribute, value: _query('lessThan', attribute, value))
+    less_than_equal = staticmethod(lambda attribute, value: _query('lessThanEqual', attribute, value))
+    greater_than = staticmethod(lambda attribute, value: _query('greaterThan', attribute, value))
+    greater_than_equal = staticmethod(lambda attribute, value: _query('greaterThanEqual', attribute, value))
+    between = staticmethod(lambda attribute, start, end: _query('between', attribute, [start, end]))
+    is_null = staticmethod(lambda attribute: _query('isNull', attribute))
+    select = staticmethod(lambda attributes: _query('select', None, attributes))
+    order_asc = staticmethod(lambda attribute: _query('orderAsc', attribute))
+    order_desc = staticmethod(lambda attribute: _query('orderDesc', attribute))
+    cursor_after = staticmethod(lambda row_id: _query('cursorAfter', None, row_id))
+    cursor_before = staticmethod(lambda row_id: _query('cursorBefore', None, row_id))
+    limit = staticmethod(lambda value: _query('limit', None, value))
+    offset = staticmethod(lambda value: _query('offset', None, value))
+
+
+class Client:
+    def set_endpoint(self, endpoint):
+        return self
+
+    def set_project(self, project):
+        return self
+
+    def set_key(self, key):
+        return self
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+def _ref(value):
+    return value.get('$id') if isinstance(value, dict) else value
+
+
+class CallStats:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+class FakeTablesDB:
+    # Rows are held per (database, table); relationship attributes store the related $id
+    def __init__(self, latency=0.0, stats=None):
+        self.latency = latency
+        self.stats = stats or CallStats()
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def _call(self, name):
+        self.stats.record(f"tables_db.{name}")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def table(self, database_id, table_id):
+        return self.tables.setdefault((database_id, table_id), {})
+
+    def seed(self, database_id, table_id, rows):
+        table = self.table(database_id, table_id)
+        for row in rows:
+            row = dict(row)
+            row.setdefault('$id', uuid.uuid4().hex[:20])
+            row.setdefault('$createdAt', _now())
+            row.setdefault('$updatedAt', row['$createdAt'])
+            table[row['$id']] = row
+
+    def _matches(self, row, query):
+        method = query['method']
+        if method not in ('equal', 'notEqual', 'lessThan', 'lessThanEqual', 'greaterThan', 'greaterThanEqual', 'between', 'isNull'):
+            return True
+        value = _ref(row.get(query['attribute']))
+        values = query.get('values', [])
+        if method == 'equal':
+            return value in values
+        if method == 'notEqual':
+            return value not in values
+        if method == 'isNull':
+            return value is None
+        if value is None:
+            return False
+        if method == 'between':
+            return values[0] <= value <= values[1]
+        bound = values[0]
+        return {
+            'lessThan': value < bound,
+            'lessThanEqual': value <= bound,
+            'greaterThan': value > bound,
+            'greaterThanEqual': value >= bound
+        }[method]
+
+    def _project(self, row, attributes):
+        if attributes is None or '*' in attributes:
+            return dict(row)
+        projected = {k: v for k, v in row.items() if k.startswith('$') and k in attributes}
+        for attribute in attributes:
+            if attribute.endswith('.$id'):
+                name = attribute[:-4]
+                projected[name] = {'$id': _ref(row.get(name))}
+            elif attribute in row:
+                projected[attribute] = row[attribute]
+        projected.setdefault('$id', row['$id'])
+        return projected
+
+    def list_rows(self, database_id, table_id, queries=None, transaction_id=None, total=None):
+        self._call('list_rows')
+        parsed = [json.loads(q) for q in (queries or [])]
+        with self.lock:
+            rows = [r for r in self.table(database_id, table_id).values() if all(self._matches(r, q) for q in parsed)]
+
+        # Default order is by $id, which is also the cursor tie-breaker
+        rows.sort(key=lambda r: r['$id'])
+        for query in reversed([q for q in parsed if q['method'] in ('orderAsc', 'orderDesc')]):
+            rows.sort(key=lambda r: (_ref(r.get(query['attribute'])) is None, _ref(r.get(query['attribute']))),
+                      reverse=query['method'] == 'orderDesc')
+
+        matched = len(rows)
+        limit, offset, attributes = 25, 0, None
+        for query in parsed:
+            if query['method'] == 'limit':
+                limit = query['values'][0]
+            elif query['method'] == 'offset':
+                offset = query['values'][0]
+            elif query['method'] == 'select':
+                attributes = query['values']
+            elif query['method'] == 'cursorAfter':
+                ids = [r['$id'] for r in rows]
+                rows = rows[ids.index(query['values'][0]) + 1:]
+            elif query['method'] == 'cursorBefore':
+                ids = [r['$id'] for r in rows]
+                rows = rows[:ids.index(query['values'][0])][::-1]
+
+        page = rows[offset:offset + limit]
+        return {'total': matched, 'rows': [self._project(r, attributes) for r in page]}
+
+    def get_row(self, database_id, table_id, row_id, queries=None, transaction_id=None):
+        self._call('get_row')
+        with self.lock:
+            row = self.table(database_id, table_id).get(row_id)
+        if row is None:
+            raise AppwriteException("Row with the requested ID could not be found.", 404, 'row_not_found')
+        return dict(row)
+
+    def _write(self, database_id, table_id, row_id, data, mode):
+        table = self.table(database_id, table_id)
+        if row_id == 'unique()':
+            row_id = uuid.uuid4().hex[:20]
+        existing = table.get(row_id)
+        if mode == 'create' and existing is not None:
+            raise AppwriteException("Row with the requested ID already exists.", 409, 'row_already_exists')
+        if mode == 'update' and existing is None:
+            raise AppwriteException("Row with the requested ID could not be found.", 404, 'row_not_found')
+
+        now = _now()
+        row = dict(existing or {'$createdAt': now})
+        row.update({k: v for k, v in data.items() if k != '$id'})
+        row['$id'] = row_id
+        row['$updatedAt'] = now
+        table[row_id] = row
+        return dict(row)
+
+    def create_row(self, database_id, table_id, row_id, data, permissions=None, transaction_id=None):
+        self._call('create_row')
+        with self.lock:
+            return self._write(database_id, table_id, row_id, data, 'create')
+
+    def update_row(self, database_id, table_id, row_id, data=None, permissions=None, transaction_id=None):
+        self._call('update_row')
+        with self.lock:
+            return self._write(database_id, table_id, row_id, data or {}, 'update')
+
+    def upsert_row(self, database_id, table_id, row_id, data=None, permissions=None, transaction_id=None):
+        self._call('upsert_row')
+        with self.lock:
+            return self._write(database_id, table_id, row_id, data or {}, 'upsert')
+
+    def create_rows(self, database_id, table_id, rows, transaction_id=None):
+        self._call('create_rows')
+        with self.lock:
+            written = [self._write(database_id, table_id, r.get('$id', 'unique()'), r, 'create') for r in rows]
+        return {'total': len(written), 'rows': written}
+
+    def upsert_rows(self, database_id, table_id, rows, transaction_id=None):
+        self._call('upsert_rows')
+        with self.lock:
+            written = [self._write(database_id, table_id, r.get('$id', 'unique()'), r, 'upsert') for r in rows]
+        return {'total': len(written), 'rows': written}
+
+    def delete_row(self, database_id, table_id, row_id, transaction_id=None):
+        self._call('delete_row')
+        with self.lock:
+            if self.table(database_id, table_id).pop(row_id, None) is None:
+                raise AppwriteException("Row with the requested ID could not be found.", 404, 'row_not_found')
+        return {}
+
+
+class FakeFunctions:
+    # Records executions; an optional handler runs the target function in-process
+    def __init__(self, latency=0.0, stats=None, handler=None):
+        self.latency = latency
+        self.stats = stats or CallStats()
+        self.handler = handler
+        self.executions = []
+        self.lock = threading.Lock()
+
+    def create_execution(self, function_id, body=None, xasync=None, path=None, method=None, headers=None, scheduled_at=None):
+        self.stats.record('functions.create_execution')
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.executions.append({'function_id': function_id, 'body': body})
+            execution_id = f"exec_{len(self.executions)}"
+        # The handler returns what context.res.json produced: {"data", "status_code"}
+        response = self.handler(function_id, body) if self.handler else None
+        if response is None:
+            return {'$id': execution_id, 'status': 'completed', 'responseStatusCode': 200, 'responseBody': ''}
+        return {'$id': execution_id, 'status': 'completed', 'responseStatusCode': response['status_code'],
+                'responseBody': json.dumps(response['data'])}
+
+
+def install(tables_db, functions=None):
+    # Registers fake `appwrite` modules so `from appwrite... import ...` resolves to the stand-ins
+    modules = {
+        'appwrite': types.ModuleType('appwrite'),
+        'appwrite.client': types.ModuleType('appwrite.client'),
+        'appwrite.query': types.ModuleType('appwrite.query'),
+        'appwrite.exception': types.ModuleType('appwrite.exception'),
+        'appwrite.services': types.ModuleType('appwrite.services'),
+        'appwrite.services.tables_db': types.ModuleType('appwrite.services.tables_db'),
+        'appwrite.services.functions': types.ModuleType('appwrite.services.functions'),
+    }
+    modules['appwrite'].__path__ = []
+    modules['appwrite.services'].__path__ = []
+    modules['appwrite.client'].Client = Client
+    modules['appwrite.query'].Query = Query
+    modules['appwrite.exception'].AppwriteException = AppwriteException
+    modules['appwrite.services.tables_db'].TablesDB = lambda client: tables_db
+    modules['appwrite.services.functions'].Functions = lambda client: functions or FakeFunctions()
+    sys.modules.update(modules)
+    return modules
@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures cold and warm start of both functions. Every run is a fresh interpreter
+# (a cold container): it times importing the function's main module, its first
+# execution, which pays for anything imported lazily, and then warm executions.
+#
+#   python benchmarks/startup.py --runs 10
+#
+# Executions run against the in-memory stand-in from fake_appwrite. When the real
+# SDK is installed, the time to import its services is reported separately.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose presence after import and after the first execution is reported
+HEAVY_MODULES = ['numpy', 'requests', 'appwrite.services.tables_db', 'appwrite.services.functions', 'concurrent.futures']
+
+FUNCTIONS = {
+    'accumulate': {"device-id": "dev_000000", "date": "2026-01-05"},
+    'trigger': {"date": "2026-01-05"}
+}
+
+
+def child(name, warm_runs):
+    # Runs inside the fresh interpreter and prints one JSON line
+    sys.path.insert(0, HERE)
+    from fake_appwrite import FakeFunctions, FakeTablesDB, install
+    from bench import ACCUMULATE_DIR, ENVIRONMENT, TRIGGER_DIR, BenchContext, load_main, seed
+    from datetime import date
+
+    os.environ.update(ENVIRONMENT)
+    tables_db = FakeTablesDB()
+    install(tables_db, FakeFunctions())
+    seed(tables_db, 1, 24, 1, date(2026, 1, 5))
+    before = set(sys.modules)
+
+    started = time.perf_counter()
+    module = load_main(f'{name}_main', ACCUMULATE_DIR if name == 'accumulate' else TRIGGER_DIR)
+    import_ms = (time.perf_counter() - started) * 1000
+    loaded_on_import = [m for m in HEAVY_MODULES if m in sys.modules and m not in before]
+
+    timings = []
+    for _ in range(warm_runs + 1):
+        started = time.perf_counter()
+        result = module.main(BenchContext(dict(FUNCTIONS[name])))
+        timings.append((time.perf_counter() - started) * 1000)
+        if result['status_code'] >= 400:
+            raise RuntimeError(f"{name} failed: {result}")
+    loaded_on_first_call = [m for m in HEAVY_MODULES if m in sys.modules and m not in before and m not in loaded_on_import]
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'first_call_ms': timings[0],
+        'warm_call_ms': statistics.median(timings[1:]),
+        'loaded_on_import': loaded_on_import,
+        'loaded_on_first_call': loaded_on_first_call
+    }))
+
+
+def run_child(name, warm_runs):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', name, '--warm-runs', str(warm_runs)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def sdk_import_ms():
+    # Cold import of the real SDK services, or None when the SDK is not installed
+    code = (
+        "import time; started = time.perf_counter()\n"
+        "import appwrite.services.tables_db, appwrite.services.functions\n"
+        "print((time.perf_counter() - started) * 1000)"
+    )
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    return round(float(result.stdout), 1) if result.returncode == 0 else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold and warm start of the accumulation functions.")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per function")
+    parser.add_argument('--warm-runs', type=int, default=5, help="Warm executions per interpreter")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    parser.add_argument('--child', choices=sorted(FUNCTIONS), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.child, args.warm_runs)
+        return
+
+    results = []
+    for name in sorted(FUNCTIONS):
+        runs = [run_child(name, args.warm_runs) for _ in range(args.runs)]
+        results.append({
+            'function': name,
+            'import_ms': round(statistics.median(r['import_ms'] for r in runs), 1),
+            'first_call_ms': round(statistics.median(r['first_call_ms'] for r in runs), 1),
+            'warm_call_ms': round(statistics.median(r['warm_call_ms'] for r in runs), 2),
+            'loaded_on_import': runs[0]['loaded_on_import'],
+            'loaded_on_first_call': runs[0]['loaded_on_first_call']
+        })
+    sdk_ms = sdk_import_ms()
+
+    if args.json:
+        print(json.dumps({'sdk_import_ms': sdk_ms, 'functions': results}, indent=2))
+        return
+
+    print(f"Median of {args.runs} cold starts, {args.warm_runs} warm executions each")
+    print(f"{'function':<12} {'import ms':>10} {'first call ms':>14} {'warm call ms':>13}")
+    for r in results:
+        print(f"{r['function']:<12} {r['import_ms']:>10} {r['first_call_ms']:>14} {r['warm_call_ms']:>13}")
+        print(f"    loaded on import:     {', '.join(r['loaded_on_import']) or '-'}")
+        print(f"    loaded on first call: {', '.join(r['loaded_on_first_call']) or '-'}")
+    print(f"Appwrite SDK services import: {'not installed' if sdk_ms is None else f'{sdk_ms} ms'}")
+
+
+if __name__ == "__main__":
+    main()
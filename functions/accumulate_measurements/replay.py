@@ -0,0 +1,241 @@
+import argparse
+import csv
+import json
+import mmap
+import os
+import sys
+from multiprocessing import Pool
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+from accumulation import (
+    MS_PER_DAY, accumulate_columns, groups_to_row_data, is_utc, local_day_of, merge_groups, merge_results, parse_timestamp, rows_to_columns
+)
+
+# Recomputes the daily table offline from an export of the raw collection.
+# The export is streamed in chunks, so memory is bounded by the number of
+# meter-days in the output rather than by the size of the file.
+#
+#   python functions/accumulate_measurements/replay.py raw.jsonl -o daily.jsonl --workers 4
+#
+# Days are UTC unless --timezone (every meter) or --timezones (a JSON file mapping
+# meter $id to IANA zone, with --timezone for the rest) place them in local time,
+# as the function does with METER_TIMEZONE and the meters' timezone attribute.
+
+DEFAULT_CHUNK_SIZE = 100_000
+
+NUMERIC_FIELDS = ['current_consumption_hca', 'consumption_at_set_date_17_hca']
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    formats = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl', '.csv': 'csv', '.parquet': 'parquet'}
+    if extension not in formats:
+        raise ValueError(f"Cannot infer the format of {path}; pass --format")
+    return formats[extension]
+
+
+def parse_number(value):
+    if value is None or value == '':
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def normalize_row(row):
+    # Exports may flatten the relationship into `meters.$id`
+    if 'meters' not in row and 'meters.$id' in row:
+        row['meters'] = row['meters.$id']
+    return row
+
+
+def read_jsonl(path, part=None):
+    # `part` is a (start, end) byte range starting on a line boundary
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, end = part or (0, len(mm))
+            mm.seek(start)
+            while mm.tell() < end:
+                line = mm.readline()
+                if line.strip():
+                    yield normalize_row(json.loads(line))
+
+
+def read_csv(path, part=None):
+    with open(path, newline='') as f:
+        if part is None:
+            reader = csv.DictReader(f)
+        else:
+            # Byte ranges assume one record per line, as the raw exports are written
+            fieldnames = next(csv.reader([f.readline()]))
+            reader = csv.DictReader(read_lines(path, part), fieldnames=fieldnames)
+        for row in reader:
+            for field in NUMERIC_FIELDS:
+                row[field] = parse_number(row.get(field))
+            row['set_date_17'] = row.get('set_date_17') or None
+            yield normalize_row(row)
+
+
+def read_lines(path, part):
+    with open(path, 'rb') as f:
+        f.seek(part[0])
+        while f.tell() < part[1]:
+            line = f.readline()
+            if not line:
+                return
+            yield line.decode('utf-8')
+
+
+def read_parquet(path, chunk_size, part=None):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Reading Parquet exports requires pyarrow (pip install pyarrow)")
+
+    # `part` is a list of row group indexes
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, row_groups=part):
+        yield from (normalize_row(row) for row in batch.to_pylist())
+
+
+def iter_rows(path, file_format, chunk_size, part=None):
+    if file_format == 'jsonl':
+        return read_jsonl(path, part)
+    if file_format == 'csv':
+        return read_csv(path, part)
+    return read_parquet(path, chunk_size, part)
+
+
+def split_input(path, file_format, parts):
+    # Splits the export into at most `parts` contiguous parts, in file order, so each
+    # worker only reads and parses its own share: byte ranges cut on line boundaries
+    # for JSONL and CSV, runs of row groups for Parquet
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        row_groups = pq.ParquetFile(path).num_row_groups
+        bounds = sorted({row_groups * i // parts for i in range(parts + 1)})
+        return [list(range(a, b)) for a, b in zip(bounds, bounds[1:])]
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        # The CSV header is read by every worker, so it belongs to no range
+        start = len(f.readline()) if file_format == 'csv' else 0
+        bounds = [start]
+        for i in range(1, parts):
+            f.seek(max(bounds[-1], start + (size - start) * i // parts))
+            if f.tell() > 0:
+                # Move to the start of the next line
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(f.tell())
+        bounds.append(size)
+    bounds = sorted(set(bounds))
+    return [(a, b) for a, b in zip(bounds, bounds[1:])]
+
+
+def iter_chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay_groups(path, file_format, chunk_size, date_from=None, date_to=None, timezones=None, default_timezone=None, part=None):
+    # Returns the partial groups of every (meter, day) read from `part` of the export
+    # (the whole export without one). `timezones` maps meter $id to IANA zone; other
+    # meters use `default_timezone` (UTC without one).
+    first_day = parse_timestamp(f"{date_from}T00:00:00") // MS_PER_DAY if date_from else None
+    last_day = parse_timestamp(f"{date_to}T00:00:00") // MS_PER_DAY if date_to else None
+    local = bool(timezones) or not is_utc(default_timezone)
+
+    groups = {}
+    for chunk in iter_chunks(iter_rows(path, file_format, chunk_size, part), chunk_size):
+        columns = rows_to_columns(chunk)
+        zones = [(timezones or {}).get(meter) or default_timezone for meter in columns['meters']] if local else None
+        if first_day is not None or last_day is not None:
+            # --from and --to are local days, like the days the rows are bucketed into
+            keep = []
+            for i, timestamp in enumerate(columns['timestamp']):
+                day = local_day_of(zones[i], timestamp) if zones and not is_utc(zones[i]) else timestamp // MS_PER_DAY
+                if (first_day is None or day >= first_day) and (last_day is None or day <= last_day):
+                    keep.append(i)
+            if len(keep) != len(chunk):
+                columns = {name: [values[i] for i in keep] for name, values in columns.items()}
+                zones = [zones[i] for i in keep] if zones else None
+
+        merge_results(groups, accumulate_columns(
+            columns['meters'],
+            columns['timestamp'],
+            columns['current_consumption_hca'],
+            columns['consumption_at_set_date_17_hca'],
+            columns['set_date_17'],
+            zones
+        ))
+    return groups
+
+
+def replay(path, file_format, chunk_size, date_from=None, date_to=None, timezones=None, default_timezone=None):
+    # Returns the row_data records for every (meter, day) in the export
+    return groups_to_row_data(replay_groups(path, file_format, chunk_size, date_from, date_to, timezones, default_timezone))
+
+
+def replay_part(args):
+    return replay_groups(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute daily measurements from a raw collection export.")
+    parser.add_argument('input', help="Raw export (.jsonl, .csv or .parquet)")
+    parser.add_argument('-o', '--output', help="Write daily rows as JSONL to this file instead of stdout")
+    parser.add_argument('--format', choices=['jsonl', 'csv', 'parquet'], help="Input format (default: from extension)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="Raw rows accumulated per chunk")
+    parser.add_argument('--workers', type=int, default=1, help="Processes to split the export across")
+    parser.add_argument('--from', dest='date_from', help="First day to include (YYYY-MM-DD)")
+    parser.add_argument('--to', dest='date_to', help="Last day to include (YYYY-MM-DD)")
+    parser.add_argument('--timezone', help="IANA timezone of meters without their own (default: UTC)")
+    parser.add_argument('--timezones', help="JSON file mapping meter $id to IANA timezone")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or detect_format(args.input)
+    timezones = None
+    if args.timezones:
+        with open(args.timezones) as f:
+            timezones = json.load(f)
+    workers = max(1, args.workers)
+    replay_args = (args.input, file_format, args.chunk_size, args.date_from, args.date_to, timezones, args.timezone)
+
+    if workers == 1:
+        rows = groups_to_row_data(replay_part(replay_args))
+    else:
+        # Each worker reads its own part of the export; the parts are merged in file
+        # order so a meter-day split across parts ends on the same reading
+        parts = split_input(args.input, file_format, workers)
+        with Pool(min(workers, len(parts) or 1)) as pool:
+            partial_groups = pool.map(replay_part, [replay_args + (part,) for part in parts])
+        groups = {}
+        for partial in partial_groups:
+            merge_groups(groups, partial)
+        rows = groups_to_row_data(groups)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for row in rows:
+            output.write(json.dumps(row) + '\n')
+    finally:
+        if args.output:
+            output.close()
+
+    print(f"Replayed {len(rows)} daily rows from {args.input}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
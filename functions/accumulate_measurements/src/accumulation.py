@@ -0,0 +1,513 @@
+import hashlib
+import json
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+# Pure accumulation logic, free of Appwrite and function-context concerns.
+# Raw rows are handled as columns so that millions of readings can be
+# reduced in one pass, whether they come from the API or from an export.
+# NumPy is imported by the functions that need it: it is the largest import
+# of a cold start, and the single-device and event paths never use it.
+
+MS_PER_DAY = 86_400_000
+
+EPOCH_DATE = date(1970, 1, 1)
+
+# Anomalies found while accumulating a day, stored on the daily row as a compact
+# comma-separated `status` ("ok" when there are none)
+FLAG_NEGATIVE = 1
+FLAG_RESET = 2
+FLAG_SINGLE_READING = 4
+FLAG_OUTLIER = 8
+FLAG_NAMES = [(FLAG_NEGATIVE, 'negative'), (FLAG_RESET, 'reset'), (FLAG_SINGLE_READING, 'single_reading'), (FLAG_OUTLIER, 'outlier')]
+
+# A meter's baseline needs this many normal days before outliers are flagged against it
+BASELINE_MIN_DAYS = 7
+
+
+def is_utc(tz_name):
+    return tz_name in (None, '', 'UTC', 'Etc/UTC')
+
+
+@lru_cache(maxsize=65536)
+def local_day_start(tz_name, day_number):
+    # Epoch milliseconds of local midnight starting day `day_number` (days since 1970-01-01)
+    local_date = EPOCH_DATE + timedelta(days=day_number)
+    if is_utc(tz_name):
+        return day_number * MS_PER_DAY
+    midnight = datetime.combine(local_date, time.min, tzinfo=ZoneInfo(tz_name))
+    return int(midnight.timestamp() * 1000)
+
+
+def day_number(value):
+    # Days since 1970-01-01 of a date or datetime, ignoring any time of day
+    value = value.date() if isinstance(value, datetime) else value
+    return (value - EPOCH_DATE).days
+
+
+def day_label(day):
+    # Local calendar day as stored in the `day` attribute
+    return f"{EPOCH_DATE + timedelta(days=int(day))}T00:00:00"
+
+
+def day_window(target_date, tz_name=None):
+    # Inclusive bounds of a local day as the naive UTC ISO strings raw `timestamp`
+    # values are compared against. Without a timezone they match the stored `day`.
+    if is_utc(tz_name):
+        start_of_day = datetime.combine(target_date, time.min).isoformat()
+        end_of_day = datetime.combine(target_date, time.max).isoformat()
+        return start_of_day, end_of_day
+    day = day_number(target_date)
+    start = datetime.fromtimestamp(local_day_start(tz_name, day) / 1000, timezone.utc).replace(tzinfo=None)
+    end = datetime.fromtimestamp(local_day_start(tz_name, day + 1) / 1000, timezone.utc).replace(tzinfo=None) - timedelta(microseconds=1)
+    return start.isoformat(), end.isoformat()
+
+
+def local_day_of(tz_name, timestamp):
+    # Local day number of one epoch-ms timestamp, from the cached day boundaries
+    day = timestamp // MS_PER_DAY
+    while timestamp < local_day_start(tz_name, day):
+        day -= 1
+    while timestamp >= local_day_start(tz_name, day + 1):
+        day += 1
+    return day
+
+
+def local_day_numbers(timestamps, timezones=None):
+    # Local day number of every timestamp. `timezones` holds one IANA name per
+    # timestamp (None = UTC); each zone is bucketed with one searchsorted over
+    # its cached midnights, so DST changes need no per-row datetime work.
+    import numpy as np
+    days = timestamps // MS_PER_DAY
+    if timezones is None:
+        return days
+    timezones = np.asarray(timezones, dtype=object)
+    for tz_name in set(timezones.tolist()):
+        if is_utc(tz_name):
+            continue
+        mask = timezones == tz_name
+        first = int(days[mask].min()) - 1
+        last = int(days[mask].max()) + 1
+        starts = np.array([local_day_start(tz_name, d) for d in range(first, last + 2)], dtype=np.int64)
+        days[mask] = first + np.searchsorted(starts, timestamps[mask], side='right') - 1
+    return days
+
+
+@lru_cache(maxsize=16)
+def status_label(flags):
+    return ','.join(name for bit, name in FLAG_NAMES if flags & bit) or 'ok'
+
+
+def status_flags(status):
+    names = (status or '').split(',')
+    return sum(bit for bit, name in FLAG_NAMES if name in names)
+
+
+def day_flags(current, single_reading, set_date_changed):
+    # Scalar counterpart of the flags accumulate_columns computes for whole arrays.
+    # A negative delta across a change of the set date (or of the value stored at
+    # it) is the allocator resetting; any other negative delta is flagged as such.
+    flags = FLAG_SINGLE_READING if single_reading else 0
+    if current < 0:
+        flags |= FLAG_RESET if set_date_changed else FLAG_NEGATIVE
+    return flags
+
+
+def meter_ref(value):
+    # Relationship attributes come back either as an $id or as the related row
+    if isinstance(value, dict):
+        return value.get('$id')
+    return value
+
+
+def parse_timestamp(value):
+    # Epoch milliseconds; naive timestamps are taken to be UTC
+    parsed = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def format_timestamp(milliseconds):
+    # Inverse of parse_timestamp, in the format Appwrite stores datetimes
+    return datetime.fromtimestamp(milliseconds / 1000, timezone.utc).isoformat(timespec='milliseconds')
+
+
+def rows_to_columns(rows):
+    columns = {
+        'meters': [],
+        'timestamp': [],
+        'current_consumption_hca': [],
+        'consumption_at_set_date_17_hca': [],
+        'set_date_17': []
+    }
+    for row in rows:
+        columns['meters'].append(meter_ref(row.get('meters')))
+        columns['timestamp'].append(parse_timestamp(row['timestamp']))
+        columns['current_consumption_hca'].append(row.get('current_consumption_hca') or 0)
+        columns['consumption_at_set_date_17_hca'].append(row.get('consumption_at_set_date_17_hca', 0))
+        columns['set_date_17'].append(row.get('set_date_17'))
+    return columns
+
+
+def accumulate_columns(meters, timestamps, current, last_month, set_date, timezones=None):
+    # Reduces raw readings to one record per (meter, local day).
+    # `timestamps` are epoch milliseconds; all inputs are equally long sequences.
+    # `timezones` optionally gives each reading's IANA zone; days are UTC without it.
+    import numpy as np
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if timestamps.size == 0:
+        return empty_result()
+
+    meter_values, meter_codes = np.unique(np.asarray(meters, dtype=object).astype(str), return_inverse=True)
+    days = local_day_numbers(timestamps, timezones)
+
+    # Sort by meter, day and timestamp; each (meter, day) group is then contiguous
+    order = np.lexsort((timestamps, days, meter_codes))
+    sorted_meters = meter_codes[order]
+    sorted_days = days[order]
+    is_group_start = np.empty(order.size, dtype=bool)
+    is_group_start[0] = True
+    is_group_start[1:] = (sorted_meters[1:] != sorted_meters[:-1]) | (sorted_days[1:] != sorted_days[:-1])
+
+    starts = np.flatnonzero(is_group_start)
+    ends = np.append(starts[1:], order.size) - 1
+    first = order[starts]
+    last = order[ends]
+
+    current = np.asarray(current)
+    start_values = current[first]
+    end_values = current[last]
+    last_month = np.asarray(last_month, dtype=object)
+    set_date = np.asarray(set_date, dtype=object)
+    readings = ends - starts + 1
+
+    # Flags for every group at once, see day_flags
+    set_date_changed = (set_date[first] != set_date[last]) | (last_month[first] != last_month[last])
+    negative = end_values < start_values
+    flags = (
+        np.where(readings == 1, FLAG_SINGLE_READING, 0)
+        | np.where(negative & set_date_changed, FLAG_RESET, 0)
+        | np.where(negative & ~set_date_changed, FLAG_NEGATIVE, 0)
+    )
+
+    return {
+        'meters': meter_values[meter_codes[first]],
+        'day': days[first].astype('datetime64[D]'),
+        'start': start_values,
+        'end': end_values,
+        'current': end_values - start_values,
+        'last_month': last_month[first],
+        'date_last_month': set_date[first],
+        'last_month_end': last_month[last],
+        'date_last_month_end': set_date[last],
+        'readings': readings,
+        'flags': flags,
+        'first_timestamp': timestamps[first],
+        'last_timestamp': timestamps[last]
+    }
+
+
+def empty_result():
+    import numpy as np
+    return {
+        'meters': np.array([], dtype=str),
+        'day': np.array([], dtype='datetime64[D]'),
+        'start': np.array([]),
+        'end': np.array([]),
+        'current': np.array([]),
+        'last_month': np.array([], dtype=object),
+        'date_last_month': np.array([], dtype=object),
+        'last_month_end': np.array([], dtype=object),
+        'date_last_month_end': np.array([], dtype=object),
+        'readings': np.array([], dtype=np.int64),
+        'flags': np.array([], dtype=np.int64),
+        'first_timestamp': np.array([], dtype=np.int64),
+        'last_timestamp': np.array([], dtype=np.int64)
+    }
+
+
+def build_row_data(internal_device_id, start_of_day, earliest_doc, latest_doc):
+    start_val = earliest_doc.get('current_consumption_hca', 0)
+    end_val = latest_doc.get('current_consumption_hca', 0)
+    single_reading = earliest_doc.get('$id', id(earliest_doc)) == latest_doc.get('$id', id(latest_doc))
+    set_date_changed = (
+        earliest_doc.get('set_date_17') != latest_doc.get('set_date_17')
+        or earliest_doc.get('consumption_at_set_date_17_hca', 0) != latest_doc.get('consumption_at_set_date_17_hca', 0)
+    )
+
+    return {
+        # Local calendar day, without any offset or fraction the caller's string carries
+        'day': start_of_day[:19],
+        'start': start_val,
+        'end': end_val,
+        'meters': internal_device_id,
+        'current': end_val - start_val,
+        'last_month': earliest_doc.get('consumption_at_set_date_17_hca', 0),
+        'date_last_month': earliest_doc.get('set_date_17'),
+        'first_timestamp': format_timestamp(parse_timestamp(earliest_doc['timestamp'])),
+        'last_timestamp': format_timestamp(parse_timestamp(latest_doc['timestamp'])),
+        'status': status_label(day_flags(end_val - start_val, single_reading, set_date_changed))
+    }
+
+
+def content_hash(row_data):
+    # Stable digest of a daily row's values, stored with the row so that a re-run
+    # can tell that recomputing the day produced nothing new
+    values = {k: v for k, v in row_data.items() if not k.startswith('$') and k != 'content_hash'}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def apply_reading(row_data, reading):
+    # Folds a single raw reading into a stored daily row in O(1), like merge_results
+    # does for chunks. Returns the updated row_data, or None when the reading lies
+    # inside the stored bounds and changes nothing.
+    timestamp = parse_timestamp(reading['timestamp'])
+    value = reading.get('current_consumption_hca') or 0
+    updated = dict(row_data)
+    if timestamp < parse_timestamp(row_data['first_timestamp']):
+        updated['start'] = value
+        updated['first_timestamp'] = format_timestamp(timestamp)
+        updated['last_month'] = reading.get('consumption_at_set_date_17_hca', 0)
+        updated['date_last_month'] = reading.get('set_date_17')
+    set_date_changed = bool(status_flags(row_data.get('status')) & FLAG_RESET)
+    if timestamp >= parse_timestamp(row_data['last_timestamp']):
+        updated['end'] = value
+        updated['last_timestamp'] = format_timestamp(timestamp)
+        set_date_changed = (
+            reading.get('set_date_17') != updated['date_last_month']
+            or reading.get('consumption_at_set_date_17_hca', 0) != updated['last_month']
+        )
+    if updated == row_data:
+        return None
+    updated['current'] = updated['end'] - updated['start']
+    single_reading = updated['first_timestamp'] == updated['last_timestamp']
+    # Outliers are judged by the bulk path against the meter's baseline; keep its verdict
+    outlier = status_flags(row_data.get('status')) & FLAG_OUTLIER
+    updated['status'] = status_label(day_flags(updated['current'], single_reading, set_date_changed) | outlier)
+    return updated
+
+
+def to_row_data(result):
+    # Converts accumulate_columns output into daily rows with plain Python values
+    rows = []
+    for i in range(len(result['meters'])):
+        rows.append({
+            'day': f"{result['day'][i]}T00:00:00",
+            'start': result['start'][i].item(),
+            'end': result['end'][i].item(),
+            'meters': str(result['meters'][i]),
+            'current': result['current'][i].item(),
+            'last_month': result['last_month'][i],
+            'date_last_month': result['date_last_month'][i],
+            'first_timestamp': format_timestamp(int(result['first_timestamp'][i])),
+            'last_timestamp': format_timestamp(int(result['last_timestamp'][i])),
+            'status': status_label(int(result['flags'][i]))
+        })
+    return rows
+
+
+def merge_results(groups, result):
+    # Folds an accumulate_columns result into `groups`, keyed by (meter, day).
+    # Lets a stream be accumulated chunk by chunk with memory bounded by the
+    # number of meter-days rather than the number of readings.
+    for i in range(len(result['meters'])):
+        merge_group(groups, (str(result['meters'][i]), str(result['day'][i])), {
+            'start': result['start'][i].item(),
+            'end': result['end'][i].item(),
+            'last_month': result['last_month'][i],
+            'date_last_month': result['date_last_month'][i],
+            'last_month_end': result['last_month_end'][i],
+            'date_last_month_end': result['date_last_month_end'][i],
+            'readings': int(result['readings'][i]),
+            'first_timestamp': int(result['first_timestamp'][i]),
+            'last_timestamp': int(result['last_timestamp'][i])
+        })
+    return groups
+
+
+def merge_groups(groups, other):
+    # Folds groups accumulated from a later part of the same stream into `groups`
+    for key, group in other.items():
+        merge_group(groups, key, dict(group))
+    return groups
+
+
+def merge_group(groups, key, partial):
+    group = groups.get(key)
+    if group is None:
+        groups[key] = partial
+        return
+
+    group['readings'] += partial['readings']
+    if partial['first_timestamp'] < group['first_timestamp']:
+        group['first_timestamp'] = partial['first_timestamp']
+        group['start'] = partial['start']
+        group['last_month'] = partial['last_month']
+        group['date_last_month'] = partial['date_last_month']
+    if partial['last_timestamp'] >= group['last_timestamp']:
+        group['last_timestamp'] = partial['last_timestamp']
+        group['end'] = partial['end']
+        group['last_month_end'] = partial['last_month_end']
+        group['date_last_month_end'] = partial['date_last_month_end']
+
+
+def groups_to_row_data(groups):
+    rows = []
+    for (meter, day), group in sorted(groups.items()):
+        rows.append({
+            'day': f"{day}T00:00:00",
+            'start': group['start'],
+            'end': group['end'],
+            'meters': meter,
+            'current': group['end'] - group['start'],
+            'last_month': group['last_month'],
+            'date_last_month': group['date_last_month'],
+            'first_timestamp': format_timestamp(group['first_timestamp']),
+            'last_timestamp': format_timestamp(group['last_timestamp']),
+            'status': status_label(day_flags(
+                group['end'] - group['start'],
+                group['readings'] == 1,
+                group['date_last_month'] != group['date_last_month_end'] or group['last_month'] != group['last_month_end']
+            ))
+        })
+    return rows
+
+
+def accumulate_rows(rows, timezones=None, default_timezone=None):
+    # `timezones` maps meter $id to IANA zone; other meters use `default_timezone`
+    columns = rows_to_columns(rows)
+    zones = None
+    if timezones or not is_utc(default_timezone):
+        zones = [(timezones or {}).get(meter) or default_timezone for meter in columns['meters']]
+    return to_row_data(accumulate_columns(
+        columns['meters'],
+        columns['timestamp'],
+        columns['current_consumption_hca'],
+        columns['consumption_at_set_date_17_hca'],
+        columns['set_date_17'],
+        zones
+    ))
+
+
+def rollup_keys(row_data):
+    # (kind, period) pairs a daily row counts towards: its calendar month and, when
+    # the meter reports a set date, the billing period that began on it
+    keys = [('month', row_data['day'][:7])]
+    if row_data.get('date_last_month'):
+        keys.append(('period', str(row_data['date_last_month'])[:10]))
+    return keys
+
+
+def new_rollup(row_data, kind, period):
+    day = row_data['day'][:10]
+    return {
+        'meters': row_data['meters'],
+        'kind': kind,
+        'period': period,
+        'first_day': day,
+        'last_day': day,
+        'days': 1,
+        'start': row_data['start'],
+        'end': row_data['end'],
+        'current': row_data['current'],
+        'last_day_current': row_data['current']
+    }
+
+
+def fold_rollup(rollup, row_data):
+    # Adds one daily row to a rollup in O(1). Days after the covered range extend it,
+    # and the last day can be rewritten because its contribution is kept. Returns
+    # None for any other day already inside the range, which needs a rebuild.
+    day = row_data['day'][:10]
+    updated = dict(rollup)
+    if day > rollup['last_day']:
+        updated.update(
+            last_day=day,
+            end=row_data['end'],
+            days=rollup['days'] + 1,
+            current=rollup['current'] + row_data['current'],
+            last_day_current=row_data['current']
+        )
+    elif day == rollup['last_day']:
+        updated.update(
+            end=row_data['end'],
+            current=rollup['current'] - rollup['last_day_current'] + row_data['current'],
+            last_day_current=row_data['current']
+        )
+        if day == rollup['first_day']:
+            updated['start'] = row_data['start']
+    elif day < rollup['first_day']:
+        updated.update(
+            first_day=day,
+            start=row_data['start'],
+            days=rollup['days'] + 1,
+            current=rollup['current'] + row_data['current']
+        )
+    else:
+        return None
+    return updated
+
+
+def after_baseline(row_data, baseline):
+    # Whether the day is newer than every day folded into the baseline. Older days
+    # are already part of it, so judging them would compare a day with its future.
+    return not baseline or row_data['day'][:10] > baseline['last_day']
+
+
+def flag_outliers(rows, baselines, factor):
+    # Flags daily rows whose delta lies more than `factor` mean absolute deviations
+    # (at least one unit) from the meter's rolling baseline, for all meters at once.
+    # `baselines` maps meter $id to fold_baseline output; young baselines are ignored,
+    # as are days the baseline already covers and days whose delta is already flagged
+    # as negative, a reset or a single reading.
+    import numpy as np
+    known = [
+        i for i, row in enumerate(rows)
+        if (baselines.get(row['meters']) or {}).get('days', 0) >= BASELINE_MIN_DAYS
+        and after_baseline(row, baselines[row['meters']])
+        and row['status'] == 'ok'
+    ]
+    if not known:
+        return 0
+    current = np.array([rows[i]['current'] for i in known], dtype=float)
+    mean = np.array([baselines[rows[i]['meters']]['mean'] for i in known], dtype=float)
+    deviation = np.array([baselines[rows[i]['meters']]['deviation'] for i in known], dtype=float)
+    outliers = np.flatnonzero(np.abs(current - mean) > factor * np.maximum(deviation, 1))
+    for i in outliers:
+        row = rows[known[i]]
+        row['status'] = status_label(status_flags(row['status']) | FLAG_OUTLIER)
+    return len(outliers)
+
+
+def fold_baseline(baseline, row_data, span):
+    # Exponentially weighted mean and mean absolute deviation of a meter's daily
+    # consumption over roughly `span` days. Outliers are folded in so the baseline
+    # follows lasting changes; negative, reset and single-reading days are not.
+    # Returns None when the day is skipped or was already folded in.
+    if status_flags(row_data.get('status')) & (FLAG_NEGATIVE | FLAG_RESET | FLAG_SINGLE_READING):
+        return None
+    day = row_data['day'][:10]
+    current = float(row_data['current'])
+    if not baseline or not baseline.get('days'):
+        return {
+            'meters': row_data['meters'],
+            'kind': 'baseline',
+            'period': 'rolling',
+            'last_day': day,
+            'days': 1,
+            'mean': current,
+            'deviation': 0.0
+        }
+    if day <= baseline['last_day']:
+        return None
+    alpha = 2 / (span + 1)
+    difference = current - baseline['mean']
+    return dict(
+        baseline,
+        last_day=day,
+        days=baseline['days'] + 1,
+        mean=baseline['mean'] + alpha * difference,
+        deviation=(1 - alpha) * baseline['deviation'] + alpha * abs(difference)
+    )
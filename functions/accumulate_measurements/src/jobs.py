@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta, timezone
+from appwrite.query import Query
+
+# Accumulation jobs are rows of the jobs table, one per (device, date), written by
+# the trigger with a deterministic $id so that re-enqueueing a day never duplicates it.
+#
+#   pending  waiting to be claimed once next_attempt_at has passed
+#   running  claimed; next_attempt_at is the end of the lease, after which another
+#            worker may claim it again. attempts counts claims.
+#   done     accumulated, or no raw data for the day
+#   failed   gave up after max attempts; last_error says why
+
+# Attributes a worker writes back; everything else in a job row is left as enqueued
+JOB_FIELDS = ['device_id', 'meter_id', 'date', 'status', 'attempts', 'last_error', 'next_attempt_at', 'claimed_by']
+
+# Rows per bulk upsert request
+JOB_UPSERT_CHUNK_SIZE = 100
+
+
+def iso(moment):
+    return moment.isoformat(timespec='milliseconds')
+
+
+def job_fields(row):
+    return dict({field: row.get(field) for field in JOB_FIELDS}, **{'$id': row['$id']})
+
+
+def upsert_jobs(tables_db, database_id, jobs_collection_id, rows):
+    for i in range(0, len(rows), JOB_UPSERT_CHUNK_SIZE):
+        tables_db.upsert_rows(database_id, jobs_collection_id, rows[i:i + JOB_UPSERT_CHUNK_SIZE])
+
+
+def held_jobs(tables_db, database_id, jobs_collection_id, job_ids, worker_id):
+    # $ids among `job_ids` that are still running under this worker
+    held = set()
+    for i in range(0, len(job_ids), JOB_UPSERT_CHUNK_SIZE):
+        chunk = job_ids[i:i + JOB_UPSERT_CHUNK_SIZE]
+        page = tables_db.list_rows(database_id, jobs_collection_id, queries=[
+            Query.equal('$id', chunk),
+            Query.select(['$id', 'status', 'claimed_by']),
+            Query.limit(len(chunk))
+        ])
+        held.update(row['$id'] for row in page.get('rows', [])
+                    if row.get('status') == 'running' and row.get('claimed_by') == worker_id)
+    return held
+
+
+def claim_jobs(tables_db, database_id, jobs_collection_id, worker_id, limit, lease_seconds, max_attempts):
+    # Claims up to `limit` due jobs by writing this worker into them. Every claim counts
+    # as an attempt, so a job whose lease keeps expiring (the worker timed out or
+    # crashed) gives up after max_attempts like one that keeps failing.
+    # Returns the claimed jobs, the number of jobs that gave up and the number of due
+    # jobs found; jobs found but not returned went to other workers.
+    #
+    # Appwrite has no conditional update, so the claim is read back and only jobs this
+    # worker still holds are returned. That settles claims whose writes land before
+    # either read-back, but a claim written after another worker has already read its
+    # own back leaves both running the job. Accumulation is an idempotent upsert, so a
+    # double run repeats work without changing the result.
+    now = datetime.now(timezone.utc)
+    page = tables_db.list_rows(database_id, jobs_collection_id, queries=[
+        Query.equal('status', ['pending', 'running']),
+        Query.less_than_equal('next_attempt_at', iso(now)),
+        Query.order_asc('next_attempt_at'),
+        Query.select(['$id'] + JOB_FIELDS),
+        Query.limit(limit)
+    ])
+    rows = page.get('rows', [])
+    if not rows:
+        return [], 0, 0
+
+    lease_until = iso(now + timedelta(seconds=lease_seconds))
+    claimed = []
+    expired = []
+    for row in rows:
+        attempts = row.get('attempts') or 0
+        if attempts >= max_attempts:
+            # Only a lease that ran out can leave a job due with no attempts left
+            expired.append(dict(job_fields(row), status='failed', claimed_by=None,
+                                last_error=f"Lease expired after {attempts} attempts"))
+        else:
+            claimed.append(dict(job_fields(row), status='running', attempts=attempts + 1, claimed_by=worker_id, next_attempt_at=lease_until))
+    upsert_jobs(tables_db, database_id, jobs_collection_id, claimed + expired)
+    if not claimed:
+        return [], len(expired), len(rows)
+
+    mine = held_jobs(tables_db, database_id, jobs_collection_id, [row['$id'] for row in claimed], worker_id)
+    return [row for row in claimed if row['$id'] in mine], len(expired), len(rows)
+
+
+def retry_delay(attempts, base_delay, max_delay):
+    # Exponential backoff in seconds after the given number of failed attempts
+    return min(max_delay, base_delay * (2 ** (attempts - 1)))
+
+
+def finish_jobs(tables_db, database_id, jobs_collection_id, worker_id, jobs, errors, max_attempts, base_delay, max_delay):
+    # Marks claimed jobs done, or schedules a retry for those in `errors` ({$id: message})
+    # until max_attempts is reached. Jobs this worker no longer holds (re-enqueued with a
+    # reset, or claimed by another worker after the lease ran out) are left to their new
+    # state. Returns the jobs written and the number of jobs that gave up.
+    now = datetime.now(timezone.utc)
+    mine = held_jobs(tables_db, database_id, jobs_collection_id, [job['$id'] for job in jobs], worker_id)
+    finished = [job for job in jobs if job['$id'] in mine]
+    updates = []
+    gave_up = 0
+    for job in finished:
+        error = errors.get(job['$id'])
+        if error is None:
+            updates.append(dict(job, status='done', last_error=None, claimed_by=None))
+            continue
+
+        # The claim already counted this attempt
+        attempts = job.get('attempts') or 1
+        if attempts >= max_attempts:
+            gave_up += 1
+            updates.append(dict(job, status='failed', last_error=error[:1000], claimed_by=None))
+        else:
+            next_attempt_at = iso(now + timedelta(seconds=retry_delay(attempts, base_delay, max_delay)))
+            updates.append(dict(job, status='pending', last_error=error[:1000],
+                                next_attempt_at=next_attempt_at, claimed_by=None))
+    upsert_jobs(tables_db, database_id, jobs_collection_id, updates)
+    return finished, gave_up
@@ -1,23 +1,132 @@
-from appwrite.client import Client
-from appwrite.services.tables_db import TablesDB
 from appwrite.query import Query
+import hashlib
 import json
 import os
+import sys
+import uuid
 import warnings
-from datetime import datetime, time
+import zlib
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+# The sibling modules are imported by name, and the Appwrite runtime does not
+# necessarily run this file with its own directory on the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from accumulation import (
+    EPOCH_DATE, FLAG_OUTLIER, accumulate_rows, after_baseline, apply_reading, build_row_data, content_hash, day_label,
+    day_number, day_window, flag_outliers, fold_baseline, is_utc, local_day_of, local_day_start, meter_ref,
+    parse_timestamp, status_flags, status_label
+)
+from client_pool import ClientPool
+from instrumentation import Instrumented, Metrics, debug_enabled
+from jobs import claim_jobs, finish_jobs
+from meter_cache import MeterIdCache
+from rollups import load_baselines, recompute_rollups, update_rollups
+from zoneinfo import ZoneInfo
+
+# Imported on first connect, so requests rejected before reaching Appwrite skip the SDK services
+TablesDB = None
+
+# Environment variables that make up the configuration, validated once per set of values
+CONFIG_ENV = [
+    'APPWRITE_DATABASE_ID',
+    'APPWRITE_RAW_COLLECTION_ID',
+    'APPWRITE_DAILY_COLLECTION_ID',
+    'APPWRITE_METERS_COLLECTION_ID',
+    'METER_TIMEZONE',
+    'METER_TIMEZONE_ATTRIBUTE',
+    'APPWRITE_ROLLUPS_COLLECTION_ID',
+    'OUTLIER_FACTOR',
+    'BASELINE_DAYS',
+    'METER_ID_CACHE_SIZE',
+    'METER_ID_CACHE_TTL_SECONDS',
+    'APPWRITE_HTTP_POOL_SIZE'
+]
+
+# Page size used when a shard worker enumerates the meters collection
+METERS_PAGE_SIZE = 100
+
+# Page size used when batch mode scans the raw collection
+RAW_PAGE_SIZE = 1000
+
+# Maximum number of values Appwrite accepts in a single Query.equal
+QUERY_VALUES_LIMIT = 100
+
+# device-id -> meter $id mappings, shared by all executions of a warm container.
+# Sized by read_config.
+METER_ID_CACHE = MeterIdCache()
+
+# Appwrite clients and their keep-alive HTTP connections, reused by warm executions.
+# Sized by read_config.
+CLIENT_POOL = ClientPool()
+
+# Page size of the projected single-query day scan; days that fit in one page are
+# scanned instead of fetched with separate earliest/latest queries
+DAY_SCAN_PAGE_SIZE = 100
+
+# meter $id -> IANA timezone, filled from meters lookups when METER_TIMEZONE_ATTRIBUTE is set
+METER_TIMEZONES = {}
+
+# Learned readings per day by meter $id, used to choose between scan and point queries
+READINGS_PER_DAY = {}
+
+# Rows per bulk upsert request in batch mode
+UPSERT_CHUNK_SIZE = 100
+
+# Appwrite row IDs are limited to 36 characters
+MAX_ROW_ID_LENGTH = 36
+
+# Job queue defaults, each overridable through the environment
+DEFAULT_JOB_CLAIM_SIZE = 100
+DEFAULT_JOB_MAX_ATTEMPTS = 5
+DEFAULT_JOB_RETRY_BASE_SECONDS = 60
+DEFAULT_JOB_RETRY_MAX_SECONDS = 3600
+DEFAULT_JOB_LEASE_SECONDS = 900
+
+# Longest date range accepted by a single backfill request
+MAX_RANGE_DAYS = 366
+
+# Attributes needed from a raw row to accumulate a day
+RAW_SCAN_FIELDS = [
+    '$id',
+    'meters.$id',
+    'timestamp',
+    'current_consumption_hca',
+    'consumption_at_set_date_17_hca',
+    'set_date_17'
+]
+
+# Attributes needed from a raw row by the per-device path
+DAY_FIELDS = [
+    '$id',
+    'timestamp',
+    'current_consumption_hca',
+    'consumption_at_set_date_17_hca',
+    'set_date_17'
+]
+
+# Attributes of a daily row that the raw-row event handler folds a reading into
+DAILY_BOUNDS_FIELDS = [
+    '$id',
+    'day',
+    'start',
+    'end',
+    'current',
+    'last_month',
+    'date_last_month',
+    'first_timestamp',
+    'last_timestamp',
+    'status'
+]
 
-# Suppress DeprecationWarnings
-warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 def main(context):
     # Retrieve environment variables
-    database_id = os.environ.get('APPWRITE_DATABASE_ID')
-    raw_collection_id = os.environ.get('APPWRITE_RAW_COLLECTION_ID')
-    daily_collection_id = os.environ.get('APPWRITE_DAILY_COLLECTION_ID')
-    meters_collection_id = os.environ.get('APPWRITE_METERS_COLLECTION_ID')
-
-    if not all([database_id, raw_collection_id, daily_collection_id, meters_collection_id]):
-        context.error("Missing environment variables.")
+    try:
+        config = read_config()
+    except ValueError as e:
+        context.error(str(e))
         return context.res.json({"error": "Configuration error"}, 500)
 
     # Parse request body
@@ -30,148 +139,1014 @@ def main(context):
         context.error(f"Failed to parse request body: {str(e)}")
         return context.res.json({"error": "Invalid request body"}, 400)
 
+    # rows.*.create events on the raw table carry the new raw row as the body
+    if context.req.headers.get('x-appwrite-trigger') == 'event':
+        metrics = Metrics()
+        tables_db = connect(context, metrics)
+        body, status_code = handle_raw_event(context, tables_db, config, payload, metrics)
+        return context.res.json(dict(body, metrics=metrics.summary()), status_code)
+
+    # {"jobs": true} turns the execution into a queue worker
+    if payload.get('jobs'):
+        try:
+            settings = read_job_settings()
+            deadline = read_deadline()
+        except ValueError as e:
+            context.error(f"Invalid job queue settings: {str(e)}")
+            return context.res.json({"error": "Configuration error"}, 500)
+        metrics = Metrics()
+        tables_db = connect(context, metrics)
+        try:
+            counts = work_jobs(context, tables_db, config, settings, deadline, metrics)
+        except Exception as e:
+            context.error(f"Error while working the job queue: {str(e)}")
+            return context.res.json({"error": str(e)}, 500)
+        context.log(f"Jobs: {counts['claimed']} claimed, {counts['done']} done, {counts['retried']} to retry, {counts['failed']} failed")
+        return context.res.json(dict(counts, client_pool=CLIENT_POOL.stats(), metrics=metrics.summary()), 200)
+
+    # {"recompute_rollups": true, "device-ids": [...]} rebuilds the devices' rollups from their daily rows
+    if payload.get('recompute_rollups'):
+        return context.res.json(*handle_recompute_rollups(context, config, payload))
+
     device_id = payload.get('device-id')
+    device_ids = payload.get('device-ids')
+    # Internal meter $ids resolved by the trigger, to skip the meters lookup
+    meter_id = payload.get('meter-id')
+    known_meter_ids = payload.get('meter-ids') or {}
+    # Per-device timezones resolved by the trigger
+    known_timezones = payload.get('timezones') or {}
+    shard = payload.get('shard')
+    shards = payload.get('shards')
+    # [after, through] $id bounds of the shard's meters, set by a sharded trigger run
+    id_range = payload.get('id-range')
+    # Set by a sharded trigger run; the worker reports completion to the runs table
+    run_id = payload.get('run-id')
     date_str = payload.get('date') # Expected format: YYYY-MM-DD
+    from_str = payload.get('from')
+    to_str = payload.get('to')
+
+    is_range = bool(from_str or to_str)
+    is_batch = device_ids is not None or shard is not None
 
-    if not device_id or not date_str:
+    if not (date_str or is_range) or not (device_id or is_batch):
         return context.res.json({"error": "Missing device-id or date"}, 400)
 
     try:
-        target_date = datetime.strptime(date_str, '%Y-%m-%d')
-    except ValueError:
+        if is_range:
+            first_day = datetime.strptime(from_str, '%Y-%m-%d')
+            last_day = datetime.strptime(to_str, '%Y-%m-%d')
+        else:
+            first_day = last_day = datetime.strptime(date_str, '%Y-%m-%d')
+    except (TypeError, ValueError):
         return context.res.json({"error": "Invalid date format. Use YYYY-MM-DD"}, 400)
 
-    context.log(f"Processing accumulation for device {device_id} on {date_str}")
+    if last_day < first_day or (last_day - first_day).days >= MAX_RANGE_DAYS:
+        return context.res.json({"error": f"'to' must not be before 'from' and the range must not exceed {MAX_RANGE_DAYS} days"}, 400)
+
+    if device_ids is not None and (not isinstance(device_ids, list) or not all(isinstance(d, str) and d for d in device_ids)):
+        return context.res.json({"error": "device-ids must be a list of device IDs"}, 400)
+
+    if not isinstance(known_meter_ids, dict):
+        return context.res.json({"error": "meter-ids must map device IDs to meter IDs"}, 400)
+
+    if not isinstance(known_timezones, dict):
+        return context.res.json({"error": "timezones must map device IDs to IANA timezones"}, 400)
+
+    if shard is not None and not (isinstance(shard, int) and isinstance(shards, int) and 0 <= shard < shards):
+        return context.res.json({"error": "shard must be an integer between 0 and shards - 1"}, 400)
+
+    if id_range is not None and not (
+        shard is not None and isinstance(id_range, list) and len(id_range) == 2
+        and all(bound is None or (isinstance(bound, str) and bound) for bound in id_range)
+    ):
+        return context.res.json({"error": "id-range must be a shard's [after, through] meter $ids"}, 400)
+
+    if run_id and (shard is None or not os.environ.get('APPWRITE_RUNS_COLLECTION_ID')):
+        return context.res.json({"error": "run-id requires a shard and APPWRITE_RUNS_COLLECTION_ID"}, 400)
+
+    try:
+        deadline = read_deadline()
+    except ValueError:
+        context.error("ACCUMULATE_TIME_BUDGET_SECONDS must be a number.")
+        return context.res.json({"error": "Configuration error"}, 500)
+
+    metrics = Metrics()
+    tables_db = connect(context, metrics)
+
+    if not is_batch and not is_range:
+        if meter_id and known_timezones.get(device_id):
+            remember_timezone(meter_id, known_timezones[device_id], context)
+        body, status_code = accumulate_device(context, tables_db, config, device_id, first_day, meter_id, metrics)
+        context.log(f"Meter ID cache: {METER_ID_CACHE.stats()}")
+        context.log(f"Client pool: {CLIENT_POOL.stats()}")
+        return context.res.json(dict(body, metrics=metrics.summary()), status_code)
 
-    # Define the time range for the day
-    start_of_day = datetime.combine(target_date, time.min).isoformat()
-    end_of_day = datetime.combine(target_date, time.max).isoformat()
+    try:
+        if shard is not None and device_ids is None:
+            context.log(f"Enumerating active meters for shard {shard}/{shards}")
+            with metrics.phase('resolve'):
+                meter_ids = list_shard_meters(tables_db, config, shard, shards, id_range, context)
+            device_ids = list(meter_ids)
+            job = f"shard:{shard}/{shards}" + (f":{id_range[0] or ''}-{id_range[1] or ''}" if id_range else '')
+        else:
+            device_ids = list(dict.fromkeys(device_ids if device_ids is not None else [device_id]))
+            if meter_id:
+                known_meter_ids = dict(known_meter_ids, **{device_id: meter_id})
+            with metrics.phase('resolve'):
+                meter_ids = resolve_meter_ids(tables_db, config, device_ids, known_meter_ids, context)
+            job = "devices:" + ",".join(sorted(device_ids))
 
-    client = Client()
-    client.set_endpoint(os.environ.get('APPWRITE_FUNCTION_ENDPOINT'))
-    client.set_project(os.environ.get('APPWRITE_FUNCTION_PROJECT_ID'))
-    client.set_key(context.req.headers.get('x-appwrite-key') or os.environ.get('APPWRITE_API_KEY'))
+        checkpoint = None
+        if is_range and os.environ.get('APPWRITE_CHECKPOINTS_COLLECTION_ID'):
+            checkpoint = load_checkpoint(tables_db, config, f"{job}|{from_str}|{to_str}")
+            if checkpoint['chunk'] or checkpoint['day']:
+                context.log(f"Resuming from checkpoint: chunk {checkpoint['chunk']}, last completed day {checkpoint['day']}")
 
-    tables_db = TablesDB(client)
+        for known_device_id, tz_name in known_timezones.items():
+            if known_device_id in meter_ids and tz_name:
+                remember_timezone(meter_ids[known_device_id], tz_name, context)
+        with metrics.phase('resolve'):
+            timezones = resolve_timezones(tables_db, config, list(meter_ids.values()), context)
+
+        context.log(f"Processing batch accumulation for {len(device_ids)} devices from {first_day.date()} to {last_day.date()}")
+        results, complete = accumulate_batch(context, tables_db, config, device_ids, meter_ids, first_day, last_day, checkpoint, deadline, metrics, timezones)
+    except Exception as e:
+        context.error(f"Error during batch accumulation: {str(e)}")
+        if run_id:
+            save_shard_row(context, tables_db, config, run_id, shard, shards, 'failed', {}, metrics, str(e))
+        return context.res.json({"error": str(e)}, 500)
+
+    if is_range:
+        # Range results are keyed by device, then by day
+        failed = [d for d, days in results.items() if any(r['status'] >= 500 for r in days.values())]
+        response = {
+            "message": f"Processed {len(results)} devices from {from_str} to {to_str}",
+            "complete": complete,
+            "processed": len(results) - len(failed),
+            "failed": len(failed),
+            "unchanged": sum(1 for days in results.values() for r in days.values() if r.get('unchanged')),
+            "meter_id_cache": METER_ID_CACHE.stats(),
+            "client_pool": CLIENT_POOL.stats(),
+            "metrics": metrics.summary(),
+            "results": results
+        }
+        if not complete:
+            response["message"] = "Time budget exhausted; progress has been checkpointed. Re-run the same request to resume."
+        context.log(f"Backfill {'finished' if complete else 'paused'}: {len(results) - len(failed)} processed, {len(failed)} failed")
+        if run_id:
+            save_shard_row(context, tables_db, config, run_id, shard, shards, 'done' if complete else 'partial', response, metrics)
+        return context.res.json(response, 200 if complete else 202)
 
+    day_key = first_day.strftime('%Y-%m-%d')
+    results = {
+        d: days.get(day_key, {"message": "No data found for the given device and date", "status": 404})
+        for d, days in results.items()
+    }
+    failed = [d for d, r in results.items() if r['status'] >= 500]
+    context.log(f"Batch finished: {len(results) - len(failed)} processed, {len(failed)} failed")
+    response = {
+        "message": f"Processed {len(results)} devices",
+        "processed": len(results) - len(failed),
+        "failed": len(failed),
+        "unchanged": sum(1 for r in results.values() if r.get('unchanged')),
+        "meter_id_cache": METER_ID_CACHE.stats(),
+        "client_pool": CLIENT_POOL.stats(),
+        "metrics": metrics.summary(),
+        "results": results
+    }
+    if run_id:
+        save_shard_row(context, tables_db, config, run_id, shard, shards, 'failed' if failed else 'done', response, metrics)
+    return context.res.json(response, 200)
+
+
+def read_config():
+    # Raises ValueError on missing or invalid configuration. Warm executions reuse
+    # the validated configuration as long as the environment is unchanged.
+    config = dict(load_config(tuple(os.environ.get(name) for name in CONFIG_ENV)))
+    # The pool size takes effect when the first client installs the shared session
+    CLIENT_POOL.pool_size = config['http_pool_size']
+    METER_ID_CACHE.max_size = config['meter_id_cache_size']
+    METER_ID_CACHE.ttl = config['meter_id_cache_ttl']
+    return config
+
+
+@lru_cache(maxsize=4)
+def load_config(values):
+    env = dict(zip(CONFIG_ENV, values))
+    config = {
+        'database_id': env['APPWRITE_DATABASE_ID'],
+        'raw_collection_id': env['APPWRITE_RAW_COLLECTION_ID'],
+        'daily_collection_id': env['APPWRITE_DAILY_COLLECTION_ID'],
+        'meters_collection_id': env['APPWRITE_METERS_COLLECTION_ID'],
+    }
+    if not all(config.values()):
+        raise ValueError("Missing environment variables.")
+
+    # Days are local to each meter's timezone: the meters attribute named by
+    # METER_TIMEZONE_ATTRIBUTE, else the deployment-wide METER_TIMEZONE (UTC by default)
+    config['default_timezone'] = env['METER_TIMEZONE'] or None
+    config['timezone_attribute'] = env['METER_TIMEZONE_ATTRIBUTE'] or None
+    # Monthly and billing-period rollups are maintained when a rollups collection is set
+    config['rollups_collection_id'] = env['APPWRITE_ROLLUPS_COLLECTION_ID'] or None
+    # Batch accumulation flags days more than OUTLIER_FACTOR deviations from the
+    # meter's rolling baseline over about BASELINE_DAYS days (kept with the rollups; 0 disables)
     try:
-        # Resolve device-id to internal database $id
-        context.log(f"Resolving internal ID for device-id: {device_id}")
-        meter_res = tables_db.list_rows(
-            database_id,
-            meters_collection_id,
+        config['outlier_factor'] = float(env['OUTLIER_FACTOR'] or 5)
+        config['baseline_days'] = int(env['BASELINE_DAYS'] or 14)
+    except ValueError:
+        raise ValueError("OUTLIER_FACTOR and BASELINE_DAYS must be numbers.")
+    if config['baseline_days'] < 1:
+        raise ValueError("BASELINE_DAYS must be at least 1.")
+    try:
+        if not is_utc(config['default_timezone']):
+            ZoneInfo(config['default_timezone'])
+    except Exception:
+        raise ValueError(f"METER_TIMEZONE {config['default_timezone']} is not a known timezone.")
+    try:
+        config['meter_id_cache_size'] = int(env['METER_ID_CACHE_SIZE'] or 10000)
+        config['meter_id_cache_ttl'] = float(env['METER_ID_CACHE_TTL_SECONDS'] or 3600)
+        config['http_pool_size'] = int(env['APPWRITE_HTTP_POOL_SIZE'] or 10)
+    except ValueError:
+        raise ValueError("METER_ID_CACHE_SIZE, METER_ID_CACHE_TTL_SECONDS and APPWRITE_HTTP_POOL_SIZE must be numbers.")
+    if config['http_pool_size'] < 1:
+        raise ValueError("APPWRITE_HTTP_POOL_SIZE must be at least 1.")
+    return config
+
+
+def connect(context, metrics):
+    global TablesDB
+    if TablesDB is None:
+        # The SDK's DeprecationWarnings are silenced with the import that raises them
+        warnings.filterwarnings("ignore", category=DeprecationWarning)
+        from appwrite.services.tables_db import TablesDB
+    client = CLIENT_POOL.get(
+        os.environ.get('APPWRITE_FUNCTION_ENDPOINT'),
+        os.environ.get('APPWRITE_FUNCTION_PROJECT_ID'),
+        context.req.headers.get('x-appwrite-key') or os.environ.get('APPWRITE_API_KEY')
+    )
+    return Instrumented(TablesDB(client), metrics, 'tables_db')
+
+
+def read_deadline():
+    # Raises ValueError on a malformed ACCUMULATE_TIME_BUDGET_SECONDS
+    time_budget = float(os.environ.get('ACCUMULATE_TIME_BUDGET_SECONDS', 0))
+    return datetime.now() + timedelta(seconds=time_budget) if time_budget > 0 else None
+
+
+def read_job_settings():
+    # Raises ValueError on missing or malformed values
+    if not os.environ.get('APPWRITE_JOBS_COLLECTION_ID'):
+        raise ValueError("APPWRITE_JOBS_COLLECTION_ID is required")
+    settings = {
+        'jobs_collection_id': os.environ.get('APPWRITE_JOBS_COLLECTION_ID'),
+        'claim_size': int(os.environ.get('JOB_CLAIM_SIZE', DEFAULT_JOB_CLAIM_SIZE)),
+        'max_attempts': int(os.environ.get('JOB_MAX_ATTEMPTS', DEFAULT_JOB_MAX_ATTEMPTS)),
+        'retry_base_delay': float(os.environ.get('JOB_RETRY_BASE_SECONDS', DEFAULT_JOB_RETRY_BASE_SECONDS)),
+        'retry_max_delay': float(os.environ.get('JOB_RETRY_MAX_SECONDS', DEFAULT_JOB_RETRY_MAX_SECONDS)),
+        'lease_seconds': float(os.environ.get('JOB_LEASE_SECONDS', DEFAULT_JOB_LEASE_SECONDS))
+    }
+    if not 1 <= settings['claim_size'] <= QUERY_VALUES_LIMIT or settings['max_attempts'] < 1:
+        raise ValueError(f"JOB_CLAIM_SIZE must be between 1 and {QUERY_VALUES_LIMIT} and JOB_MAX_ATTEMPTS positive")
+    return settings
+
+
+def work_jobs(context, tables_db, config, settings, deadline, metrics):
+    # Claims due jobs and accumulates them a day at a time, like a batch request,
+    # until none are due or the time budget is spent. Failures are written back to
+    # the job for a later retry instead of failing the execution. A round whose jobs
+    # all went to other workers claims again, since more may be due behind them.
+    worker_id = context.req.headers.get('x-appwrite-execution-id') or uuid.uuid4().hex[:20]
+    counts = {'claimed': 0, 'done': 0, 'retried': 0, 'failed': 0}
+    while not (deadline and datetime.now() >= deadline):
+        with metrics.phase('claim'):
+            jobs, expired, found = claim_jobs(tables_db, config['database_id'], settings['jobs_collection_id'], worker_id,
+                                              settings['claim_size'], settings['lease_seconds'], settings['max_attempts'])
+        counts['failed'] += expired
+        if not found:
+            break
+        if not jobs:
+            continue
+        counts['claimed'] += len(jobs)
+
+        by_date = {}
+        for job in jobs:
+            by_date.setdefault(job['date'], []).append(job)
+
+        errors = {}
+        for date_str, day_jobs in sorted(by_date.items()):
+            meter_ids = {job['device_id']: job['meter_id'] for job in day_jobs}
+            day = datetime.strptime(date_str, '%Y-%m-%d')
+            try:
+                with metrics.phase('resolve'):
+                    timezones = resolve_timezones(tables_db, config, list(meter_ids.values()), context)
+                results, _ = accumulate_batch(context, tables_db, config, list(meter_ids), meter_ids, day, day, metrics=metrics, timezones=timezones)
+            except Exception as e:
+                context.error(f"Error accumulating {len(day_jobs)} jobs for {date_str}: {str(e)}")
+                errors.update({job['$id']: str(e) for job in day_jobs})
+                continue
+            for job in day_jobs:
+                # No result for the day means there was no raw data, which leaves nothing to retry
+                result = results.get(job['device_id'], {}).get(date_str)
+                if result and result['status'] >= 500:
+                    errors[job['$id']] = result.get('error') or 'Accumulation failed'
+
+        with metrics.phase('finish'):
+            finished, gave_up = finish_jobs(tables_db, config['database_id'], settings['jobs_collection_id'], worker_id, jobs, errors,
+                                            settings['max_attempts'], settings['retry_base_delay'], settings['retry_max_delay'])
+        failed = sum(1 for job in finished if job['$id'] in errors)
+        counts['done'] += len(finished) - failed
+        counts['retried'] += failed - gave_up
+        counts['failed'] += gave_up
+    return counts
+
+
+def shard_of(value, shards):
+    # Stable across processes, unlike the builtin hash()
+    return zlib.crc32(value.encode('utf-8')) % shards
+
+
+def chunked(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def meter_fields(config):
+    fields = ['$id', 'device-id']
+    if config['timezone_attribute']:
+        fields.append(config['timezone_attribute'])
+    return fields
+
+
+@lru_cache(maxsize=1024)
+def known_timezone(tz_name):
+    try:
+        return is_utc(tz_name) or ZoneInfo(tz_name) is not None
+    except Exception:
+        return False
+
+
+def remember_timezone(internal_device_id, tz_name, context=None):
+    # An unknown zone would fail every meter of the batch once days are bucketed, so
+    # the meter falls back to the default timezone (cached as None) instead
+    if not tz_name:
+        return
+    if not known_timezone(tz_name):
+        if context:
+            context.error(f"Meter {internal_device_id} has an unknown timezone {tz_name!r}; using the default timezone.")
+        tz_name = None
+    METER_TIMEZONES[internal_device_id] = tz_name
+    if len(METER_TIMEZONES) > METER_ID_CACHE.max_size:
+        METER_TIMEZONES.pop(next(iter(METER_TIMEZONES)))
+
+
+def resolve_timezones(tables_db, config, internal_ids, context=None):
+    # meter $id -> timezone for meters that do not use the default. Timezones passed
+    # by the trigger or seen in earlier meters lookups are cached; with
+    # METER_TIMEZONE_ATTRIBUTE set, the rest are fetched by $id, 100 per query.
+    missing = [m for m in internal_ids if m not in METER_TIMEZONES] if config['timezone_attribute'] else []
+    for chunk in chunked(missing, QUERY_VALUES_LIMIT):
+        res = tables_db.list_rows(
+            config['database_id'],
+            config['meters_collection_id'],
             queries=[
-                Query.equal('device-id', device_id),
-                Query.limit(1)
+                Query.equal('$id', chunk),
+                Query.select(['$id', config['timezone_attribute']]),
+                Query.limit(len(chunk))
             ]
         )
+        for meter in res.get('rows', []):
+            remember_timezone(meter['$id'], meter.get(config['timezone_attribute']), context)
+    return {m: METER_TIMEZONES[m] for m in internal_ids if METER_TIMEZONES.get(m)}
 
-        if meter_res['total'] == 0:
-            context.error(f"Device with ID {device_id} not found in meters collection.")
-            return context.res.json({"error": f"Device {device_id} not found"}, 404)
 
-        internal_device_id = meter_res['rows'][0]['$id']
-        context.log(f"Resolved internal ID: {internal_device_id}")
+def list_shard_meters(tables_db, config, shard, shards, id_range=None, context=None):
+    # A shard given as an $id range reads only its own meters. Without one, every
+    # shard pages through all active meters and keeps those hashing into it.
+    meter_ids = {}
+    cursor = None
+    while True:
+        queries = [
+            Query.equal('active', True),
+            Query.select(meter_fields(config)),
+            Query.limit(METERS_PAGE_SIZE)
+        ]
+        if id_range is not None:
+            after, through = id_range
+            queries.append(Query.order_asc('$id'))
+            if after:
+                queries.append(Query.greater_than('$id', after))
+            if through:
+                queries.append(Query.less_than_equal('$id', through))
+        if cursor:
+            queries.append(Query.cursor_after(cursor))
 
-        # Fetch earliest measurement for the day
-        context.log(f"Fetching earliest measurement between {start_of_day} and {end_of_day} using 'timestamp' attribute")
-        earliest_res = tables_db.list_rows(
-            database_id,
-            raw_collection_id,
+        page = tables_db.list_rows(config['database_id'], config['meters_collection_id'], queries=queries)
+        rows = page.get('rows', [])
+        for meter in rows:
+            meter_device_id = meter.get('device-id')
+            if meter_device_id and (id_range is not None or shard_of(meter['$id'], shards) == shard):
+                meter_ids[meter_device_id] = meter['$id']
+                METER_ID_CACHE.put(meter_device_id, meter['$id'])
+                remember_timezone(meter['$id'], meter.get(config['timezone_attribute'] or ''), context)
+
+        if len(rows) < METERS_PAGE_SIZE:
+            return meter_ids
+        cursor = rows[-1]['$id']
+
+
+def shard_row_id(run_id, shard):
+    # Must match shard_row_id in trigger_accumulation_for_all_meters
+    return f"{run_id}_{shard}"
+
+
+def save_shard_row(context, tables_db, config, run_id, shard, shards, status, response, metrics, error=None):
+    # Completion row of one shard of a sharded run. A failure to write it is only
+    # logged: the shard's daily rows are written, and the run shows it as missing.
+    try:
+        tables_db.upsert_row(config['database_id'], os.environ.get('APPWRITE_RUNS_COLLECTION_ID'), shard_row_id(run_id, shard), {
+            'run_id': run_id,
+            'kind': 'shard',
+            'shard': shard,
+            'shards': shards,
+            'status': status,
+            'devices': len(response.get('results', {})),
+            'processed': response.get('processed', 0),
+            'failed': response.get('failed', 0),
+            'unchanged': response.get('unchanged', 0),
+            'error': error[:1000] if error else None,
+            'duration_ms': metrics.summary()['total_ms'],
+            'finished_at': datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+        })
+    except Exception as e:
+        context.error(f"Failed to record shard {shard} of run {run_id}: {str(e)}")
+
+
+def resolve_meter_ids(tables_db, config, device_ids, known_meter_ids=None, context=None):
+    # Prefer ids passed in the payload, then the process cache, and only query
+    # the meters collection for the rest, one query per chunk of devices
+    meter_ids = {}
+    unresolved = []
+    for device_id in device_ids:
+        internal_id = (known_meter_ids or {}).get(device_id) or METER_ID_CACHE.get(device_id)
+        if internal_id:
+            meter_ids[device_id] = internal_id
+        else:
+            unresolved.append(device_id)
+
+    for chunk in chunked(unresolved, QUERY_VALUES_LIMIT):
+        res = tables_db.list_rows(
+            config['database_id'],
+            config['meters_collection_id'],
             queries=[
-                Query.equal('meters', internal_device_id),
-                Query.greater_than_equal('timestamp', start_of_day),
-                Query.less_than_equal('timestamp', end_of_day),
+                Query.equal('device-id', chunk),
+                Query.select(meter_fields(config)),
+                Query.limit(len(chunk))
+            ]
+        )
+        for meter in res.get('rows', []):
+            meter_ids[meter['device-id']] = meter['$id']
+            METER_ID_CACHE.put(meter['device-id'], meter['$id'])
+            remember_timezone(meter['$id'], meter.get(config['timezone_attribute'] or ''), context)
+    return meter_ids
+
+
+def scan_raw_rows(tables_db, config, internal_ids, start, end):
+    # Single cursor-paginated pass over the raw rows of many meters, in timestamp
+    # order so that every day is complete once the scan has moved past it
+    for chunk in chunked(internal_ids, QUERY_VALUES_LIMIT):
+        cursor = None
+        while True:
+            queries = [
+                Query.equal('meters', chunk),
+                Query.greater_than_equal('timestamp', start),
+                Query.less_than_equal('timestamp', end),
                 Query.order_asc('timestamp'),
-                Query.limit(1)
+                Query.select(RAW_SCAN_FIELDS),
+                Query.limit(RAW_PAGE_SIZE)
             ]
+            if cursor:
+                queries.append(Query.cursor_after(cursor))
+
+            page = tables_db.list_rows(config['database_id'], config['raw_collection_id'], queries=queries)
+            rows = page.get('rows', [])
+            yield from rows
+
+            if len(rows) < RAW_PAGE_SIZE:
+                break
+            cursor = rows[-1]['$id']
+
+
+def iter_day_rows(rows):
+    # Buckets a timestamp-ordered row stream into days, yielding each day once it is complete
+    day, day_rows = None, []
+    for row in rows:
+        row_day = row['timestamp'][:10]
+        if row_day != day:
+            if day_rows:
+                yield day, day_rows
+            day, day_rows = row_day, []
+        day_rows.append(row)
+    if day_rows:
+        yield day, day_rows
+
+
+def iter_local_day_rows(rows, zone_of, zones):
+    # Buckets a timestamp-ordered row stream into local days. A day is yielded once
+    # the stream has passed its end in every zone of the batch, so it is complete.
+    pending = {}
+    for row in rows:
+        timestamp = parse_timestamp(row['timestamp'])
+        day = local_day_of(zone_of(row), timestamp)
+        pending.setdefault(day, []).append(row)
+        while pending:
+            first = min(pending)
+            if timestamp < max(local_day_start(tz_name, first + 1) for tz_name in zones):
+                break
+            yield str(EPOCH_DATE + timedelta(days=first)), pending.pop(first)
+    for day in sorted(pending):
+        yield str(EPOCH_DATE + timedelta(days=day)), pending[day]
+
+
+def utc_iso(milliseconds):
+    # Naive UTC ISO string, the form the raw scans compare `timestamp` against
+    return datetime.fromtimestamp(milliseconds / 1000, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def daily_row_id(internal_device_id, start_of_day):
+    # Deterministic per meter and day, so writes are idempotent upserts
+    day = start_of_day[:10].replace('-', '')
+    row_id = f"{internal_device_id}_{day}"
+    if len(row_id) <= MAX_ROW_ID_LENGTH:
+        return row_id
+    return 'd' + hashlib.sha1(row_id.encode('utf-8')).hexdigest()[:MAX_ROW_ID_LENGTH - 1]
+
+
+def checkpoint_row_id(job):
+    return 'ckpt_' + hashlib.sha1(job.encode('utf-8')).hexdigest()[:31]
+
+
+def load_checkpoint(tables_db, config, job):
+    # A checkpoint records the meter chunk in progress and the last day completed in it
+    checkpoint = {'$id': checkpoint_row_id(job), 'job': job, 'chunk': 0, 'day': None}
+    res = tables_db.list_rows(
+        config['database_id'],
+        os.environ.get('APPWRITE_CHECKPOINTS_COLLECTION_ID'),
+        queries=[
+            Query.equal('$id', checkpoint['$id']),
+            Query.limit(1)
+        ]
+    )
+    if res['total'] > 0:
+        row = res['rows'][0]
+        # A finished job starts over when it is requested again
+        if row.get('status') == 'running':
+            checkpoint['chunk'] = row.get('chunk') or 0
+            checkpoint['day'] = row.get('day')
+    return checkpoint
+
+
+def save_checkpoint(tables_db, config, checkpoint, status, metrics):
+    row_data = {
+        'job': checkpoint['job'][:255],
+        'chunk': checkpoint['chunk'],
+        'day': checkpoint['day'],
+        'status': status
+    }
+    with metrics.phase('checkpoint'):
+        tables_db.upsert_row(config['database_id'], os.environ.get('APPWRITE_CHECKPOINTS_COLLECTION_ID'), checkpoint['$id'], row_data)
+
+
+def stored_rows(tables_db, config, row_ids):
+    # content_hash and status of existing daily rows, by row ID
+    res = tables_db.list_rows(
+        config['database_id'],
+        config['daily_collection_id'],
+        queries=[
+            Query.equal('$id', row_ids),
+            Query.select(['$id', 'content_hash', 'status']),
+            Query.limit(len(row_ids))
+        ]
+    )
+    return {row['$id']: row for row in res.get('rows', [])}
+
+
+def stored_hashes(tables_db, config, row_ids):
+    # content_hash of existing daily rows, by row ID
+    return {row_id: row.get('content_hash') for row_id, row in stored_rows(tables_db, config, row_ids).items()}
+
+
+def write_daily_rows(context, tables_db, config, day, day_rows, device_by_meter, results, metrics, timezones=None, written=None, baselines=None):
+    # `baselines` ({meter $id: baseline}) enables outlier flags; written days are folded into it
+    with metrics.phase('accumulate'):
+        rows = [
+            dict(row_data, **{'$id': daily_row_id(row_data['meters'], row_data['day'])})
+            for row_data in accumulate_rows(day_rows, timezones, config['default_timezone'])
+            if row_data['meters'] in device_by_meter
+        ]
+
+    for chunk in chunked(rows, UPSERT_CHUNK_SIZE):
+        try:
+            # Re-runs and retries leave rows whose values did not change untouched
+            with metrics.phase('compare'):
+                stored = stored_rows(tables_db, config, [row['$id'] for row in chunk])
+            with metrics.phase('accumulate'):
+                if baselines is not None:
+                    flag_outliers(chunk, baselines, config['outlier_factor'])
+                    # A day the baseline already covers keeps the verdict it got when it was new
+                    for row in chunk:
+                        previous = stored.get(row['$id'], {}).get('status')
+                        if row['status'] == 'ok' and not after_baseline(row, baselines.get(row['meters'])) \
+                                and status_flags(previous) & FLAG_OUTLIER:
+                            row['status'] = status_label(FLAG_OUTLIER)
+                for row in chunk:
+                    row['content_hash'] = content_hash(row)
+            changed = [row for row in chunk if stored.get(row['$id'], {}).get('content_hash') != row['content_hash']]
+            if changed:
+                with metrics.phase('write'):
+                    tables_db.upsert_rows(config['database_id'], config['daily_collection_id'], changed)
+                if written is not None:
+                    written.extend(changed)
+                if baselines is not None:
+                    for row in changed:
+                        baseline = fold_baseline(baselines.get(row['meters']), row, config['baseline_days'])
+                        if baseline:
+                            baselines[row['meters']] = baseline
+            changed_ids = {row['$id'] for row in changed}
+            for row in chunk:
+                if row['$id'] not in changed_ids:
+                    results[device_by_meter[row['meters']]][day] = {"message": "Daily measurement unchanged", "documentId": row['$id'], "status": 200, "unchanged": True}
+                else:
+                    results[device_by_meter[row['meters']]][day] = {"message": "Daily measurement upserted successfully", "documentId": row['$id'], "status": 200}
+        except Exception as e:
+            context.error(f"Error while upserting {len(chunk)} daily rows for {day}: {str(e)}")
+            for row in chunk:
+                results[device_by_meter[row['meters']]][day] = {"error": str(e), "status": 500}
+
+
+def accumulate_batch(context, tables_db, config, device_ids, meter_ids, first_day, last_day, checkpoint=None, deadline=None, metrics=None, timezones=None):
+    # Returns ({device_id: {day: result}}, complete)
+    metrics = metrics or Metrics()
+    timezones = timezones or {}
+    default_timezone = config['default_timezone']
+    results = {}
+    for device_id in device_ids:
+        if device_id in meter_ids:
+            results[device_id] = {}
+        else:
+            context.error(f"Device with ID {device_id} not found in meters collection.")
+            results[device_id] = {first_day.strftime('%Y-%m-%d'): {"error": f"Device {device_id} not found", "status": 404}}
+
+    device_by_meter = {meter_ids[d]: d for d in device_ids if d in meter_ids}
+    zones = {timezones.get(m) or default_timezone for m in device_by_meter}
+    local = not all(is_utc(tz_name) for tz_name in zones)
+    if local:
+        # One scan covers the batch's local days in every zone; rows outside them are dropped
+        end_of_range = utc_iso(max(local_day_start(tz_name, day_number(last_day) + 1) for tz_name in zones) - 1)
+    else:
+        end_of_range = day_window(last_day)[1]
+    last_key = last_day.strftime('%Y-%m-%d')
+
+    # Daily rows written since the rollups were last brought up to date
+    written = []
+    chunks = list(chunked(list(device_by_meter), QUERY_VALUES_LIMIT))
+    for index, chunk in enumerate(chunks):
+        scan_from = first_day
+        if checkpoint:
+            if index < checkpoint['chunk']:
+                continue
+            if index == checkpoint['chunk'] and checkpoint['day']:
+                scan_from = datetime.strptime(checkpoint['day'], '%Y-%m-%d') + timedelta(days=1)
+
+        if local:
+            start_of_range = utc_iso(min(local_day_start(tz_name, day_number(scan_from)) for tz_name in zones))
+        else:
+            start_of_range = day_window(scan_from)[0]
+        baselines = chunk_baselines(context, tables_db, config, chunk, metrics)
+        raw_rows = metrics.timed_iter('scan', scan_raw_rows(tables_db, config, chunk, start_of_range, end_of_range))
+        if local:
+            zone_of = lambda row: timezones.get(meter_ref(row.get('meters'))) or default_timezone
+            days = iter_local_day_rows(raw_rows, zone_of, zones)
+        else:
+            days = iter_day_rows(raw_rows)
+
+        first_key = scan_from.strftime('%Y-%m-%d')
+        for day, day_rows in days:
+            if not first_key <= day <= last_key:
+                continue
+            write_daily_rows(context, tables_db, config, day, day_rows, device_by_meter, results, metrics, timezones, written, baselines)
+
+            if checkpoint:
+                checkpoint['day'] = day
+                save_checkpoint(tables_db, config, checkpoint, 'running', metrics)
+            if deadline and datetime.now() >= deadline:
+                roll_up(context, tables_db, config, written, metrics, baselines)
+                return results, False
+
+        roll_up(context, tables_db, config, written, metrics, baselines)
+        if checkpoint:
+            checkpoint['chunk'], checkpoint['day'] = index + 1, None
+            save_checkpoint(tables_db, config, checkpoint, 'running', metrics)
+        if deadline and datetime.now() >= deadline and index + 1 < len(chunks):
+            return results, False
+
+    if checkpoint:
+        save_checkpoint(tables_db, config, checkpoint, 'done', metrics)
+    return results, True
+
+
+def chunk_baselines(context, tables_db, config, meter_ids, metrics):
+    # Rolling baselines of a chunk's meters, read once and then updated in memory, or
+    # None when outliers are not flagged. Without them the chunk is accumulated unflagged.
+    if not config['rollups_collection_id'] or config['outlier_factor'] <= 0:
+        return None
+    try:
+        with metrics.phase('rollup'):
+            return load_baselines(tables_db, config, meter_ids)
+    except Exception as e:
+        context.error(f"Error loading baselines for {len(meter_ids)} meters: {str(e)}")
+        return None
+
+
+def roll_up(context, tables_db, config, written, metrics, baselines=None):
+    # Brings the rollups (and baselines) of freshly written daily rows up to date and
+    # empties `written`. A failure is logged rather than failing the accumulation:
+    # the daily rows are written, and recompute_rollups repairs the rollups.
+    if not config['rollups_collection_id'] or not written:
+        written.clear()
+        return
+    try:
+        with metrics.phase('rollup'):
+            update_rollups(tables_db, config, written, baselines)
+    except Exception as e:
+        context.error(f"Error updating rollups for {len(written)} daily rows: {str(e)}")
+    written.clear()
+
+
+def handle_recompute_rollups(context, config, payload):
+    if not config['rollups_collection_id']:
+        context.error("APPWRITE_ROLLUPS_COLLECTION_ID is required to recompute rollups.")
+        return {"error": "Configuration error"}, 500
+    device_ids = payload.get('device-ids') or ([payload['device-id']] if payload.get('device-id') else None)
+    if not isinstance(device_ids, list) or not all(isinstance(d, str) and d for d in device_ids):
+        return {"error": "recompute_rollups requires device-id or device-ids"}, 400
+
+    metrics = Metrics()
+    tables_db = connect(context, metrics)
+    try:
+        with metrics.phase('resolve'):
+            meter_ids = resolve_meter_ids(tables_db, config, device_ids, payload.get('meter-ids') or {}, context)
+        with metrics.phase('rollup'):
+            written = recompute_rollups(tables_db, config, list(meter_ids.values()))
+    except Exception as e:
+        context.error(f"Error recomputing rollups: {str(e)}")
+        return {"error": str(e)}, 500
+    context.log(f"Recomputed {written} rollups for {len(meter_ids)} meters")
+    return {
+        "message": f"Recomputed {written} rollups",
+        "rollups": written,
+        "not_found": [d for d in device_ids if d not in meter_ids],
+        "metrics": metrics.summary()
+    }, 200
+
+
+def handle_raw_event(context, tables_db, config, row, metrics):
+    # Folds a newly inserted raw row into its day's row: one read and at most one write
+    event = context.req.headers.get('x-appwrite-event') or ''
+    if f".{config['raw_collection_id']}." not in event or not event.endswith('.create'):
+        context.log(f"Ignoring event {event}")
+        return {"message": "Event ignored"}, 200
+
+    internal_device_id = meter_ref(row.get('meters'))
+    if not internal_device_id or not row.get('timestamp'):
+        context.error(f"Raw row {row.get('$id')} has no meter or timestamp.")
+        return {"error": "Raw row has no meter or timestamp"}, 400
+
+    try:
+        tz_name = resolve_timezones(tables_db, config, [internal_device_id], context).get(internal_device_id) or config['default_timezone']
+    except Exception as e:
+        context.error(f"Error while resolving the timezone of {internal_device_id}: {str(e)}")
+        return {"error": str(e)}, 500
+
+    # Days are local to the meter's timezone, as in the batch path
+    local_day = local_day_of(tz_name, parse_timestamp(row['timestamp']))
+    day = datetime.combine(EPOCH_DATE + timedelta(days=local_day), datetime.min.time())
+    start_of_day = day_label(local_day)
+    row_id = daily_row_id(internal_device_id, start_of_day)
+
+    try:
+        with metrics.phase('read'):
+            res = tables_db.list_rows(
+                config['database_id'],
+                config['daily_collection_id'],
+                queries=[
+                    Query.equal('$id', row_id),
+                    Query.select(DAILY_BOUNDS_FIELDS),
+                    Query.limit(1)
+                ]
+            )
+
+        if res['total'] == 0:
+            row_data = build_row_data(internal_device_id, start_of_day, row, row)
+        else:
+            existing = res['rows'][0]
+            if not (existing.get('first_timestamp') and existing.get('last_timestamp')):
+                # Written before the bounds were stored; recompute the day once
+                context.log(f"Daily row {row_id} has no stored bounds; recomputing the day")
+                return accumulate_device(context, tables_db, config, internal_device_id, day, internal_device_id, metrics)
+
+            stored = {field: existing.get(field) for field in DAILY_BOUNDS_FIELDS if field != '$id'}
+            # `day` comes back in Appwrite's datetime format; keep ours so the hash stays comparable
+            row_data = apply_reading(dict(stored, day=start_of_day[:19], meters=internal_device_id), row)
+            if row_data is None:
+                context.log(f"Reading {row.get('$id')} lies inside the stored bounds of {row_id}")
+                return {"message": "Daily measurement unchanged", "documentId": row_id}, 200
+
+        row_data['content_hash'] = content_hash(row_data)
+        with metrics.phase('write'):
+            tables_db.upsert_row(config['database_id'], config['daily_collection_id'], row_id, row_data)
+    except Exception as e:
+        context.error(f"Error while applying raw row {row.get('$id')}: {str(e)}")
+        return {"error": str(e)}, 500
+
+    context.log(f"Applied raw row {row.get('$id')} to {row_id}: current {row_data['current']}")
+    roll_up(context, tables_db, config, [row_data], metrics)
+    return {"message": "Daily measurement updated from event", "documentId": row_id}, 200
+
+
+def skip_unchanged_enabled():
+    # Batches always compare hashes (one read per 100 rows); for a single device the
+    # lookup costs as many requests as the write it saves, so it is opt-in
+    return os.environ.get('ACCUMULATE_SKIP_UNCHANGED', '').lower() in ('1', 'true', 'yes')
+
+
+def day_query_mode(internal_device_id):
+    # One projected scan of the day is a single request as long as the day fits in
+    # one page; above that, two point queries (earliest, latest) are cheaper
+    mode = os.environ.get('ACCUMULATE_DAY_QUERY', 'auto').lower()
+    if mode in ('point', 'scan'):
+        return mode
+    estimate = READINGS_PER_DAY.get(internal_device_id)
+    if estimate is None:
+        estimate = float(os.environ.get('ACCUMULATE_READINGS_PER_DAY', 0)) or None
+    return 'scan' if estimate is not None and estimate <= DAY_SCAN_PAGE_SIZE else 'point'
+
+
+def learn_readings_per_day(internal_device_id, readings):
+    previous = READINGS_PER_DAY.get(internal_device_id)
+    READINGS_PER_DAY[internal_device_id] = readings if previous is None else (previous + readings) / 2
+    if len(READINGS_PER_DAY) > METER_ID_CACHE.max_size:
+        READINGS_PER_DAY.pop(next(iter(READINGS_PER_DAY)))
+
+
+def fetch_day_bounds(context, tables_db, config, internal_device_id, start_of_day, end_of_day, metrics):
+    # Returns the earliest and latest raw rows of the day, or (None, None)
+    window = [
+        Query.equal('meters', internal_device_id),
+        Query.greater_than_equal('timestamp', start_of_day),
+        Query.less_than_equal('timestamp', end_of_day),
+        Query.select(DAY_FIELDS)
+    ]
+
+    if day_query_mode(internal_device_id) == 'scan':
+        context.log(f"Scanning measurements between {start_of_day} and {end_of_day} using 'timestamp' attribute")
+        earliest_doc = latest_doc = None
+        readings = 0
+        cursor = None
+        with metrics.phase('scan'):
+            while True:
+                queries = window + [Query.order_asc('timestamp'), Query.limit(DAY_SCAN_PAGE_SIZE)]
+                if cursor:
+                    queries.append(Query.cursor_after(cursor))
+                rows = tables_db.list_rows(config['database_id'], config['raw_collection_id'], queries=queries).get('rows', [])
+                if rows:
+                    earliest_doc = earliest_doc or rows[0]
+                    latest_doc = rows[-1]
+                    readings += len(rows)
+                if len(rows) < DAY_SCAN_PAGE_SIZE:
+                    break
+                cursor = rows[-1]['$id']
+        learn_readings_per_day(internal_device_id, readings)
+        return earliest_doc, latest_doc
+
+    # Fetch earliest measurement for the day
+    context.log(f"Fetching earliest measurement between {start_of_day} and {end_of_day} using 'timestamp' attribute")
+    with metrics.phase('earliest'):
+        earliest_res = tables_db.list_rows(
+            config['database_id'],
+            config['raw_collection_id'],
+            queries=window + [Query.order_asc('timestamp'), Query.limit(1)]
         )
 
-        if earliest_res['total'] == 0:
+    # total counts every match, which tells us how large a scan would have been
+    learn_readings_per_day(internal_device_id, earliest_res['total'])
+    if earliest_res['total'] == 0:
+        return None, None
+
+    # Fetch latest measurement for the day
+    context.log("Fetching latest measurement")
+    with metrics.phase('latest'):
+        latest_res = tables_db.list_rows(
+            config['database_id'],
+            config['raw_collection_id'],
+            queries=window + [Query.order_desc('timestamp'), Query.limit(1)]
+        )
+    return earliest_res['rows'][0], latest_res['rows'][0]
+
+
+def accumulate_device(context, tables_db, config, device_id, target_date, internal_device_id=None, metrics=None):
+    database_id = config['database_id']
+    daily_collection_id = config['daily_collection_id']
+    meters_collection_id = config['meters_collection_id']
+    metrics = metrics or Metrics()
+
+    context.log(f"Processing accumulation for device {device_id} on {target_date.strftime('%Y-%m-%d')}")
+
+    try:
+        with metrics.phase('resolve'):
+            if not internal_device_id:
+                internal_device_id = METER_ID_CACHE.get(device_id)
+
+            if internal_device_id:
+                context.log(f"Using known internal ID: {internal_device_id}")
+            else:
+                # Resolve device-id to internal database $id
+                context.log(f"Resolving internal ID for device-id: {device_id}")
+                meter_res = tables_db.list_rows(
+                    database_id,
+                    meters_collection_id,
+                    queries=[
+                        Query.equal('device-id', device_id),
+                        Query.select(meter_fields(config)),
+                        Query.limit(1)
+                    ]
+                )
+
+                if meter_res['total'] == 0:
+                    context.error(f"Device with ID {device_id} not found in meters collection.")
+                    return {"error": f"Device {device_id} not found"}, 404
+
+                internal_device_id = meter_res['rows'][0]['$id']
+                METER_ID_CACHE.put(device_id, internal_device_id)
+                remember_timezone(internal_device_id, meter_res['rows'][0].get(config['timezone_attribute'] or ''), context)
+                context.log(f"Resolved internal ID: {internal_device_id}")
+
+            tz_name = resolve_timezones(tables_db, config, [internal_device_id], context).get(internal_device_id) or config['default_timezone']
+
+        # The meter's local day, queried with naive UTC bounds like the batch scans
+        start_of_day = day_label(day_number(target_date))
+        window_start, window_end = day_window(target_date, tz_name)
+
+        earliest_doc, latest_doc = fetch_day_bounds(context, tables_db, config, internal_device_id, window_start, window_end, metrics)
+        if earliest_doc is None:
             context.log("No data found for the given device and date")
-            return context.res.json({"message": "No data found for the given device and date"}, 404)
+            return {"message": "No data found for the given device and date"}, 404
 
-        earliest_doc = earliest_res['rows'][0]
-        
         # Get last_month and date_last_month from the raw measurement
         last_month_val = earliest_doc.get('consumption_at_set_date_17_hca', 0)
         date_last_month_val = earliest_doc.get('set_date_17')
         context.log(f"Extracted from raw: last_month: {last_month_val}, date_last_month: {date_last_month_val}")
-        
-        # Fetch latest measurement for the day
-        context.log("Fetching latest measurement")
-        latest_res = tables_db.list_rows(
-            database_id,
-            raw_collection_id,
-            queries=[
-                Query.equal('meters', internal_device_id),
-                Query.greater_than_equal('timestamp', start_of_day),
-                Query.less_than_equal('timestamp', end_of_day),
-                Query.order_desc('timestamp'),
-                Query.limit(1)
-            ]
-        )
 
-        earliest_doc = earliest_res['rows'][0]
-        latest_doc = latest_res['rows'][0]
+        # Full row dumps are only worth their serialization cost when debugging
+        if debug_enabled():
+            context.log(f"Earliest measurement: {json.dumps(earliest_doc)}")
+            context.log(f"Latest measurement: {json.dumps(latest_doc)}")
 
-        context.log(f"Earliest measurement: {json.dumps(earliest_doc)}")
-        context.log(f"Latest measurement: {json.dumps(latest_doc)}")
+        row_data = build_row_data(internal_device_id, start_of_day, earliest_doc, latest_doc)
+        context.log(f"Calculated daily consumption: {row_data['current']}")
 
-        start_val = earliest_doc.get('current_consumption_hca', 0)
-        end_val = latest_doc.get('current_consumption_hca', 0)
-        
-        daily_current = end_val - start_val
-        context.log(f"Calculated daily consumption: {daily_current}")
+        row_id = daily_row_id(internal_device_id, start_of_day)
+        row_data['content_hash'] = content_hash(row_data)
 
-        # Check if an entry for this day and meter already exists
-        context.log(f"Checking if entry exists for meter {internal_device_id} and day {start_of_day}")
-        existing_res = tables_db.list_rows(
-            database_id,
-            daily_collection_id,
-            queries=[
-                Query.equal('meters', internal_device_id),
-                Query.equal('day', start_of_day),
-                Query.limit(1)
-            ]
-        )
+        # Optional: trade the blind upsert for a hash lookup that skips no-op writes
+        if skip_unchanged_enabled():
+            with metrics.phase('compare'):
+                stored = stored_hashes(tables_db, config, [row_id])
+            if stored.get(row_id) == row_data['content_hash']:
+                context.log(f"Daily measurement {row_id} is unchanged; skipping the write")
+                return {"message": "Daily measurement unchanged", "documentId": row_id, "unchanged": True}, 200
 
-        row_data = {
-            'day': start_of_day,
-            'start': start_val,
-            'end': end_val,
-            'meters': internal_device_id,
-            'current': daily_current,
-            'last_month': last_month_val,
-            'date_last_month': date_last_month_val
-        }
-
-        if existing_res['total'] > 0:
-            existing_row_id = existing_res['rows'][0]['$id']
-            context.log(f"Updating existing daily measurement row: {existing_row_id}")
-            result_row = tables_db.update_row(
-                database_id,
-                daily_collection_id,
-                existing_row_id,
-                row_data
-            )
-            message = "Daily measurement updated successfully"
-        else:
-            context.log("No existing entry found. Creating new row.")
-            result_row = tables_db.create_row(
+        # Create or update the day's row in a single request
+        context.log(f"Upserting daily measurement row: {row_id}")
+        with metrics.phase('write'):
+            result_row = tables_db.upsert_row(
                 database_id,
                 daily_collection_id,
-                'unique()',
+                row_id,
                 row_data
             )
+
+        if result_row.get('$createdAt') == result_row.get('$updatedAt'):
             message = "Daily measurement accumulated successfully"
+        else:
+            message = "Daily measurement updated successfully"
 
         context.log(f"Operation successful: {result_row['$id']}")
-        return context.res.json({
+        roll_up(context, tables_db, config, [row_data], metrics)
+        return {
             "message": message,
             "documentId": result_row['$id']
-        }, 201 if message == "Daily measurement accumulated successfully" else 200)
+        }, 201 if message == "Daily measurement accumulated successfully" else 200
 
     except Exception as e:
         context.error(f"Error during accumulation: {str(e)}")
-        return context.res.json({"error": str(e)}, 500)
+        return {"error": str(e)}, 500
@@ -0,0 +1,35 @@
+import time
+from collections import OrderedDict
+
+
+class MeterIdCache:
+    # LRU cache of device-id -> internal meter $id with a time-to-live.
+    # Kept at module level so it survives warm container reuse.
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device_id):
+        entry = self.entries.get(device_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[device_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(device_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, device_id, meter_id):
+        if self.max_size <= 0:
+            return
+        self.entries[device_id] = (meter_id, time.monotonic() + self.ttl)
+        self.entries.move_to_end(device_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
@@ -0,0 +1,167 @@
+import hashlib
+from datetime import date
+from appwrite.query import Query
+from accumulation import fold_rollup, new_rollup, rollup_keys
+
+# Monthly and billing-period totals per meter, kept in the rollups table next to
+# the daily rows they are built from. Rows just written are folded into the stored
+# rollups incrementally; a rollup a fold cannot update is rebuilt from its daily rows.
+# Each meter also has one "baseline" row: the rolling daily consumption that batch
+# accumulation flags outliers against.
+
+# Attributes of a rollup row
+ROLLUP_FIELDS = ['meters', 'kind', 'period', 'first_day', 'last_day', 'days', 'start', 'end', 'current', 'last_day_current']
+
+# Attributes of a meter's baseline row
+BASELINE_FIELDS = ['meters', 'kind', 'period', 'last_day', 'days', 'mean', 'deviation']
+
+# Attributes of a daily row that rollups are built from
+DAILY_ROLLUP_FIELDS = ['$id', 'meters.$id', 'day', 'start', 'end', 'current', 'date_last_month']
+
+# Appwrite row IDs are limited to 36 characters
+MAX_ROW_ID_LENGTH = 36
+
+# Page size used when scanning daily rows
+DAILY_PAGE_SIZE = 1000
+
+# Maximum number of values Appwrite accepts in a single Query.equal
+QUERY_VALUES_LIMIT = 100
+
+
+def rollup_row_id(meter_id, kind, period):
+    row_id = f"{meter_id}_{kind[0]}{period.replace('-', '')}"
+    if len(row_id) <= MAX_ROW_ID_LENGTH:
+        return row_id
+    return 'r' + hashlib.sha1(row_id.encode('utf-8')).hexdigest()[:MAX_ROW_ID_LENGTH - 1]
+
+
+def baseline_row_id(meter_id):
+    return rollup_row_id(meter_id, 'baseline', 'rolling')
+
+
+def chunked(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def daily_fields(row):
+    # Daily rows read back carry the meter as a relationship and `day` as a full datetime
+    meter = row.get('meters')
+    return dict(row, meters=meter.get('$id') if isinstance(meter, dict) else meter)
+
+
+def fold_rows(rollups, rows, changed=None):
+    # Folds daily rows, in day order per meter, into `rollups` ({row id: rollup}),
+    # also recording updated rollups in `changed`. Returns
+    # {row id: (meter, kind, period, date_last_month)} for those needing a rebuild.
+    rebuild = {}
+    for row in rows:
+        for kind, period in rollup_keys(row):
+            row_id = rollup_row_id(row['meters'], kind, period)
+            if row_id in rebuild:
+                continue
+            stored = rollups.get(row_id)
+            updated = new_rollup(row, kind, period) if stored is None else fold_rollup(stored, row)
+            if updated is None:
+                rebuild[row_id] = (row['meters'], kind, period, row.get('date_last_month'))
+            else:
+                rollups[row_id] = updated
+                if changed is not None:
+                    changed[row_id] = updated
+    return rebuild
+
+
+def load_rollups(tables_db, database_id, rollups_collection_id, row_ids, fields=ROLLUP_FIELDS):
+    rollups = {}
+    for chunk in chunked(list(row_ids), QUERY_VALUES_LIMIT):
+        page = tables_db.list_rows(database_id, rollups_collection_id, queries=[
+            Query.equal('$id', chunk),
+            Query.select(['$id'] + fields),
+            Query.limit(len(chunk))
+        ])
+        for row in page.get('rows', []):
+            rollups[row['$id']] = {field: row.get(field) for field in fields}
+    return rollups
+
+
+def load_baselines(tables_db, config, meter_ids):
+    # {meter $id: baseline} for the meters that have one: one read per 100 meters
+    row_ids = {baseline_row_id(meter_id): meter_id for meter_id in meter_ids}
+    stored = load_rollups(tables_db, config['database_id'], config['rollups_collection_id'], row_ids, BASELINE_FIELDS)
+    return {row_ids[row_id]: dict(baseline, meters=row_ids[row_id]) for row_id, baseline in stored.items()}
+
+
+def save_rollups(tables_db, database_id, rollups_collection_id, rollups):
+    rows = [dict(rollup, **{'$id': row_id}) for row_id, rollup in rollups.items()]
+    for chunk in chunked(rows, QUERY_VALUES_LIMIT):
+        tables_db.upsert_rows(database_id, rollups_collection_id, chunk)
+
+
+def scan_daily_rows(tables_db, config, filters):
+    # Daily rows matching `filters`, in day order, in cursor-paginated pages
+    cursor = None
+    while True:
+        queries = filters + [
+            Query.order_asc('day'),
+            Query.select(DAILY_ROLLUP_FIELDS),
+            Query.limit(DAILY_PAGE_SIZE)
+        ]
+        if cursor:
+            queries.append(Query.cursor_after(cursor))
+
+        page = tables_db.list_rows(config['database_id'], config['daily_collection_id'], queries=queries)
+        rows = page.get('rows', [])
+        for row in rows:
+            yield daily_fields(row)
+
+        if len(rows) < DAILY_PAGE_SIZE:
+            return
+        cursor = rows[-1]['$id']
+
+
+def period_filters(meter_id, kind, period, date_last_month):
+    if kind == 'period':
+        return [Query.equal('meters', meter_id), Query.equal('date_last_month', date_last_month)]
+    year, month = (int(part) for part in period.split('-'))
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return [
+        Query.equal('meters', meter_id),
+        Query.greater_than_equal('day', f"{period}-01T00:00:00"),
+        Query.less_than('day', f"{next_month.isoformat()}T00:00:00")
+    ]
+
+
+def update_rollups(tables_db, config, rows, baselines=None):
+    # Folds daily rows that were just written into their month and billing-period
+    # rollups: one read and one bulk write per 100 rollups, plus a scan of the
+    # period's daily rows for each rollup that has to be rebuilt. The baselines of
+    # the rows' meters, already folded by the caller, are written in the same requests.
+    # Returns the number written.
+    rows = sorted(rows, key=lambda row: (row['meters'], row['day']))
+    row_ids = {rollup_row_id(row['meters'], kind, period) for row in rows for kind, period in rollup_keys(row)}
+    rollups = load_rollups(tables_db, config['database_id'], config['rollups_collection_id'], row_ids)
+    changed = {}
+    rebuild = fold_rows(rollups, rows, changed)
+
+    for row_id, (meter_id, kind, period, date_last_month) in rebuild.items():
+        rebuilt = {}
+        fold_rows(rebuilt, scan_daily_rows(tables_db, config, period_filters(meter_id, kind, period, date_last_month)))
+        if row_id in rebuilt:
+            changed[row_id] = rebuilt[row_id]
+
+    for meter_id in {row['meters'] for row in rows} & set(baselines or {}):
+        changed[baseline_row_id(meter_id)] = baselines[meter_id]
+    save_rollups(tables_db, config['database_id'], config['rollups_collection_id'], changed)
+    return len(changed)
+
+
+def recompute_rollups(tables_db, config, meter_ids):
+    # Rebuilds every rollup of the given meters from one ordered scan of their daily
+    # rows per 100 meters; memory is bounded by the number of rollups, not days.
+    written = 0
+    for chunk in chunked(list(meter_ids), QUERY_VALUES_LIMIT):
+        rollups = {}
+        fold_rows(rollups, scan_daily_rows(tables_db, config, [Query.equal('meters', chunk)]))
+        save_rollups(tables_db, config['database_id'], config['rollups_collection_id'], rollups)
+        written += len(rollups)
+    return written
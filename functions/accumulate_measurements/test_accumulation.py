@@ -0,0 +1,292 @@
+import sys
+import os
+import csv
+import json
+import tempfile
+from datetime import datetime
+import numpy as np
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+# The accumulation core has no Appwrite dependency, so nothing is mocked here
+import replay
+from accumulation import accumulate_columns, accumulate_rows, apply_reading, build_row_data, day_number, flag_outliers, fold_baseline, fold_rollup, new_rollup, rollup_keys, local_day_numbers, local_day_of, day_window, groups_to_row_data, merge_results, parse_timestamp, rows_to_columns
+
+
+def test_day_window():
+    start_of_day, end_of_day = day_window(datetime(2026, 1, 5))
+    assert start_of_day == '2026-01-05T00:00:00'
+    assert end_of_day == '2026-01-05T23:59:59.999999'
+    print("SUCCESS: day_window matches the stored day format.")
+
+
+def test_parse_timestamp():
+    assert parse_timestamp('2026-01-05T00:00:00.000+00:00') == parse_timestamp('2026-01-05T00:00:00Z')
+    assert parse_timestamp('2026-01-05T01:00:00+01:00') == parse_timestamp('2026-01-05T00:00:00')
+    print("SUCCESS: Timestamps with and without offsets are parsed to UTC epoch milliseconds.")
+
+
+def test_accumulate_columns():
+    day = 86_400_000
+    base = parse_timestamp('2026-01-05T00:00:00Z')
+    # Deliberately unordered: two meters, two days
+    result = accumulate_columns(
+        meters=['b', 'a', 'a', 'b', 'a', 'a'],
+        timestamps=[base + 5, base + 20, base + 10, base + 1, base + day + 1, base + day + 2],
+        current=[60, 30, 10, 50, 40, 45],
+        last_month=[0, 0, 7, 3, 0, 0],
+        set_date=[None, None, '2025-12-15', '2025-12-16', None, None]
+    )
+
+    assert list(result['meters']) == ['a', 'a', 'b']
+    assert [str(d) for d in result['day']] == ['2026-01-05', '2026-01-06', '2026-01-05']
+    assert result['start'].tolist() == [10, 40, 50]
+    assert result['end'].tolist() == [30, 45, 60]
+    assert result['current'].tolist() == [20, 5, 10]
+    assert list(result['last_month']) == [7, 0, 3]
+    assert list(result['date_last_month']) == ['2025-12-15', None, '2025-12-16']
+    assert result['readings'].tolist() == [2, 2, 2]
+    print("SUCCESS: accumulate_columns reduces per meter and day.")
+
+
+def test_accumulate_rows():
+    rows = [
+        {'meters': {'$id': 'm1'}, 'timestamp': '2026-01-05T20:00:00.000+00:00', 'current_consumption_hca': 150},
+        {'meters': {'$id': 'm1'}, 'timestamp': '2026-01-05T08:00:00.000+00:00', 'current_consumption_hca': 100,
+         'consumption_at_set_date_17_hca': 600, 'set_date_17': '2025-12-15T00:00:00Z'}
+    ]
+    assert accumulate_rows(rows) == [{
+        'day': '2026-01-05T00:00:00',
+        'start': 100,
+        'end': 150,
+        'meters': 'm1',
+        'current': 50,
+        'last_month': 600,
+        'date_last_month': '2025-12-15T00:00:00Z',
+        'first_timestamp': '2026-01-05T08:00:00.000+00:00',
+        'last_timestamp': '2026-01-05T20:00:00.000+00:00',
+        'status': 'ok'
+    }]
+    assert accumulate_rows([]) == []
+    print("SUCCESS: accumulate_rows produces the same row_data as the per-device path.")
+
+
+def test_chunked_merge():
+    rows = [
+        {'meters': f'm{i % 3}', 'timestamp': f'2026-01-0{1 + i % 2}T{i % 24:02d}:00:00Z', 'current_consumption_hca': i * 3,
+         'consumption_at_set_date_17_hca': i, 'set_date_17': f'2025-12-{10 + i % 5}'}
+        for i in range(40)
+    ]
+
+    def accumulate(chunk):
+        columns = rows_to_columns(chunk)
+        return accumulate_columns(columns['meters'], columns['timestamp'], columns['current_consumption_hca'],
+                                  columns['consumption_at_set_date_17_hca'], columns['set_date_17'])
+
+    groups = {}
+    for i in range(0, len(rows), 7):
+        merge_results(groups, accumulate(rows[i:i + 7]))
+
+    expected = sorted(accumulate_rows(rows), key=lambda r: (r['meters'], r['day']))
+    assert groups_to_row_data(groups) == expected
+    print("SUCCESS: Chunk-wise accumulation matches a single pass.")
+
+
+def test_apply_reading():
+    rows = [
+        {'meters': 'm1', 'timestamp': f'2026-01-05T{hour:02d}:00:00Z', 'current_consumption_hca': 100 + hour,
+         'consumption_at_set_date_17_hca': hour, 'set_date_17': f'2025-12-{hour:02d}'}
+        for hour in (12, 6, 9, 20)
+    ]
+    row_data = accumulate_rows(rows[:1])[0]
+    for row in rows[1:]:
+        row_data = apply_reading(row_data, row) or row_data
+
+    assert row_data == accumulate_rows(rows)[0]
+    assert apply_reading(row_data, rows[2]) is None
+    print("SUCCESS: Folding readings one at a time matches a full recompute.")
+
+
+def test_local_days():
+    # Naive UTC bounds, the same form the batch scans use
+    assert day_window(datetime(2026, 1, 5), 'Europe/Berlin') == ('2026-01-04T23:00:00', '2026-01-05T22:59:59.999999')
+    # 2026-03-29 has 23 hours in Berlin
+    assert day_window(datetime(2026, 3, 29), 'Europe/Berlin') == ('2026-03-28T23:00:00', '2026-03-29T21:59:59.999999')
+
+    timestamps = [parse_timestamp(t) for t in (
+        '2026-01-04T23:30:00Z', '2026-01-05T22:59:59Z', '2026-01-05T23:00:00Z',
+        '2026-03-28T22:59:00Z', '2026-03-28T23:00:00Z', '2026-03-29T21:59:00Z', '2026-03-29T22:00:00Z'
+    )]
+    expected = [day_number(datetime(2026, m, d)) for m, d in ((1, 5), (1, 5), (1, 6), (3, 28), (3, 29), (3, 29), (3, 30))]
+    days = local_day_numbers(np.array(timestamps, dtype=np.int64), ['Europe/Berlin'] * len(timestamps))
+    assert days.tolist() == expected
+    assert [local_day_of('Europe/Berlin', t) for t in timestamps] == expected
+
+    rows = [
+        {'meters': 'berlin', 'timestamp': '2026-01-04T23:30:00Z', 'current_consumption_hca': 10},
+        {'meters': 'berlin', 'timestamp': '2026-01-05T22:30:00Z', 'current_consumption_hca': 15},
+        {'meters': 'utc', 'timestamp': '2026-01-04T23:30:00Z', 'current_consumption_hca': 10},
+        {'meters': 'utc', 'timestamp': '2026-01-05T22:30:00Z', 'current_consumption_hca': 15}
+    ]
+    result = [(r['meters'], r['day'], r['current']) for r in accumulate_rows(rows, {'berlin': 'Europe/Berlin'})]
+    assert result == [('berlin', '2026-01-05T00:00:00', 5), ('utc', '2026-01-04T00:00:00', 0), ('utc', '2026-01-05T00:00:00', 0)], result
+    print("SUCCESS: Readings are bucketed into each meter's local day, across DST changes.")
+
+
+def test_rollups():
+    def day(d, start, end):
+        return {'meters': 'm1', 'day': f'2026-01-{d:02d}T00:00:00', 'start': start, 'end': end, 'current': end - start, 'date_last_month': '2025-12-15'}
+
+    assert rollup_keys(day(5, 0, 1)) == [('month', '2026-01'), ('period', '2025-12-15')]
+    rollup = new_rollup(day(5, 10, 12), 'month', '2026-01')
+    rollup = fold_rollup(rollup, day(6, 12, 15))
+    rollup = fold_rollup(rollup, day(7, 15, 16))
+    assert (rollup['days'], rollup['current'], rollup['start'], rollup['end']) == (3, 6, 10, 16), rollup
+
+    # Re-accumulating the latest day replaces its contribution instead of adding it again
+    rollup = fold_rollup(rollup, day(7, 15, 19))
+    assert (rollup['days'], rollup['current'], rollup['end'], rollup['last_day']) == (3, 9, 19, '2026-01-07'), rollup
+
+    rollup = fold_rollup(rollup, day(4, 8, 10))
+    assert (rollup['days'], rollup['current'], rollup['start'], rollup['first_day']) == (4, 11, 8, '2026-01-04'), rollup
+
+    # A day inside the covered range can only be folded by a rebuild
+    assert fold_rollup(rollup, day(5, 10, 13)) is None
+    print("SUCCESS: Rollups fold daily rows incrementally.")
+
+
+def test_status_flags():
+    def reading(meter, hour, value, set_date='2025-12-15', at_set_date=50):
+        return {'$id': f'{meter}_{hour}', 'meters': meter, 'timestamp': f'2026-01-05T{hour:02d}:00:00Z',
+                'current_consumption_hca': value, 'consumption_at_set_date_17_hca': at_set_date, 'set_date_17': set_date}
+
+    days = {
+        'steady': [reading('steady', 6, 10), reading('steady', 18, 20)],
+        'single': [reading('single', 12, 10)],
+        'reset': [reading('reset', 6, 400), reading('reset', 18, 5, '2026-01-05', 410)],
+        'negative': [reading('negative', 6, 40), reading('negative', 18, 30)]
+    }
+    rows = accumulate_rows([r for readings in days.values() for r in readings])
+    expected = {'steady': 'ok', 'single': 'single_reading', 'reset': 'reset', 'negative': 'negative'}
+    assert {row['meters']: row['status'] for row in rows} == expected
+
+    # The per-device path flags the same day from its earliest and latest reading
+    for meter, readings in days.items():
+        row_data = build_row_data(meter, '2026-01-05T00:00:00', readings[0], readings[-1])
+        assert row_data['status'] == expected[meter], (meter, row_data)
+
+    # Ten days of 10 units make a baseline; 60 units is an outlier, 12 is not
+    baseline = None
+    for day in range(1, 11):
+        baseline = fold_baseline(baseline, {'meters': 'steady', 'day': f'2026-01-{day:02d}', 'current': 10, 'status': 'ok'}, 14)
+    assert (baseline['days'], baseline['mean'], baseline['deviation']) == (10, 10, 0)
+    assert fold_baseline(baseline, {'meters': 'steady', 'day': '2026-01-10', 'current': 10, 'status': 'ok'}, 14) is None
+    assert fold_baseline(baseline, {'meters': 'steady', 'day': '2026-01-11', 'current': 0, 'status': 'single_reading'}, 14) is None
+
+    candidates = [
+        {'meters': 'steady', 'day': '2026-01-11T00:00:00', 'current': 60, 'status': 'ok'},
+        {'meters': 'steady', 'day': '2026-01-11T00:00:00', 'current': 12, 'status': 'ok'},
+        {'meters': 'steady', 'day': '2026-01-11T00:00:00', 'current': -60, 'status': 'negative'},
+        {'meters': 'unknown', 'day': '2026-01-11T00:00:00', 'current': 60, 'status': 'ok'},
+        # Already folded into the baseline, so not judged against it
+        {'meters': 'steady', 'day': '2026-01-09T00:00:00', 'current': 60, 'status': 'ok'}
+    ]
+    assert flag_outliers(candidates, {'steady': baseline}, 5) == 1
+    assert [row['status'] for row in candidates] == ['outlier', 'ok', 'negative', 'ok', 'ok']
+    print("SUCCESS: Negative, reset, single-reading and outlier days are flagged.")
+
+
+def test_replay_timezones():
+    rows = [
+        # 00:30 and 23:30 local on 2026-01-05 in Berlin, then 00:30 on the 6th
+        {'meters': 'meter_berlin', 'timestamp': '2026-01-04T23:30:00Z', 'current_consumption_hca': 100},
+        {'meters': 'meter_berlin', 'timestamp': '2026-01-05T22:30:00Z', 'current_consumption_hca': 140},
+        {'meters': 'meter_berlin', 'timestamp': '2026-01-05T23:30:00Z', 'current_consumption_hca': 150},
+        # 20:00 local on 2026-01-05 in New York
+        {'meters': 'meter_ny', 'timestamp': '2026-01-05T13:00:00Z', 'current_consumption_hca': 10},
+        {'meters': 'meter_ny', 'timestamp': '2026-01-06T01:00:00Z', 'current_consumption_hca': 17}
+    ]
+    timezones = {'meter_ny': 'America/New_York'}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'raw.jsonl')
+        with open(path, 'w') as f:
+            f.writelines(json.dumps(row) + '\n' for row in rows)
+
+        replayed = replay.replay(path, 'jsonl', 2, timezones=timezones, default_timezone='Europe/Berlin')
+        assert replayed == accumulate_rows(rows, timezones, 'Europe/Berlin'), replayed
+        # --from/--to select local days
+        replayed = replay.replay(path, 'jsonl', 2, '2026-01-05', '2026-01-05', timezones=timezones, default_timezone='Europe/Berlin')
+        assert [(r['meters'], r['day'], r['current']) for r in replayed] == [
+            ('meter_berlin', '2026-01-05T00:00:00', 40), ('meter_ny', '2026-01-05T00:00:00', 7)
+        ], replayed
+    print("SUCCESS: Replay buckets readings into each meter's local day.")
+
+
+def test_replay():
+    rows = [
+        {'meters': meter, 'timestamp': f'2026-01-0{day}T{hour:02d}:00:00Z', 'current_consumption_hca': day * 100 + hour + offset,
+         'consumption_at_set_date_17_hca': 50, 'set_date_17': '2025-12-15' if hour < 12 else None}
+        for meter, offset in (('meter_a', 0), ('meter_b', 1000), ('meter_c', 2000))
+        for day in (4, 5, 6) for hour in (6, 18)
+    ]
+    fields = list(rows[0])
+    expected = sorted(accumulate_rows(rows), key=lambda r: (r['meters'], r['day']))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        jsonl_path = os.path.join(tmp, 'raw.jsonl')
+        with open(jsonl_path, 'w') as f:
+            f.writelines(json.dumps(row) + '\n' for row in rows)
+        csv_path = os.path.join(tmp, 'raw.csv')
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        inputs = [jsonl_path, csv_path]
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            parquet_path = os.path.join(tmp, 'raw.parquet')
+            pq.write_table(pa.Table.from_pylist(rows), parquet_path)
+            inputs.append(parquet_path)
+        except ImportError:
+            print("pyarrow is not installed; skipping the Parquet reader")
+
+        # Byte ranges start on line boundaries and cover every record once
+        for path, header in ((jsonl_path, 0), (csv_path, 1)):
+            parts = replay.split_input(path, 'jsonl' if header == 0 else 'csv', 4)
+            with open(path, 'rb') as f:
+                data = f.read()
+            assert len(parts) == 4 and parts[-1][1] == len(data), parts
+            assert b''.join(data[start:end] for start, end in parts).count(b'\n') == len(rows), parts
+            assert all(data[start - 1:start] == b'\n' for start, _ in parts if start), parts
+
+        def run(*argv):
+            output = os.path.join(tmp, 'daily.jsonl')
+            replay.main(list(argv) + ['-o', output, '--chunk-size', '5'])
+            with open(output) as f:
+                return [json.loads(line) for line in f]
+
+        for path in inputs:
+            assert run(path) == expected, path
+            # Splitting the export across processes gives the same rows, including for
+            # the meter-days cut in two
+            assert run(path, '--workers', '2') == expected, path
+            assert run(path, '--workers', '4', '--from', '2026-01-05', '--to', '2026-01-05') == [r for r in expected if r['day'].startswith('2026-01-05')], path
+            assert run(path, '--from', '2026-01-05', '--to', '2026-01-05') == [r for r in expected if r['day'].startswith('2026-01-05')], path
+    print("SUCCESS: Replaying JSONL and CSV exports matches accumulate_rows.")
+
+
+if __name__ == "__main__":
+    test_day_window()
+    test_parse_timestamp()
+    test_accumulate_columns()
+    test_accumulate_rows()
+    test_chunked_merge()
+    test_apply_reading()
+    test_local_days()
+    test_rollups()
+    test_status_flags()
+    test_replay_timezones()
+    test_replay()
+    print("\nALL ACCUMULATION TESTS PASSED")
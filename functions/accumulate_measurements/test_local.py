@@ -40,6 +40,20 @@ class MockContext:
         print(f"ERROR: {message}")
         self.errors.append(message)
 
+class FakeQuery:
+    # Renders queries as inspectable JSON strings, similar to the real SDK
+    def __getattr__(self, method):
+        return lambda *args: json.dumps({"method": method, "args": list(args)})
+
+def parse_queries(queries):
+    return [json.loads(q) for q in queries]
+
+def query_value(queries, method, attribute=None):
+    for q in parse_queries(queries):
+        if q['method'] == method and (attribute is None or q['args'][0] == attribute):
+            return q['args'][-1]
+    return None
+
 @patch('main.TablesDB')
 def test_function(MockTablesDB):
     # Mock Environment Variables
@@ -108,26 +122,16 @@ def test_function(MockTablesDB):
                     'total': 3,
                     'rows': [mock_rows[0]]
                 }
-        elif collection_id == 'test_daily':
-            # This is the existence check for daily-measurements
-            # We can control this to test CREATE vs UPDATE
-            if os.environ.get('TEST_MODE') == 'UPDATE':
-                return {
-                    'total': 1,
-                    'rows': [{'$id': 'existing_row_789'}]
-                }
-            else:
-                return {
-                    'total': 0,
-                    'rows': []
-                }
         return {'total': 0, 'rows': []}
 
     mock_instance.list_rows.side_effect = side_effect
     
-    # Mock behavior of create_row and update_row
-    mock_instance.create_row.return_value = {'$id': 'new_doc_id'}
-    mock_instance.update_row.return_value = {'$id': 'existing_row_789'}
+    # Mock behavior of upsert_row: a row that already existed has a newer $updatedAt
+    def upsert_side_effect(database_id, collection_id, row_id, data):
+        updated_at = '2026-01-06T01:00:00.000+00:00' if os.environ.get('TEST_MODE') == 'UPDATE' else '2026-01-05T01:00:00.000+00:00'
+        return {'$id': row_id, '$createdAt': '2026-01-05T01:00:00.000+00:00', '$updatedAt': updated_at}
+
+    mock_instance.upsert_row.side_effect = upsert_side_effect
 
     print("\n--- Testing CREATE Mode ---")
     os.environ['TEST_MODE'] = 'CREATE'
@@ -159,28 +163,768 @@ def test_function(MockTablesDB):
         print("\nFAILURE: Function did not log using 'timestamp' attribute.")
         sys.exit(1)
 
-    # Verify last_month was passed to create_row (from the first run)
-    create_call_args = next(call for call in mock_instance.create_row.call_args_list)
-    row_data = create_call_args[0][3]
+    # Verify last_month was passed to upsert_row (from the first run)
+    upsert_call_args = mock_instance.upsert_row.call_args_list[0]
+    row_data = upsert_call_args[0][3]
     if row_data.get('last_month') == 600 and row_data.get('date_last_month') == '2025-12-15T00:00:00Z':
-        print("SUCCESS: last_month and date_last_month correctly passed to create_row.")
+        print("SUCCESS: last_month and date_last_month correctly passed to upsert_row.")
     else:
-        print(f"FAILURE: last_month or date_last_month incorrect in create_row: {row_data}")
+        print(f"FAILURE: last_month or date_last_month incorrect in upsert_row: {row_data}")
         sys.exit(1)
     
-    # Verify update_row was called (from the second run)
-    if mock_instance.update_row.called:
-        update_call_args = mock_instance.update_row.call_args[0]
-        if update_call_args[2] == 'existing_row_789':
-            print("SUCCESS: update_row called with correct ID.")
-        else:
-            print(f"FAILURE: update_row called with wrong ID: {update_call_args[2]}")
-            sys.exit(1)
+    # Verify both runs upserted the same deterministic row without a lookup on the daily collection
+    row_ids = {call[0][2] for call in mock_instance.upsert_row.call_args_list}
+    daily_lookups = [call for call in mock_instance.list_rows.call_args_list if call[0][1] == 'test_daily']
+    if row_ids == {'internal_device_456_20260105'} and not daily_lookups:
+        print("SUCCESS: upsert_row called with a deterministic ID and no read-before-write.")
     else:
-        print("FAILURE: update_row was not called in UPDATE mode.")
+        print(f"FAILURE: unexpected upsert IDs {row_ids} or daily lookups {daily_lookups}")
         sys.exit(1)
 
     print("\nALL LOCAL TESTS PASSED")
 
+def raw_scan_page(raw, queries):
+    # Bulk scan: raw rows of the requested meters inside the timestamp window, in timestamp order
+    wanted = query_value(queries, 'equal', 'meters')
+    wanted = [wanted] if isinstance(wanted, str) else wanted
+    start = query_value(queries, 'greater_than_equal', 'timestamp')
+    end = query_value(queries, 'less_than_equal', 'timestamp')
+    rows = [
+        dict(r, **{'$id': f"{m}_{i}", 'meters': {'$id': m}})
+        for m in wanted for i, r in enumerate(raw.get(m, []))
+        if start <= r['timestamp'][:19] <= end
+    ]
+    rows.sort(key=lambda r: r['timestamp'])
+    return {'total': len(rows), 'rows': rows}
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_batch_mode(MockTablesDB):
+    meters = {'dev_a': 'meter_a', 'dev_b': 'meter_b'}
+    raw = {
+        'meter_a': [
+            {'timestamp': '2026-01-05T01:00:00Z', 'current_consumption_hca': 10, 'consumption_at_set_date_17_hca': 5, 'set_date_17': '2025-12-15'},
+            {'timestamp': '2026-01-05T23:00:00Z', 'current_consumption_hca': 30}
+        ],
+        'meter_b': [
+            {'timestamp': '2026-01-05T06:00:00Z', 'current_consumption_hca': 7}
+        ]
+    }
+
+    def side_effect(database_id, collection_id, queries=None):
+        if collection_id == 'test_meters':
+            wanted = query_value(queries, 'equal', 'device-id')
+            if wanted is not None:
+                rows = [{'$id': meters[d], 'device-id': d} for d in wanted if d in meters]
+                return {'total': len(rows), 'rows': rows}
+            # Shard enumeration, optionally of an $id range
+            after = query_value(queries, 'greater_than', '$id')
+            through = query_value(queries, 'less_than_equal', '$id')
+            rows = [{'$id': m, 'device-id': d} for d, m in meters.items()
+                    if (after is None or m > after) and (through is None or m <= through)]
+            return {'total': len(rows), 'rows': rows}
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        return {'total': 0, 'rows': []}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = side_effect
+    mock_instance.upsert_rows.side_effect = lambda db, table, rows: {'total': len(rows), 'rows': rows}
+
+    print("\n--- Testing BATCH Mode ---")
+    result = main(MockContext({"device-ids": ["dev_a", "dev_b", "dev_missing"], "date": "2026-01-05"}))
+    print(f"Result: {result}")
+    results = result['data']['results']
+
+    assert result['status_code'] == 200
+    assert results['dev_a']['status'] == 200 and results['dev_b']['status'] == 200
+    assert results['dev_a']['documentId'] == 'meter_a_20260105'
+    assert results['dev_missing']['status'] == 404
+    assert mock_instance.upsert_rows.call_count == 1
+    written = {r['meters']: r for c in mock_instance.upsert_rows.call_args_list for r in c[0][2]}
+    assert written['meter_a']['current'] == 20 and written['meter_a']['last_month'] == 5
+    assert written['meter_b']['current'] == 0
+    raw_calls = [c for c in mock_instance.list_rows.call_args_list if c[0][1] == 'test_raw']
+    assert len(raw_calls) == 1
+    print("SUCCESS: Batch mode returns a per-device result map from a single raw scan.")
+
+    print("\n--- Testing SHARD Mode ---")
+    results_by_shard = [
+        main(MockContext({"shard": shard, "shards": 2, "date": "2026-01-05"}))['data']['results']
+        for shard in range(2)
+    ]
+    assert sorted(d for r in results_by_shard for d in r) == ['dev_a', 'dev_b']
+    print("SUCCESS: Shards partition the active meters.")
+
+    # A shard with an $id range only reads the meters inside it
+    enumerated = len([c for c in mock_instance.list_rows.call_args_list if c[0][1] == 'test_meters'])
+    results_by_shard = [
+        main(MockContext({"shard": shard, "shards": 2, "id-range": id_range, "date": "2026-01-05"}))['data']['results']
+        for shard, id_range in enumerate([[None, 'meter_a'], ['meter_a', None]])
+    ]
+    assert [sorted(r) for r in results_by_shard] == [['dev_a'], ['dev_b']], results_by_shard
+    meter_calls = [c for c in mock_instance.list_rows.call_args_list if c[0][1] == 'test_meters'][enumerated:]
+    assert len(meter_calls) == 2 and all(query_value(c.kwargs['queries'], 'order_asc') == '$id' for c in meter_calls)
+    assert main(MockContext({"shard": 0, "shards": 2, "id-range": "meter_a", "date": "2026-01-05"}))['status_code'] == 400
+    print("SUCCESS: Shards given as $id ranges read only their own meters.")
+
+    invalid = main(MockContext({"shard": 2, "shards": 2, "date": "2026-01-05"}))
+    assert invalid['status_code'] == 400
+    print("SUCCESS: Invalid shard rejected.")
+
+    os.environ['APPWRITE_RUNS_COLLECTION_ID'] = 'test_runs'
+    main(MockContext({"shard": 0, "shards": 1, "date": "2026-01-05", "run-id": "run_1"}))
+    del os.environ['APPWRITE_RUNS_COLLECTION_ID']
+    _, table, row_id, data = mock_instance.upsert_row.call_args[0]
+    assert (table, row_id) == ('test_runs', 'run_1_0'), (table, row_id)
+    assert data['kind'] == 'shard' and data['status'] == 'done' and data['devices'] == 2 and data['processed'] == 2, data
+    assert main(MockContext({"device-ids": ["dev_a"], "date": "2026-01-05", "run-id": "run_1"}))['status_code'] == 400
+    print("SUCCESS: Shard workers of a sharded run record their completion.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_range_backfill(MockTablesDB):
+    os.environ['APPWRITE_CHECKPOINTS_COLLECTION_ID'] = 'test_checkpoints'
+    raw = {
+        'meter_a': [
+            {'timestamp': f'2026-01-0{day}T{hour:02d}:00:00.000+00:00', 'current_consumption_hca': day * 100 + hour}
+            for day in (1, 2, 4) for hour in (6, 18)
+        ]
+    }
+    checkpoints = {}
+    daily = []
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_meters':
+            return {'total': 1, 'rows': [{'$id': 'meter_a', 'device-id': 'dev_a'}]}
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        if collection_id == 'test_checkpoints':
+            row = checkpoints.get(query_value(queries, 'equal', '$id'))
+            return {'total': 1, 'rows': [row]} if row else {'total': 0, 'rows': []}
+        return {'total': 0, 'rows': []}
+
+    def upsert_rows(database_id, collection_id, rows):
+        daily.extend(rows)
+        return {'total': len(rows), 'rows': rows}
+
+    def upsert_row(database_id, collection_id, row_id, data):
+        checkpoints[row_id] = dict(data, **{'$id': row_id})
+        return checkpoints[row_id]
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_row.side_effect = upsert_row
+    mock_instance.upsert_rows.side_effect = upsert_rows
+
+    print("\n--- Testing RANGE Mode with resume ---")
+    payload = {"device-id": "dev_a", "from": "2026-01-01", "to": "2026-01-04"}
+
+    # A tiny time budget stops the run after the first completed day
+    os.environ['ACCUMULATE_TIME_BUDGET_SECONDS'] = '0.000001'
+    first = main(MockContext(payload))
+    del os.environ['ACCUMULATE_TIME_BUDGET_SECONDS']
+    assert first['status_code'] == 202 and first['data']['complete'] is False
+    assert [d['day'] for d in daily] == ['2026-01-01T00:00:00']
+    assert list(checkpoints.values())[0]['day'] == '2026-01-01'
+
+    second = main(MockContext(payload))
+    assert second['status_code'] == 200 and second['data']['complete'] is True
+    assert [d['day'] for d in daily] == ['2026-01-01T00:00:00', '2026-01-02T00:00:00', '2026-01-04T00:00:00']
+    assert [d['current'] for d in daily] == [12, 12, 12]
+    assert sorted(second['data']['results']['dev_a']) == ['2026-01-02', '2026-01-04']
+    assert list(checkpoints.values())[0]['status'] == 'done'
+    raw_calls = [c for c in mock_instance.list_rows.call_args_list if c[0][1] == 'test_raw']
+    assert len(raw_calls) == 2
+    print("SUCCESS: Range backfill buckets one ordered scan into days and resumes from its checkpoint.")
+
+    del os.environ['APPWRITE_CHECKPOINTS_COLLECTION_ID']
+
+@patch('main.TablesDB')
+def test_meter_id_fast_path(MockTablesDB):
+    sys.modules['main'].METER_ID_CACHE.entries.clear()
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.return_value = {
+        'total': 1,
+        'rows': [{'$id': 'internal_x', 'device-id': 'dev_x', 'timestamp': '2026-01-05T08:00:00Z', 'current_consumption_hca': 1}]
+    }
+    mock_instance.upsert_row.return_value = {'$id': 'new_doc_id'}
+
+    print("\n--- Testing meter-id fast path ---")
+    main(MockContext({"device-id": "dev_x", "meter-id": "internal_x", "date": "2026-01-05"}))
+    tables = [c[0][1] for c in mock_instance.list_rows.call_args_list]
+    assert 'test_meters' not in tables, tables
+    print("SUCCESS: A meter-id in the payload skips the meters lookup.")
+
+    mock_instance.list_rows.reset_mock()
+    main(MockContext({"device-id": "dev_y", "date": "2026-01-05"}))
+    main(MockContext({"device-id": "dev_y", "date": "2026-01-06"}))
+    tables = [c[0][1] for c in mock_instance.list_rows.call_args_list]
+    assert tables.count('test_meters') == 1, tables
+    stats = sys.modules['main'].METER_ID_CACHE.stats()
+    assert stats['hits'] >= 1 and stats['misses'] >= 1, stats
+    print("SUCCESS: Resolved meter ids are cached across executions.")
+
+@patch('main.TablesDB')
+def test_metrics(MockTablesDB):
+    sys.modules['main'].METER_ID_CACHE.entries.clear()
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.return_value = {
+        'total': 1,
+        'rows': [{'$id': 'internal_m', 'device-id': 'dev_m', 'timestamp': '2026-01-05T08:00:00Z', 'current_consumption_hca': 1}]
+    }
+    mock_instance.upsert_row.return_value = {'$id': 'new_doc_id'}
+
+    print("\n--- Testing metrics and debug logging ---")
+    context = MockContext({"device-id": "dev_m", "date": "2026-01-05"})
+    metrics = main(context)['data']['metrics']
+    assert set(metrics['timings_ms']) == {'resolve', 'earliest', 'latest', 'write'}, metrics
+    assert metrics['calls']['tables_db.list_rows']['count'] == 3
+    assert metrics['calls']['tables_db.upsert_row']['count'] == 1
+    assert not any(log.startswith('Earliest measurement:') for log in context.logs)
+
+    os.environ['LOG_LEVEL'] = 'debug'
+    context = MockContext({"device-id": "dev_m", "date": "2026-01-05"})
+    main(context)
+    del os.environ['LOG_LEVEL']
+    assert any(log.startswith('Earliest measurement:') for log in context.logs)
+    print("SUCCESS: Responses carry per-phase timings and row dumps are gated behind LOG_LEVEL=debug.")
+
+def test_client_pool():
+    from client_pool import ClientPool, SessionRequests
+
+    print("\n--- Testing client pool ---")
+    pool = ClientPool(pool_size=4)
+    pool.get('https://localhost/v1', 'test_project', 'key_1')
+    pool.get('https://localhost/v1', 'test_project', 'key_1')
+    pool.get('https://localhost/v1', 'test_project', 'key_2')
+    stats = pool.stats()
+    assert stats['clients_created'] == 2 and stats['clients_reused'] == 1, stats
+    assert len(pool.clients) == 2
+
+    # The SDK's requests.request() now goes through the shared keep-alive session
+    import appwrite.client as sdk
+    assert isinstance(sdk.requests, SessionRequests)
+    sdk.requests.request('GET', 'https://localhost/v1/health', headers={})
+    pool.session.request.assert_called_with('GET', 'https://localhost/v1/health', headers={})
+
+    context = MockContext({"device-ids": ["dev_a"], "date": "2026-01-05"})
+    with patch('main.TablesDB') as MockTablesDB:
+        MockTablesDB.return_value.list_rows.return_value = {'total': 0, 'rows': []}
+        before = sys.modules['main'].CLIENT_POOL.stats()
+        after = main(context)['data']['client_pool']
+    assert after['clients_created'] == before['clients_created'], (before, after)
+    assert after['clients_reused'] == before['clients_reused'] + 1, (before, after)
+
+    # Pool and cache sizes are read with the rest of the configuration
+    os.environ['APPWRITE_HTTP_POOL_SIZE'] = 'ten'
+    result = main(MockContext({"device-ids": ["dev_a"], "date": "2026-01-05"}))
+    assert result['status_code'] == 500 and result['data'] == {"error": "Configuration error"}, result
+    os.environ['APPWRITE_HTTP_POOL_SIZE'] = '4'
+    os.environ['METER_ID_CACHE_SIZE'] = '50'
+    with patch('main.TablesDB') as MockTablesDB:
+        MockTablesDB.return_value.list_rows.return_value = {'total': 0, 'rows': []}
+        main(MockContext({"device-ids": ["dev_a"], "date": "2026-01-05"}))
+    del os.environ['APPWRITE_HTTP_POOL_SIZE']
+    del os.environ['METER_ID_CACHE_SIZE']
+    assert sys.modules['main'].CLIENT_POOL.pool_size == 4 and sys.modules['main'].METER_ID_CACHE.max_size == 50
+    print("SUCCESS: Clients are reused across executions and share one HTTP session.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_day_query_mode(MockTablesDB):
+    sys.modules['main'].READINGS_PER_DAY.clear()
+    raw = [
+        {'$id': f'r{hour}', 'timestamp': f'2026-01-05T{hour:02d}:00:00Z', 'current_consumption_hca': 100 + hour,
+         'consumption_at_set_date_17_hca': 9, 'set_date_17': '2025-12-15'}
+        for hour in (6, 12, 18)
+    ]
+
+    def list_rows(database_id, collection_id, queries=None):
+        assert query_value(queries, 'select') is not None, "raw reads must be projected"
+        rows = raw[::-1] if query_value(queries, 'order_desc') else raw
+        return {'total': len(rows), 'rows': rows[:query_value(queries, 'limit')]}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_row.side_effect = lambda db, table, row_id, data: dict(data, **{'$id': row_id})
+
+    print("\n--- Testing adaptive day query ---")
+    payload = {"device-id": "dev_q", "meter-id": "meter_q", "date": "2026-01-05"}
+    first = main(MockContext(payload))['data']['metrics']
+    second = main(MockContext(payload))['data']['metrics']
+    # The first run learns the day's size from the point query's total
+    assert first['calls']['tables_db.list_rows']['count'] == 2 and 'earliest' in first['timings_ms']
+    assert second['calls']['tables_db.list_rows']['count'] == 1 and 'scan' in second['timings_ms']
+    written = [c[0][3] for c in mock_instance.upsert_row.call_args_list]
+    assert written[0] == written[1] and written[0]['current'] == 12 and written[0]['last_month'] == 9
+
+    os.environ['ACCUMULATE_DAY_QUERY'] = 'point'
+    forced = main(MockContext(payload))['data']['metrics']
+    del os.environ['ACCUMULATE_DAY_QUERY']
+    assert forced['calls']['tables_db.list_rows']['count'] == 2
+    print("SUCCESS: Small days are read with one projected scan once their size is known.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_raw_event(MockTablesDB):
+    daily = {}
+
+    def list_rows(database_id, collection_id, queries=None):
+        assert collection_id == 'test_daily'
+        row = daily.get(query_value(queries, 'equal', '$id'))
+        return {'total': 1, 'rows': [row]} if row else {'total': 0, 'rows': []}
+
+    def upsert_row(database_id, collection_id, row_id, data):
+        daily[row_id] = dict(data, **{'$id': row_id})
+        return daily[row_id]
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_row.side_effect = upsert_row
+
+    def event(row):
+        context = MockContext(dict(row, meters={'$id': 'meter_e'}))
+        context.req.headers = {
+            'x-appwrite-trigger': 'event',
+            'x-appwrite-event': f"databases.test_db.tables.test_raw.rows.{row['$id']}.create"
+        }
+        return main(context)
+
+    print("\n--- Testing raw row events ---")
+    readings = [('r1', '2026-01-05T12:00:00.000+00:00', 120), ('r2', '2026-01-05T06:00:00.000+00:00', 100),
+                ('r3', '2026-01-05T09:00:00.000+00:00', 110), ('r4', '2026-01-05T22:00:00.000+00:00', 150)]
+    results = [event({'$id': i, 'timestamp': t, 'current_consumption_hca': v}) for i, t, v in readings]
+    assert all(r['status_code'] == 200 for r in results)
+    assert results[2]['data']['message'] == "Daily measurement unchanged"
+
+    row = daily['meter_e_20260105']
+    assert (row['start'], row['end'], row['current']) == (100, 150, 50), row
+    assert row['first_timestamp'] == '2026-01-05T06:00:00.000+00:00' and row['last_timestamp'] == '2026-01-05T22:00:00.000+00:00'
+    # One bounds lookup per reading, and no raw table queries
+    assert mock_instance.list_rows.call_count == 4 and mock_instance.upsert_row.call_count == 3
+    print("SUCCESS: Inserted raw rows update the day's bounds in place.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_skip_unchanged(MockTablesDB):
+    raw = {'meter_s': [
+        {'timestamp': '2026-01-05T06:00:00Z', 'current_consumption_hca': 10},
+        {'timestamp': '2026-01-05T18:00:00Z', 'current_consumption_hca': 25}
+    ]}
+    daily = {}
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        if collection_id == 'test_daily':
+            rows = [daily[i] for i in query_value(queries, 'equal', '$id') if i in daily]
+            return {'total': len(rows), 'rows': rows}
+        return {'total': 0, 'rows': []}
+
+    def upsert_rows(database_id, collection_id, rows):
+        daily.update({r['$id']: dict(r) for r in rows})
+        return {'total': len(rows), 'rows': rows}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_rows.side_effect = upsert_rows
+
+    print("\n--- Testing skip-unchanged ---")
+    payload = {"device-ids": ["dev_s"], "meter-ids": {"dev_s": "meter_s"}, "date": "2026-01-05"}
+    first = main(MockContext(payload))['data']
+    second = main(MockContext(payload))['data']
+    assert first['unchanged'] == 0 and second['unchanged'] == 1, (first, second)
+    assert mock_instance.upsert_rows.call_count == 1
+    assert second['results']['dev_s']['message'] == "Daily measurement unchanged"
+
+    raw['meter_s'].append({'timestamp': '2026-01-05T22:00:00Z', 'current_consumption_hca': 30})
+    third = main(MockContext(payload))['data']
+    assert third['unchanged'] == 0 and mock_instance.upsert_rows.call_count == 2
+    assert daily['meter_s_20260105']['current'] == 20
+    print("SUCCESS: Re-runs only rewrite daily rows whose values changed.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_timezones(MockTablesDB):
+    raw = {
+        # 00:30 and 23:30 local on 2026-01-05 in Berlin, then 00:30 on the 6th
+        'meter_berlin': [
+            {'timestamp': '2026-01-04T23:30:00Z', 'current_consumption_hca': 100},
+            {'timestamp': '2026-01-05T22:30:00Z', 'current_consumption_hca': 140},
+            {'timestamp': '2026-01-05T23:30:00Z', 'current_consumption_hca': 150}
+        ],
+        # 08:00 and 20:00 local on 2026-01-05 in New York
+        'meter_ny': [
+            {'timestamp': '2026-01-05T13:00:00Z', 'current_consumption_hca': 10},
+            {'timestamp': '2026-01-06T01:00:00Z', 'current_consumption_hca': 17}
+        ]
+    }
+    written = []
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        return {'total': 0, 'rows': []}
+
+    def upsert_rows(database_id, collection_id, rows):
+        written.extend(rows)
+        return {'total': len(rows), 'rows': rows}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_rows.side_effect = upsert_rows
+
+    print("\n--- Testing timezone-aware days ---")
+    os.environ['METER_TIMEZONE'] = 'Europe/Berlin'
+    result = main(MockContext({
+        "device-ids": ["dev_berlin", "dev_ny"],
+        "meter-ids": {"dev_berlin": "meter_berlin", "dev_ny": "meter_ny"},
+        "timezones": {"dev_ny": "America/New_York"},
+        "date": "2026-01-05"
+    }))
+    del os.environ['METER_TIMEZONE']
+
+    assert result['status_code'] == 200, result
+    rows = {r['meters']: r for r in written}
+    assert rows['meter_berlin']['day'] == '2026-01-05T00:00:00' and rows['meter_berlin']['current'] == 40, rows
+    assert rows['meter_ny']['current'] == 7 and rows['meter_ny']['$id'] == 'meter_ny_20260105', rows
+    raw_calls = [c for c in mock_instance.list_rows.call_args_list if c[0][1] == 'test_raw']
+    assert len(raw_calls) == 1
+
+    # A single device is read with the same naive UTC bounds and stored under the same day
+    os.environ['METER_TIMEZONE'] = 'Europe/Berlin'
+    os.environ['ACCUMULATE_DAY_QUERY'] = 'scan'
+    mock_instance.list_rows.reset_mock()
+    result = main(MockContext({"device-id": "dev_berlin", "meter-id": "meter_berlin", "date": "2026-01-05"}))
+    del os.environ['METER_TIMEZONE']
+    del os.environ['ACCUMULATE_DAY_QUERY']
+    assert result['status_code'] in (200, 201), result
+    queries = [c for c in mock_instance.list_rows.call_args_list if c[0][1] == 'test_raw'][0].kwargs['queries']
+    assert query_value(queries, 'greater_than_equal', 'timestamp') == '2026-01-04T23:00:00', queries
+    assert query_value(queries, 'less_than_equal', 'timestamp') == '2026-01-05T22:59:59.999999', queries
+    row_id, row_data = mock_instance.upsert_row.call_args[0][2:4]
+    assert row_id == 'meter_berlin_20260105' and row_data['day'] == rows['meter_berlin']['day'], row_data
+    assert row_data['current'] == rows['meter_berlin']['current'], row_data
+
+    # A misspelled zone falls back to the default instead of failing the whole batch
+    os.environ['METER_TIMEZONE'] = 'Europe/Berlin'
+    written.clear()
+    context = MockContext({
+        "device-ids": ["dev_berlin", "dev_ny"],
+        "meter-ids": {"dev_berlin": "meter_berlin", "dev_ny": "meter_ny"},
+        "timezones": {"dev_ny": "America/New_Yrok"},
+        "date": "2026-01-05"
+    })
+    result = main(context)
+    del os.environ['METER_TIMEZONE']
+    assert result['status_code'] == 200, result
+    rows = {r['meters']: r for r in written}
+    assert rows['meter_berlin']['current'] == 40 and rows['meter_ny']['day'] == '2026-01-05T00:00:00', rows
+    assert any('America/New_Yrok' in e for e in context.errors), context.errors
+    print("SUCCESS: One raw scan is bucketed into each meter's local day.")
+
+@patch('jobs.Query', FakeQuery())
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_job_queue(MockTablesDB):
+    os.environ['APPWRITE_JOBS_COLLECTION_ID'] = 'test_jobs'
+    raw = {
+        'meter_a': [
+            {'timestamp': '2026-01-05T01:00:00Z', 'current_consumption_hca': 10},
+            {'timestamp': '2026-01-05T23:00:00Z', 'current_consumption_hca': 30}
+        ],
+        'meter_b': []
+    }
+    jobs = {
+        f'{m}_20260105': {'$id': f'{m}_20260105', 'device_id': d, 'meter_id': m, 'date': '2026-01-05', 'status': 'pending',
+                          'attempts': 0, 'next_attempt_at': '2026-01-05T00:00:00.000+00:00'}
+        for d, m in [('dev_a', 'meter_a'), ('dev_b', 'meter_b')]
+    }
+    daily_fails = []
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_jobs':
+            ids = query_value(queries, 'equal', '$id')
+            if ids is not None:
+                rows = [jobs[i] for i in ids if i in jobs]
+            else:
+                due = query_value(queries, 'less_than_equal', 'next_attempt_at')
+                statuses = query_value(queries, 'equal', 'status')
+                rows = [j for j in jobs.values() if j['status'] in statuses and j['next_attempt_at'] <= due][:query_value(queries, 'limit')]
+            return {'total': len(rows), 'rows': [dict(r) for r in rows]}
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        return {'total': 0, 'rows': []}
+
+    def upsert_rows(database_id, collection_id, rows):
+        if collection_id == 'test_jobs':
+            for row in rows:
+                jobs[row['$id']] = dict(jobs.get(row['$id'], {}), **row)
+        elif daily_fails:
+            raise Exception(daily_fails.pop())
+        return {'total': len(rows), 'rows': rows}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_rows.side_effect = upsert_rows
+
+    print("\n--- Testing JOB QUEUE worker ---")
+    result = main(MockContext({"jobs": True}))
+    assert result['status_code'] == 200, result
+    assert result['data']['claimed'] == 2 and result['data']['done'] == 2, result['data']
+    assert all(j['status'] == 'done' and j['claimed_by'] is None for j in jobs.values()), jobs
+
+    # Every claim counts as an attempt
+    assert all(j['attempts'] == 1 for j in jobs.values()), jobs
+
+    # A failed write is recorded on the job and retried later with backoff
+    jobs['meter_a_20260105'].update(status='pending', attempts=0, next_attempt_at='2026-01-05T00:00:00.000+00:00')
+    daily_fails.append("Server error")
+    result = main(MockContext({"jobs": True}))
+    job = jobs['meter_a_20260105']
+    assert result['data']['retried'] == 1 and job['status'] == 'pending' and job['attempts'] == 1, job
+    assert job['last_error'] == 'Server error' and job['next_attempt_at'] > '2026-01-06', job
+    assert main(MockContext({"jobs": True}))['data']['claimed'] == 0
+
+    # The last attempt gives up
+    os.environ['JOB_MAX_ATTEMPTS'] = '2'
+    job['next_attempt_at'] = '2026-01-05T00:00:00.000+00:00'
+    daily_fails.append("Server error")
+    result = main(MockContext({"jobs": True}))
+    job = jobs['meter_a_20260105']
+    assert result['data']['failed'] == 1 and job['status'] == 'failed' and job['attempts'] == 2, job
+
+    # A job claimed by another worker in the meantime is left to that worker
+    job.update(status='pending', attempts=0, next_attempt_at='2026-01-05T00:00:00.000+00:00')
+    def contested(database_id, collection_id, rows):
+        upsert_rows(database_id, collection_id, rows)
+        if collection_id == 'test_jobs' and rows[0]['status'] == 'running':
+            jobs['meter_a_20260105']['claimed_by'] = 'other_worker'
+        return {'total': len(rows), 'rows': rows}
+    mock_instance.upsert_rows.side_effect = contested
+    result = main(MockContext({"jobs": True}))
+    job = jobs['meter_a_20260105']
+    assert result['data']['claimed'] == 0 and job['claimed_by'] == 'other_worker', job
+
+    # A round lost entirely to another worker is followed by another claim
+    os.environ['JOB_CLAIM_SIZE'] = '1'
+    for j in jobs.values():
+        j.update(status='pending', attempts=0, claimed_by=None, next_attempt_at='2026-01-05T00:00:00.000+00:00')
+    lost = []
+    def contested_once(database_id, collection_id, rows):
+        upsert_rows(database_id, collection_id, rows)
+        if collection_id == 'test_jobs' and rows[0]['status'] == 'running' and not lost:
+            lost.append(rows[0]['$id'])
+            jobs[rows[0]['$id']]['claimed_by'] = 'other_worker'
+        return {'total': len(rows), 'rows': rows}
+    mock_instance.upsert_rows.side_effect = contested_once
+    result = main(MockContext({"jobs": True}))
+    del os.environ['JOB_CLAIM_SIZE']
+    assert result['data']['claimed'] == 1 and result['data']['done'] == 1, result['data']
+    assert [j['$id'] for j in jobs.values() if j['status'] == 'done'] == ['meter_b_20260105'], jobs
+    job = jobs['meter_a_20260105']
+
+    # A job re-enqueued with a reset while it ran is not overwritten when the worker finishes
+    mock_instance.upsert_rows.side_effect = upsert_rows
+    job.update(status='pending', attempts=0, claimed_by=None, next_attempt_at='2026-01-05T00:00:00.000+00:00')
+    def accumulate_during_reset(*args, **kwargs):
+        jobs['meter_a_20260105'].update(status='pending', attempts=0, claimed_by=None)
+        return {}, None
+    with patch('main.accumulate_batch', side_effect=accumulate_during_reset):
+        result = main(MockContext({"jobs": True}))
+    job = jobs['meter_a_20260105']
+    assert result['data']['claimed'] == 1 and result['data']['done'] == 0, result['data']
+    assert job['status'] == 'pending' and job['attempts'] == 0, job
+
+    # A lease that keeps running out uses up the attempts too
+    job.update(status='running', attempts=2, claimed_by='crashed_worker', next_attempt_at='2026-01-05T00:00:00.000+00:00')
+    result = main(MockContext({"jobs": True}))
+    job = jobs['meter_a_20260105']
+    assert result['data']['failed'] == 1 and result['data']['claimed'] == 0, result['data']
+    assert job['status'] == 'failed' and job['claimed_by'] is None and 'Lease expired' in job['last_error'], job
+
+    del os.environ['JOB_MAX_ATTEMPTS']
+    del os.environ['APPWRITE_JOBS_COLLECTION_ID']
+    print("SUCCESS: Queue workers claim jobs, record failures and retry with backoff.")
+
+@patch('rollups.Query', FakeQuery())
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_rollups(MockTablesDB):
+    os.environ['APPWRITE_ROLLUPS_COLLECTION_ID'] = 'test_rollups'
+    raw = {
+        'meter_a': [
+            {'timestamp': f'2026-01-0{day}T{hour:02d}:00:00.000+00:00', 'current_consumption_hca': day * 100 + hour,
+             'consumption_at_set_date_17_hca': 50, 'set_date_17': '2025-12-15'}
+            for day in (5, 6, 7) for hour in (6, 18)
+        ]
+    }
+    tables = {'test_daily': {}, 'test_rollups': {}}
+    scans = []
+
+    def matches(row, q):
+        method, attribute, value = q['method'], q['args'][0], q['args'][-1]
+        if method not in ('equal', 'greater_than_equal', 'less_than'):
+            return True
+        field = row.get(attribute)
+        field = field.get('$id') if isinstance(field, dict) else field
+        if method == 'equal':
+            return field in (value if isinstance(value, list) else [value])
+        if method == 'greater_than_equal':
+            return field >= value
+        if method == 'less_than':
+            return field < value
+        return True
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_meters':
+            return {'total': 1, 'rows': [{'$id': 'meter_a', 'device-id': 'dev_a'}]}
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        if collection_id in tables:
+            if query_value(queries, 'order_asc'):
+                scans.append(queries)
+            rows = [r for r in tables[collection_id].values() if all(matches(r, q) for q in parse_queries(queries))]
+            rows.sort(key=lambda r: r.get('day') or '')
+            return {'total': len(rows), 'rows': [dict(r) for r in rows]}
+        return {'total': 0, 'rows': []}
+
+    def upsert_rows(database_id, collection_id, rows):
+        for row in rows:
+            tables[collection_id][row['$id']] = dict(row)
+        return {'total': len(rows), 'rows': rows}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_rows.side_effect = upsert_rows
+
+    print("\n--- Testing ROLLUPS ---")
+    main(MockContext({"device-ids": ["dev_a"], "from": "2026-01-05", "to": "2026-01-07"}))
+    month = tables['test_rollups']['meter_a_m202601']
+    period = tables['test_rollups']['meter_a_p20251215']
+    assert (month['days'], month['current'], month['start'], month['end']) == (3, 36, 506, 718), month
+    assert period['current'] == 36 and period['first_day'] == '2026-01-05', period
+    assert not scans
+
+    # A late reading for the last day replaces that day's contribution
+    raw['meter_a'].append({'timestamp': '2026-01-07T22:00:00.000+00:00', 'current_consumption_hca': 730})
+    main(MockContext({"device-ids": ["dev_a"], "date": "2026-01-07"}))
+    month = tables['test_rollups']['meter_a_m202601']
+    assert (month['days'], month['current'], month['end']) == (3, 48, 730), month
+    assert not scans
+
+    # A late reading for an earlier day is folded by rebuilding from the daily rows
+    raw['meter_a'].append({'timestamp': '2026-01-05T23:00:00.000+00:00', 'current_consumption_hca': 530})
+    main(MockContext({"device-ids": ["dev_a"], "date": "2026-01-05"}))
+    month = tables['test_rollups']['meter_a_m202601']
+    assert (month['days'], month['current']) == (3, 60), month
+    assert len(scans) == 2
+
+    # The meter's baseline is written with the rollups
+    baseline = tables['test_rollups']['meter_a_brolling']
+    assert (baseline['kind'], baseline['days'], baseline['last_day']) == ('baseline', 3, '2026-01-07'), baseline
+
+    # The bulk recompute builds the same rollups from one ordered scan and keeps the baseline
+    expected = {k: dict(v) for k, v in tables['test_rollups'].items()}
+    for row_id in [k for k, v in tables['test_rollups'].items() if v['kind'] != 'baseline']:
+        del tables['test_rollups'][row_id]
+    result = main(MockContext({"recompute_rollups": True, "device-ids": ["dev_a"]}))
+    assert result['status_code'] == 200 and result['data']['rollups'] == 2, result
+    assert tables['test_rollups'] == expected, tables['test_rollups']
+    assert len(scans) == 3
+
+    del os.environ['APPWRITE_ROLLUPS_COLLECTION_ID']
+    print("SUCCESS: Rollups are maintained incrementally and rebuilt from daily rows.")
+
+@patch('rollups.Query', FakeQuery())
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+def test_anomaly_flags(MockTablesDB):
+    os.environ['APPWRITE_ROLLUPS_COLLECTION_ID'] = 'test_rollups'
+
+    def reading(day, hour, value, set_date='2025-12-15', at_set_date=50, month=1):
+        return {'timestamp': f'2026-{month:02d}-{day:02d}T{hour:02d}:00:00.000+00:00', 'current_consumption_hca': value,
+                'consumption_at_set_date_17_hca': at_set_date, 'set_date_17': set_date}
+
+    # Ten steady days of 12 units, then a spike, a single reading, a reset at the
+    # set date and a counter that runs backwards
+    readings = [reading(day, hour, 20 * day + (12 if hour == 18 else 0)) for day in range(1, 11) for hour in (6, 18)]
+    readings += [
+        reading(11, 6, 220), reading(11, 18, 420),
+        reading(12, 12, 430),
+        reading(13, 6, 500), reading(13, 18, 3, '2026-01-13', 505),
+        reading(14, 6, 20, '2026-01-13', 505), reading(14, 18, 10, '2026-01-13', 505)
+    ]
+    raw = {'meter_a': readings}
+    tables = {'test_daily': {}, 'test_rollups': {}}
+    rollup_reads = []
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_meters':
+            return {'total': 1, 'rows': [{'$id': 'meter_a', 'device-id': 'dev_a'}]}
+        if collection_id == 'test_raw':
+            return raw_scan_page(raw, queries)
+        wanted = query_value(queries, 'equal', '$id') or []
+        if collection_id == 'test_rollups':
+            rollup_reads.append(wanted)
+        rows = [dict(r) for row_id, r in tables.get(collection_id, {}).items() if row_id in wanted]
+        return {'total': len(rows), 'rows': rows}
+
+    def upsert_rows(database_id, collection_id, rows):
+        for row in rows:
+            tables[collection_id][row['$id']] = dict(row)
+        return {'total': len(rows), 'rows': rows}
+
+    mock_instance = MockTablesDB.return_value
+    mock_instance.list_rows.side_effect = list_rows
+    mock_instance.upsert_rows.side_effect = upsert_rows
+
+    print("\n--- Testing ANOMALY FLAGS ---")
+    result = main(MockContext({"device-ids": ["dev_a"], "from": "2026-01-01", "to": "2026-01-14"}))
+    assert result['status_code'] == 200, result
+    status = {row['day'][:10]: row['status'] for row in tables['test_daily'].values()}
+    assert all(status[f'2026-01-{day:02d}'] == 'ok' for day in range(1, 11)), status
+    assert status['2026-01-11'] == 'outlier'
+    assert status['2026-01-12'] == 'single_reading'
+    assert status['2026-01-13'] == 'reset'
+    assert status['2026-01-14'] == 'negative'
+
+    # Baselines are read once for the chunk and written with its rollups
+    assert len(rollup_reads) == 2, rollup_reads
+    baseline = tables['test_rollups']['meter_a_brolling']
+    assert (baseline['days'], baseline['last_day']) == (11, '2026-01-11'), baseline
+
+    # Then 45 days of 1 unit, which pulls the baseline far below the early days
+    raw['meter_a'] = readings + [
+        reading(day, hour, 600 + 2 * day + (1 if hour == 18 else 0), '2026-01-13', 505, month)
+        for month, days in ((1, range(15, 32)), (2, range(1, 29))) for day in days for hour in (6, 18)
+    ]
+    result = main(MockContext({"device-ids": ["dev_a"], "from": "2026-01-15", "to": "2026-02-28"}))
+    assert result['status_code'] == 200, result
+    print('BASE', tables['test_rollups']['meter_a_brolling']); assert tables['test_rollups']['meter_a_brolling']['last_day'] == '2026-02-28'
+
+    # Re-running an old, unchanged day keeps its status and leaves the row untouched
+    before = {day: dict(row) for day, row in tables['test_daily'].items()}
+    for date_str in ('2026-01-05', '2026-01-11'):
+        result = main(MockContext({"device-ids": ["dev_a"], "date": date_str}))
+        assert result['data']['results']['dev_a'].get('unchanged'), result['data']
+    assert tables['test_daily'] == before
+
+    del os.environ['APPWRITE_ROLLUPS_COLLECTION_ID']
+    print("SUCCESS: Negative, reset, single-reading and outlier days are flagged in one pass.")
+
 if __name__ == "__main__":
     test_function()
+    test_batch_mode()
+    test_range_backfill()
+    test_meter_id_fast_path()
+    test_metrics()
+    test_client_pool()
+    test_day_query_mode()
+    test_raw_event()
+    test_skip_unchanged()
+    test_timezones()
+    test_job_queue()
+    test_rollups()
+    test_anomaly_flags()
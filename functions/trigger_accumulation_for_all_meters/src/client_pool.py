@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+
+class SessionRequests:
+    # Stands in for the `requests` module inside the SDK, which sends every call
+    # through requests.request() and so opens a new connection (and TLS session)
+    # each time. Routing it through one Session keeps connections alive.
+    def __init__(self, requests, session):
+        self._requests = requests
+        self._session = session
+
+    def request(self, method, url, **kwargs):
+        return self._session.request(method, url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._requests, name)
+
+
+def install_session(pool_size):
+    import appwrite.client as sdk
+    requests = getattr(sdk, 'requests', None)
+    if requests is None:
+        # SDK without a module-level requests import; leave it untouched
+        return None
+    if isinstance(requests, SessionRequests):
+        return requests._session
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    sdk.requests = SessionRequests(requests, session)
+    return session
+
+
+class ClientPool:
+    # Appwrite clients keyed by (endpoint, project, key), kept at module level so
+    # warm executions reuse them. All clients share one keep-alive HTTP session,
+    # so connections are reused even when the per-execution key changes.
+    def __init__(self, pool_size=10, max_clients=32):
+        self.pool_size = pool_size
+        self.max_clients = max_clients
+        self.clients = OrderedDict()
+        self.session = None
+        self.session_installed = False
+        self.created = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, project, key):
+        with self.lock:
+            if not self.session_installed:
+                self.session = install_session(self.pool_size)
+                self.session_installed = True
+
+            client_key = (endpoint, project, key)
+            client = self.clients.get(client_key)
+            if client is not None:
+                self.clients.move_to_end(client_key)
+                self.reused += 1
+                return client
+
+            from appwrite.client import Client
+            client = Client()
+            client.set_endpoint(endpoint)
+            client.set_project(project)
+            client.set_key(key)
+            self.clients[client_key] = client
+            self.created += 1
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+            return client
+
+    def connection_stats(self):
+        # urllib3 counts connections opened and requests sent per host pool
+        opened = sent = 0
+        if self.session is not None:
+            for adapter in self.session.adapters.values():
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools[pool_key]
+                    opened += pool.num_connections
+                    sent += pool.num_requests
+        return opened, sent - opened
+
+    def stats(self):
+        with self.lock:
+            opened, reused = self.connection_stats()
+            return {
+                "clients_created": self.created,
+                "clients_reused": self.reused,
+                "connections_opened": opened,
+                "connections_reused": reused
+            }
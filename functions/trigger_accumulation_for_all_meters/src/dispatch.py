@@ -0,0 +1,94 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    # Allows `rate` acquisitions per second with bursts of up to `capacity`
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_retryable(error):
+    # AppwriteException carries the HTTP status in `code`; errors without one are network failures
+    code = getattr(error, 'code', None)
+    if not isinstance(code, int) or code == 0:
+        return True
+    return code == 429 or code >= 500
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def call_with_retry(fn, max_retries, base_delay, max_delay, rate_limiter=None):
+    attempt = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            return fn(), attempt
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                e.retries = attempt
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            attempt += 1
+
+
+def dispatch_batches(batches, send, concurrency, max_retries, base_delay, max_delay, rate_limiter=None, on_error=None, check=None):
+    # Runs send(batch) for every batch with at most `concurrency` calls in flight.
+    # `batches` may be a generator; it is only consumed as slots free up.
+    # check(batch, result), when given, returns the members of a batch whose work
+    # failed although the call went through; a batch that failed whole counts as a
+    # failed execution.
+    summary = {'executions': 0, 'devices': 0, 'retries': 0, 'failed_executions': 0, 'failed_device_ids': []}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def run(batch):
+        try:
+            result, retries = call_with_retry(lambda: send(batch), max_retries, base_delay, max_delay, rate_limiter)
+            failed = list(check(batch, result)) if check else []
+            with lock:
+                summary['retries'] += retries
+                summary['failed_device_ids'].extend(failed)
+                if failed and len(failed) >= len(batch):
+                    summary['failed_executions'] += 1
+                else:
+                    summary['executions'] += 1
+                    summary['devices'] += len(batch) - len(failed)
+        except Exception as e:
+            with lock:
+                summary['failed_executions'] += 1
+                summary['failed_device_ids'].extend(batch)
+                summary['retries'] += getattr(e, 'retries', 0)
+            if on_error:
+                on_error(batch, e)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch in batches:
+            slots.acquire()
+            executor.submit(run, batch)
+
+    return summary
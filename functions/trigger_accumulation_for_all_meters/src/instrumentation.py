@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def debug_enabled():
+    # Verbose logging (e.g. full row dumps) is only paid for when LOG_LEVEL=debug
+    return os.environ.get('LOG_LEVEL', '').lower() == 'debug'
+
+
+class Metrics:
+    # Per-execution timings: wall time per phase and latency/rows per Appwrite call
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.calls = {}
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def timed_iter(self, name, iterable):
+        # Charges the time spent producing each item (e.g. fetching pages) to a phase
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, elapsed_ms, rows):
+        with self.lock:
+            call = self.calls.setdefault(name, {'count': 0, 'total_ms': 0, 'max_ms': 0, 'rows': 0})
+            call['count'] += 1
+            call['total_ms'] += elapsed_ms
+            call['max_ms'] = max(call['max_ms'], elapsed_ms)
+            call['rows'] += rows
+
+    def add_retries(self, retries):
+        with self.lock:
+            self.retries += retries
+
+    def summary(self):
+        with self.lock:
+            return {
+                'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'timings_ms': {name: round(ms, 1) for name, ms in self.phases.items()},
+                'calls': {
+                    name: dict(call, total_ms=round(call['total_ms'], 1), max_ms=round(call['max_ms'], 1))
+                    for name, call in self.calls.items()
+                },
+                'retries': self.retries
+            }
+
+
+class Instrumented:
+    # Wraps an Appwrite service (TablesDB, Functions) and records every call in `metrics`
+    def __init__(self, service, metrics, prefix):
+        self._service = service
+        self._metrics = metrics
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attribute = getattr(self._service, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            result = None
+            try:
+                result = attribute(*args, **kwargs)
+                return result
+            finally:
+                rows = len(result['rows']) if isinstance(result, dict) and isinstance(result.get('rows'), list) else int(result is not None)
+                self._metrics.record(f"{self._prefix}.{name}", (time.perf_counter() - started) * 1000, rows)
+
+        return call
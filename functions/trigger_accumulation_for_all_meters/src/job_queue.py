@@ -0,0 +1,121 @@
+import hashlib
+from datetime import datetime, timedelta, timezone
+from appwrite.query import Query
+
+# Enqueueing side of the accumulation job queue; accumulate_measurements claims and
+# works the jobs (see its jobs.py for the status lifecycle).
+
+JOB_STATUSES = ['pending', 'running', 'done', 'failed']
+
+# Rows per bulk upsert request
+JOB_UPSERT_CHUNK_SIZE = 100
+
+# Appwrite row IDs are limited to 36 characters
+MAX_ROW_ID_LENGTH = 36
+
+# Largest `total` Appwrite reports for a list (APP_LIMIT_COUNT)
+APP_LIMIT_COUNT = 5000
+
+# Page size of the projected scan that counts past APP_LIMIT_COUNT
+COUNT_PAGE_SIZE = 1000
+
+
+def job_row_id(meter_id, date_str):
+    # One job per (meter, date): enqueueing the same day again finds the job instead of duplicating it
+    row_id = f"{meter_id}_{date_str.replace('-', '')}"
+    if len(row_id) <= MAX_ROW_ID_LENGTH:
+        return row_id
+    return 'j' + hashlib.sha1(row_id.encode('utf-8')).hexdigest()[:MAX_ROW_ID_LENGTH - 1]
+
+
+def period_dates(period):
+    if 'date' in period:
+        return [period['date']]
+    day = datetime.strptime(period['from'], '%Y-%m-%d')
+    last_day = datetime.strptime(period['to'], '%Y-%m-%d')
+    dates = []
+    while day <= last_day:
+        dates.append(day.strftime('%Y-%m-%d'))
+        day += timedelta(days=1)
+    return dates
+
+
+def existing_statuses(tables_db, database_id, jobs_collection_id, row_ids):
+    # {$id: status} of the jobs among `row_ids` that already exist, one read per 100
+    statuses = {}
+    for i in range(0, len(row_ids), JOB_UPSERT_CHUNK_SIZE):
+        chunk = row_ids[i:i + JOB_UPSERT_CHUNK_SIZE]
+        page = tables_db.list_rows(database_id, jobs_collection_id, queries=[
+            Query.equal('$id', chunk),
+            Query.select(['$id', 'status']),
+            Query.limit(len(chunk))
+        ])
+        statuses.update({row['$id']: row.get('status') for row in page.get('rows', [])})
+    return statuses
+
+
+def enqueue_jobs(tables_db, database_id, jobs_collection_id, batch, dates, reset=False):
+    # Writes a pending job for every {device-id: meter $id} in `batch` and every date.
+    # Jobs that are already queued, running or done are left alone, so enqueueing a
+    # day again neither reruns finished work nor resets a job a worker holds; failed
+    # jobs get a fresh set of attempts. With `reset`, every job is rewritten.
+    # Returns the number of jobs written.
+    now = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+    rows = [
+        {
+            '$id': job_row_id(meter_id, date_str),
+            'device_id': device_id,
+            'meter_id': meter_id,
+            'date': date_str,
+            'status': 'pending',
+            'attempts': 0,
+            'last_error': None,
+            'next_attempt_at': now,
+            'claimed_by': None
+        }
+        for date_str in dates for device_id, meter_id in batch.items()
+    ]
+    if not reset:
+        statuses = existing_statuses(tables_db, database_id, jobs_collection_id, [row['$id'] for row in rows])
+        rows = [row for row in rows if statuses.get(row['$id']) in (None, 'failed')]
+    for i in range(0, len(rows), JOB_UPSERT_CHUNK_SIZE):
+        tables_db.upsert_rows(database_id, jobs_collection_id, rows[i:i + JOB_UPSERT_CHUNK_SIZE])
+    return len(rows)
+
+
+def count_rows(tables_db, database_id, jobs_collection_id, queries):
+    # Rows matching `queries`. The `total` of a list response is capped by Appwrite
+    # (APP_LIMIT_COUNT, 5000 by default), so at the cap the rows are counted with a
+    # projected, cursor-paginated scan instead.
+    page = tables_db.list_rows(database_id, jobs_collection_id, queries=queries + [
+        Query.select(['$id']),
+        Query.limit(1)
+    ])
+    total = page.get('total', 0)
+    if total < APP_LIMIT_COUNT:
+        return total
+
+    total = 0
+    cursor = None
+    while True:
+        page_queries = queries + [Query.select(['$id']), Query.limit(COUNT_PAGE_SIZE)]
+        if cursor:
+            page_queries.append(Query.cursor_after(cursor))
+        rows = tables_db.list_rows(database_id, jobs_collection_id, queries=page_queries).get('rows', [])
+        total += len(rows)
+        if len(rows) < COUNT_PAGE_SIZE:
+            return total
+        cursor = rows[-1]['$id']
+
+
+def count_jobs(tables_db, database_id, jobs_collection_id, period=None):
+    # Jobs per status, optionally for one period: one count query per status, and a
+    # scan for a status with more jobs than Appwrite counts
+    date_filter = []
+    if period and 'date' in period:
+        date_filter = [Query.equal('date', period['date'])]
+    elif period:
+        date_filter = [Query.greater_than_equal('date', period['from']), Query.less_than_equal('date', period['to'])]
+
+    return {status: count_rows(tables_db, database_id, jobs_collection_id, date_filter + [Query.equal('status', status)])
+            for status in JOB_STATUSES}
@@ -0,0 +1,138 @@
+import math
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+from appwrite.query import Query
+
+# Dry-run planning: what a run would cost, estimated from the meters enumeration and
+# count queries of raw rows per day and chunk of meters. Request counts follow how accumulate_measurements
+# batches its own work; compare reads and writes are counted as if every day changed.
+
+# Meters per query and rows per bulk write in accumulate_measurements
+WORKER_CHUNK_SIZE = 100
+
+# Page size of accumulate_measurements' raw scan
+WORKER_RAW_PAGE_SIZE = 1000
+
+# Page size of the trigger's $id scan of a sharded run
+METER_ID_PAGE_SIZE = 1000
+
+# Meters per page when a worker enumerates its shard
+METERS_PAGE_SIZE = 100
+
+# Jobs a queue worker claims per round (its JOB_CLAIM_SIZE default)
+WORKER_CLAIM_SIZE = 100
+
+# Requests per claim round besides accumulating: claim read, claim write, read back,
+# finish read back and finish write
+CLAIM_REQUESTS = 5
+
+# Start-up and scheduling time of one execution, unless the request gives one
+DEFAULT_EXECUTION_OVERHEAD_MS = 500
+
+# Round-trip latency when the plan's own queries could not be timed
+DEFAULT_LATENCY_MS = 50
+
+# Largest `total` Appwrite reports for a list (APP_LIMIT_COUNT)
+APP_LIMIT_COUNT = 5000
+
+# Chunks of meters whose raw rows are counted per day; larger fleets are extrapolated
+# from an evenly spread sample of this many chunks
+RAW_COUNT_CHUNKS = 10
+
+
+def count_raw_rows(tables_db, database_id, raw_collection_id, date_str, tz_name='UTC', meter_ids=None):
+    # Raw rows of one day, local to `tz_name`, from a projected count query that returns
+    # a single row, optionally for a chunk of meters only. Appwrite caps the count at
+    # APP_LIMIT_COUNT, so a count that reaches it means at least that many rows.
+    day = datetime.strptime(date_str, '%Y-%m-%d').date()
+    zone = ZoneInfo(tz_name)
+    start = datetime.combine(day, time.min, tzinfo=zone).astimezone(timezone.utc).replace(tzinfo=None)
+    end = datetime.combine(day + timedelta(days=1), time.min, tzinfo=zone).astimezone(timezone.utc).replace(tzinfo=None)
+    queries = [Query.equal('meters', meter_ids)] if meter_ids else []
+    page = tables_db.list_rows(database_id, raw_collection_id, queries=queries + [
+        Query.greater_than_equal('timestamp', start.isoformat()),
+        Query.less_than('timestamp', end.isoformat()),
+        Query.select(['$id']),
+        Query.limit(1)
+    ])
+    return page.get('total', 0)
+
+
+def sample_chunks(meter_ids, chunk_size=WORKER_CHUNK_SIZE, samples=RAW_COUNT_CHUNKS):
+    # Chunks of meters as a worker queries them, or an evenly spread sample of them
+    chunks = [meter_ids[i:i + chunk_size] for i in range(0, len(meter_ids), chunk_size)]
+    if len(chunks) <= samples:
+        return chunks
+    return [chunks[i * len(chunks) // samples] for i in range(samples)]
+
+
+def count_day_rows(tables_db, database_id, raw_collection_id, date_str, tz_name, meter_ids):
+    # Raw rows of one day summed over chunks of meters, each well under the count cap
+    # at normal reading rates, and scaled up by meters when only a sample was counted.
+    # Returns the count and whether a chunk reached the cap.
+    chunks = sample_chunks(meter_ids)
+    counts = [count_raw_rows(tables_db, database_id, raw_collection_id, date_str, tz_name, chunk) for chunk in chunks]
+    sampled = sum(len(chunk) for chunk in chunks)
+    total = sum(counts) if sampled == len(meter_ids) else round(sum(counts) * len(meter_ids) / sampled)
+    return total, any(count >= APP_LIMIT_COUNT for count in counts)
+
+
+def batch_requests(devices, days, raw_rows):
+    # Requests of one accumulate_batch call: per chunk of 100 meters a raw scan that
+    # stops at the first short page, then a compare read and a bulk write per day
+    if not devices:
+        return 0
+    chunks = math.ceil(devices / WORKER_CHUNK_SIZE)
+    scan_pages = chunks * (int(raw_rows / chunks) // WORKER_RAW_PAGE_SIZE + 1)
+    return scan_pages + chunks * days * 2
+
+
+def estimate_run(mode, devices, meter_pages, days, raw_rows, settings, latency_ms, overhead_ms, shards=None):
+    # Executions, Appwrite round-trips and projected wall time of a run in `mode`
+    # ("direct", "queue" or "shards") over `devices` meters and `days` days
+    batches = math.ceil(devices / settings['batch_size'])
+    if mode == 'shards':
+        # The trigger scans the meter $ids once; each shard pages through its own range
+        executions = shards
+        shard_devices = math.ceil(devices / shards)
+        per_execution = math.ceil((shard_devices + 1) / METERS_PAGE_SIZE) + batch_requests(shard_devices, days, raw_rows / shards) + 1
+        trigger = math.ceil((devices + 1) / METER_ID_PAGE_SIZE) + 1 + shards
+        worker = per_execution * shards
+        execution_ms = overhead_ms + per_execution * latency_ms
+        wall_ms = math.ceil(shards / settings['concurrency']) * latency_ms + execution_ms
+    elif mode == 'queue':
+        # A batch's jobs for every day are enqueued at once, so a claim mixes days and
+        # accumulates each day separately; every worker ends on a claim that finds nothing
+        jobs = devices * days
+        claims = math.ceil(jobs / WORKER_CLAIM_SIZE)
+        groups = min(days, WORKER_CLAIM_SIZE)
+        group_devices = math.ceil(min(jobs, WORKER_CLAIM_SIZE) / groups)
+        per_claim = CLAIM_REQUESTS + groups * batch_requests(group_devices, 1, raw_rows / max(claims * groups, 1))
+        executions = settings['queue_workers']
+        # Per 100 jobs a read of the existing jobs' status and a bulk write
+        enqueue = 2 * batches * math.ceil(min(devices, settings['batch_size']) * days / WORKER_CHUNK_SIZE)
+        trigger = meter_pages + enqueue + executions
+        worker = per_claim * claims + executions
+        execution_ms = overhead_ms + math.ceil(claims / executions) * per_claim * latency_ms
+        wall_ms = (meter_pages + math.ceil(enqueue / settings['concurrency'])) * latency_ms + execution_ms
+    else:
+        # The trigger waits for each execution; `concurrency` of them run at once
+        executions = batches
+        per_execution = batch_requests(min(devices, settings['batch_size']), days, raw_rows / max(batches, 1))
+        trigger = meter_pages + executions
+        worker = per_execution * batches
+        execution_ms = overhead_ms + per_execution * latency_ms
+        dispatch_ms = math.ceil(batches / settings['concurrency']) * execution_ms
+        if settings['rate_limit']:
+            dispatch_ms = max(dispatch_ms, batches / settings['rate_limit'] * 1000)
+        wall_ms = meter_pages * latency_ms + dispatch_ms
+
+    return {
+        'mode': mode,
+        'batches': batches,
+        'executions': executions,
+        'round_trips': {'trigger': trigger, 'workers': worker, 'total': trigger + worker},
+        'daily_rows': devices * days,
+        'execution_ms': round(execution_ms),
+        'projected_wall_ms': round(wall_ms)
+    }
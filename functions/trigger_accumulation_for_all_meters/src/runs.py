@@ -0,0 +1,147 @@
+import math
+import uuid
+from datetime import datetime, timezone
+from appwrite.query import Query
+
+# A sharded run is one summary row (kind "run", $id = run id) plus one completion
+# row per shard (kind "shard"), written by the accumulate_measurements worker.
+
+# Page size used when collecting shard completion rows
+RUNS_PAGE_SIZE = 100
+
+# Page size of the projected $id scan that sizes and splits a sharded run
+METER_ID_PAGE_SIZE = 1000
+
+# Counters summed from the shard rows into the run row
+SHARD_COUNTERS = ['devices', 'processed', 'failed', 'unchanged']
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+def new_run_id():
+    # Sortable by start time and short enough for shard row IDs
+    return 'run' + datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S') + uuid.uuid4().hex[:8]
+
+
+def shard_row_id(run_id, shard):
+    # Must match shard_row_id in accumulate_measurements
+    return f"{run_id}_{shard}"
+
+
+def shard_count(requested, active_meters, meters_per_shard, max_shards):
+    # An explicit count, or enough shards for `meters_per_shard` meters each
+    if requested != 'auto':
+        return int(requested)
+    return min(max_shards, max(1, math.ceil(active_meters / meters_per_shard)))
+
+
+def list_active_meter_ids(tables_db, database_id, meters_collection_id):
+    # $ids of all active meters in the server's $id order. A real count: the `total`
+    # of a list response is capped by Appwrite (APP_LIMIT_COUNT, 5000 by default).
+    meter_ids = []
+    cursor = None
+    while True:
+        queries = [
+            Query.equal('active', True),
+            Query.order_asc('$id'),
+            Query.select(['$id']),
+            Query.limit(METER_ID_PAGE_SIZE)
+        ]
+        if cursor:
+            queries.append(Query.cursor_after(cursor))
+
+        rows = tables_db.list_rows(database_id, meters_collection_id, queries=queries).get('rows', [])
+        meter_ids.extend(row['$id'] for row in rows)
+        if len(rows) < METER_ID_PAGE_SIZE:
+            return meter_ids
+        cursor = rows[-1]['$id']
+
+
+def shard_ranges(meter_ids, shards):
+    # Splits $ids (in server order) into `shards` contiguous [after, through] ranges
+    # of nearly equal size. The first and last range are open, so meters added after
+    # the scan still fall into a shard. Each worker then only reads its own range.
+    ranges = []
+    for shard in range(shards):
+        low = shard * len(meter_ids) // shards
+        high = (shard + 1) * len(meter_ids) // shards
+        after = meter_ids[low - 1] if shard > 0 else None
+        through = meter_ids[high - 1] if shard < shards - 1 else None
+        ranges.append([after, through])
+    return ranges
+
+
+def start_run(tables_db, database_id, runs_collection_id, run_id, shards, period_label):
+    tables_db.upsert_row(database_id, runs_collection_id, run_id, dict({
+        'run_id': run_id,
+        'kind': 'run',
+        'shard': None,
+        'shards': shards,
+        'period': period_label,
+        'status': 'running',
+        'shards_done': 0,
+        'started_at': now_iso(),
+        'finished_at': None
+    }, **{counter: 0 for counter in SHARD_COUNTERS}))
+
+
+def list_shard_rows(tables_db, database_id, runs_collection_id, run_id):
+    rows = []
+    cursor = None
+    while True:
+        queries = [
+            Query.equal('run_id', run_id),
+            Query.equal('kind', 'shard'),
+            Query.limit(RUNS_PAGE_SIZE)
+        ]
+        if cursor:
+            queries.append(Query.cursor_after(cursor))
+
+        page = tables_db.list_rows(database_id, runs_collection_id, queries=queries)
+        rows.extend(page.get('rows', []))
+        if len(page.get('rows', [])) < RUNS_PAGE_SIZE:
+            return rows
+        cursor = rows[-1]['$id']
+
+
+def collect_run(tables_db, database_id, runs_collection_id, run_id):
+    # Folds the shard completion rows into the run row. The run is "running" until
+    # every shard has reported, then "done", or "failed"/"partial" when a shard was.
+    res = tables_db.list_rows(database_id, runs_collection_id, queries=[
+        Query.equal('$id', run_id),
+        Query.limit(1)
+    ])
+    if res['total'] == 0:
+        return None
+    run = res['rows'][0]
+
+    shard_rows = list_shard_rows(tables_db, database_id, runs_collection_id, run_id)
+    statuses = {row.get('status') for row in shard_rows}
+    if len(shard_rows) < run['shards']:
+        status = 'running'
+    elif 'failed' in statuses:
+        status = 'failed'
+    elif 'partial' in statuses:
+        status = 'partial'
+    else:
+        status = 'done'
+
+    summary = {counter: sum(row.get(counter) or 0 for row in shard_rows) for counter in SHARD_COUNTERS}
+    summary.update({
+        'status': status,
+        'shards_done': len(shard_rows),
+        'finished_at': max(row.get('finished_at') or '' for row in shard_rows) if status != 'running' else None
+    })
+    tables_db.upsert_row(database_id, runs_collection_id, run_id, summary)
+
+    summary.update({
+        'run_id': run_id,
+        'shards': run['shards'],
+        'period': run.get('period'),
+        'started_at': run.get('started_at'),
+        'failed_shards': sorted(row['shard'] for row in shard_rows if row.get('status') != 'done'),
+        'missing_shards': sorted(set(range(run['shards'])) - {row['shard'] for row in shard_rows})
+    })
+    return summary
@@ -36,6 +36,18 @@ class MockContext:
         print(f"ERROR: {message}")
         self.errors.append(str(message))
 
+class FakeQuery:
+    # Renders queries as inspectable JSON strings, similar to the real SDK
+    def __getattr__(self, method):
+        return lambda *args: json.dumps({"method": method, "args": list(args)})
+
+def query_value(queries, method, attribute=None):
+    for q in queries:
+        q = json.loads(q)
+        if q['method'] == method and (attribute is None or q['args'][0] == attribute):
+            return q['args'][-1]
+    return None
+
 @patch('main.TablesDB')
 @patch('main.Functions')
 def test_function(MockFunctions, MockTablesDB):
@@ -80,24 +92,573 @@ def test_function(MockFunctions, MockTablesDB):
         # Verify list_rows was called
         mock_tables_instance.list_rows.assert_called_once()
         
-        # Verify create_execution was called twice (once for each active meter)
-        assert mock_functions_instance.create_execution.call_count == 2
-        print("SUCCESS: create_execution called for each active meter.")
+        # Verify create_execution was called once with both meters in one batch
+        assert mock_functions_instance.create_execution.call_count == 1
+        print("SUCCESS: create_execution called once for the whole batch.")
         
         # Verify payloads
         calls = mock_functions_instance.create_execution.call_args_list
-        body1 = json.loads(calls[0].kwargs['body'])
-        body2 = json.loads(calls[1].kwargs['body'])
+        body = json.loads(calls[0].kwargs['body'])
         
-        assert body1['device-id'] == 'dev_001'
-        assert body1['date'] == '2026-01-05'
-        assert body2['device-id'] == 'dev_002'
-        assert body2['date'] == '2026-01-05'
+        assert body['device-ids'] == ['dev_001', 'dev_002']
+        assert body['meter-ids'] == {'dev_001': 'meter_1', 'dev_002': 'meter_2'}
+        assert body['date'] == '2026-01-05'
+        assert result['data']['devices_dispatched'] == 2
+        assert result['data']['metrics']['calls']['functions.create_execution']['count'] == 1
+        assert set(result['data']['metrics']['timings_ms']) == {'enumerate', 'dispatch'}
         print("SUCCESS: Trigger payloads are correct.")
         
     else:
         print(f"FAILURE: Function returned status {result['status_code']}")
         sys.exit(1)
 
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_batch_size(MockFunctions, MockTablesDB):
+    os.environ['ACCUMULATE_BATCH_SIZE'] = '1'
+
+    mock_tables_instance = MockTablesDB.return_value
+    mock_tables_instance.list_rows.return_value = {
+        'total': 3,
+        'rows': [
+            {'$id': 'meter_1', 'device-id': 'dev_001', 'active': True},
+            {'$id': 'meter_2', 'active': True},
+            {'$id': 'meter_3', 'device-id': 'dev_003', 'active': True}
+        ]
+    }
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning batch size test for trigger function...")
+    result = main(MockContext({"date": "2026-01-05"}))
+    del os.environ['ACCUMULATE_BATCH_SIZE']
+
+    calls = mock_functions_instance.create_execution.call_args_list
+    batches = [json.loads(c.kwargs['body'])['device-ids'] for c in calls]
+    assert sorted(batches) == [['dev_001'], ['dev_003']], batches
+    assert result['data']['batch_size'] == 1
+
+    # A malformed pool size is a configuration error, like the other settings
+    os.environ['APPWRITE_HTTP_POOL_SIZE'] = 'ten'
+    result = main(MockContext({"date": "2026-01-05"}))
+    os.environ['APPWRITE_HTTP_POOL_SIZE'] = '3'
+    main(MockContext({"date": "2026-01-05"}))
+    del os.environ['APPWRITE_HTTP_POOL_SIZE']
+    assert result['status_code'] == 500 and result['data'] == {"error": "Configuration error"}, result
+    assert sys.modules['main'].CLIENT_POOL.pool_size == 3
+    print("SUCCESS: Meters are chunked by ACCUMULATE_BATCH_SIZE and meters without device-id are skipped.")
+
+@patch('main.METERS_PAGE_SIZE', 2)
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_pagination(MockFunctions, MockTablesDB):
+    meters = [{'$id': f'meter_{i}', 'device-id': f'dev_{i}'} for i in range(5)]
+    meters[3] = {'$id': 'meter_3'}
+
+    def list_rows(database_id, collection_id, queries=None):
+        limit = query_value(queries, 'limit')
+        cursor = query_value(queries, 'cursor_after')
+        start = 0 if cursor is None else [m['$id'] for m in meters].index(cursor) + 1
+        return {'total': len(meters), 'rows': meters[start:start + limit]}
+
+    MockTablesDB.return_value.list_rows.side_effect = list_rows
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning pagination test for trigger function...")
+    result = main(MockContext({"date": "2026-01-05"}))
+
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert body['device-ids'] == ['dev_0', 'dev_1', 'dev_2', 'dev_4'], body
+    assert result['data']['pages_fetched'] == 3
+    assert result['data']['total_active'] == 5
+    assert result['data']['rows_skipped'] == 1
+    assert result['data']['devices_dispatched'] == 4
+    print("SUCCESS: All pages of active meters are enumerated.")
+
+class FakeAppwriteException(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_retry_and_failures(MockFunctions, MockTablesDB):
+    os.environ['ACCUMULATE_BATCH_SIZE'] = '1'
+    os.environ['TRIGGER_RETRY_BASE_DELAY'] = '0'
+    os.environ['TRIGGER_RATE_LIMIT'] = '1000'
+
+    MockTablesDB.return_value.list_rows.return_value = {
+        'total': 3,
+        'rows': [{'$id': f'meter_{i}', 'device-id': f'dev_{i}'} for i in range(3)]
+    }
+
+    attempts = {}
+    def create_execution(function_id, body):
+        device_id = json.loads(body)['device-ids'][0]
+        attempts[device_id] = attempts.get(device_id, 0) + 1
+        if device_id == 'dev_0' and attempts[device_id] < 3:
+            raise FakeAppwriteException("Too many requests", 429)
+        if device_id == 'dev_1':
+            raise FakeAppwriteException("Bad request", 400)
+        if device_id == 'dev_2':
+            raise FakeAppwriteException("Server error", 503)
+        return {'$id': 'exec_id'}
+
+    MockFunctions.return_value.create_execution.side_effect = create_execution
+
+    print("\nRunning retry test for trigger function...")
+    result = main(MockContext({"date": "2026-01-05"}))
+    for name in ['ACCUMULATE_BATCH_SIZE', 'TRIGGER_RETRY_BASE_DELAY', 'TRIGGER_RATE_LIMIT']:
+        del os.environ[name]
+
+    data = result['data']
+    assert attempts == {'dev_0': 3, 'dev_1': 1, 'dev_2': 6}, attempts
+    assert data['devices_dispatched'] == 1
+    assert sorted(data['failed_device_ids']) == ['dev_1', 'dev_2']
+    assert data['retries'] == 7
+    print("SUCCESS: 429/5xx are retried, 4xx fail fast and failed device-ids are reported.")
+
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_execution_results(MockFunctions, MockTablesDB):
+    os.environ['ACCUMULATE_BATCH_SIZE'] = '2'
+    MockTablesDB.return_value.list_rows.return_value = {
+        'total': 8,
+        'rows': [{'$id': f'meter_{i}', 'device-id': f'dev_{i}'} for i in range(8)]
+    }
+
+    def create_execution(function_id, body):
+        devices = json.loads(body)['device-ids']
+        if devices[0] == 'dev_0':
+            # One device of the batch failed inside the accumulation
+            results = {'dev_0': {'status': 200}, 'dev_1': {'status': 500, 'error': 'boom'}}
+            return {'status': 'completed', 'responseStatusCode': 200, 'responseBody': json.dumps({'results': results})}
+        if devices[0] == 'dev_2':
+            return {'status': 'completed', 'responseStatusCode': 400, 'responseBody': '{"error": "Invalid date format"}'}
+        if devices[0] == 'dev_6':
+            # A backfill that ran out of time budget: its devices' results look fine, but days are missing
+            results = {d: {'2026-01-05': {'status': 200}} for d in devices}
+            return {'status': 'completed', 'responseStatusCode': 202,
+                    'responseBody': json.dumps({'complete': False, 'results': results})}
+        results = {d: {'status': 200} for d in devices}
+        return {'status': 'completed', 'responseStatusCode': 200, 'responseBody': json.dumps({'results': results})}
+
+    MockFunctions.return_value.create_execution.side_effect = create_execution
+
+    print("\nRunning execution result test for trigger function...")
+    data = main(MockContext({"date": "2026-01-05"}))['data']
+    del os.environ['ACCUMULATE_BATCH_SIZE']
+    assert (data['devices_dispatched'], data['failed_executions']) == (3, 2), data
+    assert sorted(data['failed_device_ids']) == ['dev_1', 'dev_2', 'dev_3', 'dev_6', 'dev_7'], data['failed_device_ids']
+    print("SUCCESS: Failed executions and failed devices inside a batch are reported as failures.")
+
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_backfill_range(MockFunctions, MockTablesDB):
+    MockTablesDB.return_value.list_rows.return_value = {
+        'total': 1,
+        'rows': [{'$id': 'meter_1', 'device-id': 'dev_001'}]
+    }
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning backfill range test for trigger function...")
+    result = main(MockContext({"from": "2026-01-01", "to": "2026-01-31"}))
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert result['status_code'] == 200
+    assert body == {"from": "2026-01-01", "to": "2026-01-31", "device-ids": ["dev_001"], "meter-ids": {"dev_001": "meter_1"}}, body
+
+    assert main(MockContext({"from": "2026-01-01"}))['status_code'] == 400
+
+    # Reversed, malformed and overlong periods are rejected before anything is dispatched or enqueued
+    mock_functions_instance.create_execution.reset_mock()
+    MockTablesDB.return_value.reset_mock()
+    for payload in ({"from": "2026-01-31", "to": "2026-01-01", "queue": True},
+                    {"date": "2026-13-01"},
+                    {"from": "2026-01-01", "to": "01/31/2026", "dry_run": True},
+                    {"from": "2022-01-01", "to": "2026-04-01", "queue": True}):
+        assert main(MockContext(payload))['status_code'] == 400, payload
+    assert not mock_functions_instance.create_execution.called
+    assert not MockTablesDB.return_value.method_calls
+    print("SUCCESS: Backfill ranges are passed through to accumulation batches.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_reconcile(MockFunctions, MockTablesDB):
+    os.environ['APPWRITE_DAILY_COLLECTION_ID'] = 'test_daily'
+    os.environ['APPWRITE_RAW_COLLECTION_ID'] = 'test_raw'
+    meters = [{'$id': f'meter_{i}', 'device-id': f'dev_{i}'} for i in range(5)]
+    daily = {
+        # Complete day
+        'meter_0_20260105': {'$id': 'meter_0_20260105', 'first_timestamp': '2026-01-05T00:10:00.000+00:00',
+                             'last_timestamp': '2026-01-05T23:00:00.000+00:00'},
+        # Last reading long before the end of the day
+        'meter_1_20260105': {'$id': 'meter_1_20260105', 'first_timestamp': '2026-01-05T00:10:00.000+00:00',
+                             'last_timestamp': '2026-01-05T09:00:00.000+00:00'},
+        # Written before bounds were stored
+        'meter_2_20260105': {'$id': 'meter_2_20260105'},
+        # Recent last reading, but a concurrent event lost the day's first reading
+        'meter_4_20260105': {'$id': 'meter_4_20260105', 'first_timestamp': '2026-01-05T06:00:00.000+00:00',
+                             'last_timestamp': '2026-01-05T23:00:00.000+00:00'}
+    }
+    raw = [
+        {'$id': 'raw_0', 'meters': {'$id': 'meter_0'}, 'timestamp': '2026-01-05T00:10:00'},
+        {'$id': 'raw_1', 'meters': {'$id': 'meter_0'}, 'timestamp': '2026-01-05T23:00:00'},
+        {'$id': 'raw_2', 'meters': {'$id': 'meter_0'}, 'timestamp': '2026-01-06T00:30:00'},
+        {'$id': 'raw_3', 'meters': {'$id': 'meter_4'}, 'timestamp': '2026-01-05T00:05:00'},
+        {'$id': 'raw_4', 'meters': {'$id': 'meter_4'}, 'timestamp': '2026-01-05T23:00:00'}
+    ]
+    raw_queries = []
+
+    def matches(row, clause):
+        clause = json.loads(clause)
+        if clause['method'] == 'and_queries':
+            return all(matches(row, q) for q in clause['args'][0])
+        attribute, value = clause['args']
+        actual = row['meters']['$id'] if attribute == 'meters' else row[attribute]
+        return {'equal': actual == value, 'greater_than': actual > value, 'less_than': actual < value,
+                'greater_than_equal': actual >= value}[clause['method']]
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_daily':
+            rows = [daily[i] for i in query_value(queries, 'equal') if i in daily]
+            return {'total': len(rows), 'rows': rows}
+        if collection_id == 'test_raw':
+            clauses = query_value(queries, 'or_queries')
+            raw_queries.append(clauses)
+            rows = [row for row in raw if any(matches(row, c) for c in clauses)]
+            return {'total': len(rows), 'rows': rows}
+        return {'total': len(meters), 'rows': meters}
+
+    MockTablesDB.return_value.list_rows.side_effect = list_rows
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning reconcile test for trigger function...")
+    result = main(MockContext({"date": "2026-01-05", "reconcile": True}))
+
+    assert result['status_code'] == 200, result
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert mock_functions_instance.create_execution.call_count == 1
+    assert body['device-ids'] == ['dev_1', 'dev_2', 'dev_3', 'dev_4'], body
+    assert result['data']['devices_up_to_date'] == 1
+    # Only the two rows that looked fresh are checked against the raw rows, in one query
+    assert len(raw_queries) == 1 and len(raw_queries[0]) == 4, raw_queries
+    assert main(MockContext({"from": "2026-01-01", "to": "2026-01-02", "reconcile": True}))['status_code'] == 400
+
+    del os.environ['APPWRITE_RAW_COLLECTION_ID']
+    assert main(MockContext({"date": "2026-01-05", "reconcile": True}))['status_code'] == 500
+    del os.environ['APPWRITE_DAILY_COLLECTION_ID']
+    print("SUCCESS: Reconcile only dispatches meters with a missing, stale or incomplete daily row.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_changed_only(MockFunctions, MockTablesDB):
+    os.environ['APPWRITE_RAW_COLLECTION_ID'] = 'test_raw'
+    os.environ['APPWRITE_CHECKPOINTS_COLLECTION_ID'] = 'test_checkpoints'
+    meters = [{'$id': f'meter_{i}', 'device-id': f'dev_{i}'} for i in range(3)]
+    raw = [
+        {'$id': 'r1', 'meters': {'$id': 'meter_0'}, '$updatedAt': '2026-01-06T01:00:00.000+00:00'},
+        {'$id': 'r2', 'meters': {'$id': 'meter_2'}, '$updatedAt': '2026-01-06T02:00:00.000+00:00'}
+    ]
+    checkpoints = {}
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_raw':
+            since = query_value(queries, 'greater_than')
+            rows = [r for r in raw if since is None or r['$updatedAt'] > since]
+            return {'total': len(rows), 'rows': rows}
+        if collection_id == 'test_checkpoints':
+            row = checkpoints.get(query_value(queries, 'equal'))
+            return {'total': 1, 'rows': [row]} if row else {'total': 0, 'rows': []}
+        return {'total': len(meters), 'rows': meters}
+
+    def upsert_row(database_id, collection_id, row_id, data):
+        checkpoints[row_id] = dict(data, **{'$id': row_id})
+        return checkpoints[row_id]
+
+    MockTablesDB.return_value.list_rows.side_effect = list_rows
+    MockTablesDB.return_value.upsert_row.side_effect = upsert_row
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning changed-only test for trigger function...")
+    first = main(MockContext({"date": "2026-01-05", "changed_only": True}))
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert body['device-ids'] == ['dev_0', 'dev_2'], body
+    assert first['data']['devices_unchanged'] == 1
+    assert list(checkpoints.values())[0]['watermark'] == '2026-01-06T02:00:00.000+00:00'
+
+    # Nothing was written since: the re-run dispatches nothing
+    second = main(MockContext({"date": "2026-01-05", "changed_only": True}))
+    assert second['data']['devices_dispatched'] == 0 and mock_functions_instance.create_execution.call_count == 1
+
+    raw.append({'$id': 'r3', 'meters': {'$id': 'meter_1'}, '$updatedAt': '2026-01-07T00:00:00.000+00:00'})
+    main(MockContext({"date": "2026-01-05", "changed_only": True}))
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert body['device-ids'] == ['dev_1'], body
+
+    del os.environ['APPWRITE_RAW_COLLECTION_ID']
+    del os.environ['APPWRITE_CHECKPOINTS_COLLECTION_ID']
+    print("SUCCESS: changed_only dispatches only meters with raw rows written since the last run.")
+
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_timezones(MockFunctions, MockTablesDB):
+    os.environ['APPWRITE_DAILY_COLLECTION_ID'] = 'test_daily'
+    os.environ['APPWRITE_RAW_COLLECTION_ID'] = 'test_raw'
+    os.environ['METER_TIMEZONE_ATTRIBUTE'] = 'timezone'
+    meters = [
+        {'$id': 'meter_0', 'device-id': 'dev_0', 'timezone': 'America/New_York'},
+        {'$id': 'meter_1', 'device-id': 'dev_1'}
+    ]
+    # Both read last at 20:00 UTC: the New York day still has 9 hours to go
+    daily = {
+        'meter_0_20260105': {'$id': 'meter_0_20260105', 'first_timestamp': '2026-01-05T05:00:00.000+00:00',
+                             'last_timestamp': '2026-01-05T20:00:00.000+00:00'},
+        'meter_1_20260105': {'$id': 'meter_1_20260105', 'first_timestamp': '2026-01-05T00:00:00.000+00:00',
+                             'last_timestamp': '2026-01-05T20:00:00.000+00:00'}
+    }
+    selects = []
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_daily':
+            rows = [daily[i] for i in query_value(queries, 'equal') if i in daily]
+            return {'total': len(rows), 'rows': rows}
+        if collection_id == 'test_raw':
+            return {'total': 0, 'rows': []}
+        selects.append(query_value(queries, 'select'))
+        return {'total': len(meters), 'rows': meters}
+
+    MockTablesDB.return_value.list_rows.side_effect = list_rows
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning timezone test for trigger function...")
+    main(MockContext({"date": "2026-01-05"}))
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert 'timezone' in selects[0], selects
+    assert body['timezones'] == {'dev_0': 'America/New_York'}, body
+
+    result = main(MockContext({"date": "2026-01-05", "reconcile": True}))
+    body = json.loads(mock_functions_instance.create_execution.call_args.kwargs['body'])
+    assert body['device-ids'] == ['dev_0'], body
+    assert result['data']['devices_up_to_date'] == 1
+
+    del os.environ['APPWRITE_DAILY_COLLECTION_ID']
+    del os.environ['APPWRITE_RAW_COLLECTION_ID']
+    del os.environ['METER_TIMEZONE_ATTRIBUTE']
+    print("SUCCESS: Meter timezones are passed on and staleness is judged against the local day.")
+
+@patch('runs.Query', FakeQuery())
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_sharded(MockFunctions, MockTablesDB):
+    os.environ['APPWRITE_RUNS_COLLECTION_ID'] = 'test_runs'
+    os.environ['TRIGGER_METERS_PER_SHARD'] = '2'
+    runs = {}
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_runs':
+            filters = [json.loads(q)['args'] for q in queries if json.loads(q)['method'] == 'equal']
+            rows = [r for r in runs.values() if all(r.get(a) in v for a, v in filters)]
+            return {'total': len(rows), 'rows': rows}
+        # Projected $id scan of the active meters; `total` is capped like Appwrite's
+        return {'total': 1, 'rows': [{'$id': f'meter_{i}'} for i in range(5)]}
+
+    def upsert_row(database_id, collection_id, row_id, data):
+        runs[row_id] = dict(runs.get(row_id, {}), **data, **{'$id': row_id})
+        return runs[row_id]
+
+    MockTablesDB.return_value.list_rows.side_effect = list_rows
+    MockTablesDB.return_value.upsert_row.side_effect = upsert_row
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning sharded run test for trigger function...")
+    result = main(MockContext({"date": "2026-01-05", "shards": "auto"}))
+    assert result['status_code'] == 200, result
+    run_id = result['data']['run_id']
+    assert result['data']['shards'] == 3 and runs[run_id]['status'] == 'running'
+    calls = mock_functions_instance.create_execution.call_args_list
+    payloads = [json.loads(c.kwargs['body']) for c in calls]
+    assert sorted(p['shard'] for p in payloads) == [0, 1, 2] and all(c.kwargs['xasync'] for c in calls)
+    assert all(p['shards'] == 3 and p['run-id'] == run_id and p['date'] == '2026-01-05' for p in payloads), payloads
+    # Contiguous $id ranges cover every meter exactly once
+    ranges = [p['id-range'] for p in sorted(payloads, key=lambda p: p['shard'])]
+    assert ranges == [[None, 'meter_0'], ['meter_0', 'meter_2'], ['meter_2', None]], ranges
+
+    # Two of three workers have reported
+    for shard, status in [(0, 'done'), (1, 'failed')]:
+        runs[f"{run_id}_{shard}"] = {'$id': f"{run_id}_{shard}", 'run_id': run_id, 'kind': 'shard', 'shard': shard,
+                                     'status': status, 'devices': 2, 'processed': 2 if status == 'done' else 0,
+                                     'failed': 0 if status == 'done' else 2, 'finished_at': f'2026-01-06T00:0{shard}:00.000+00:00'}
+    collected = main(MockContext({"collect": run_id}))['data']
+    assert collected['status'] == 'running' and collected['missing_shards'] == [2], collected
+
+    runs[f"{run_id}_2"] = dict(runs[f"{run_id}_0"], **{'$id': f"{run_id}_2", 'shard': 2, 'finished_at': '2026-01-06T00:05:00.000+00:00'})
+    collected = main(MockContext({"collect": run_id}))['data']
+    assert collected['status'] == 'failed' and collected['failed_shards'] == [1], collected
+    assert runs[run_id]['devices'] == 6 and runs[run_id]['processed'] == 4 and runs[run_id]['shards_done'] == 3
+    assert runs[run_id]['finished_at'] == '2026-01-06T00:05:00.000+00:00'
+
+    assert main(MockContext({"collect": "run_missing"}))['status_code'] == 404
+    os.environ['APPWRITE_DAILY_COLLECTION_ID'] = 'test_daily'
+    os.environ['APPWRITE_RAW_COLLECTION_ID'] = 'test_raw'
+    assert main(MockContext({"date": "2026-01-05", "shards": 2, "reconcile": True}))['status_code'] == 400
+    del os.environ['APPWRITE_DAILY_COLLECTION_ID']
+    del os.environ['APPWRITE_RAW_COLLECTION_ID']
+    assert main(MockContext({"date": "2026-01-05", "shards": -1}))['status_code'] == 400
+
+    del os.environ['APPWRITE_RUNS_COLLECTION_ID']
+    del os.environ['TRIGGER_METERS_PER_SHARD']
+    print("SUCCESS: Sharded runs start one worker per shard and collect their completion rows.")
+
+@patch('job_queue.Query', FakeQuery())
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_job_queue(MockFunctions, MockTablesDB):
+    os.environ['APPWRITE_JOBS_COLLECTION_ID'] = 'test_jobs'
+    os.environ['TRIGGER_QUEUE_WORKERS'] = '2'
+    meters = [{'$id': f'meter_{i}', 'device-id': f'dev_{i}'} for i in range(3)]
+    jobs = {}
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_jobs':
+            ids = query_value(queries, 'equal', '$id')
+            if ids is not None:
+                rows = [jobs[i] for i in ids if i in jobs]
+                return {'total': len(rows), 'rows': rows}
+            status = query_value(queries, 'equal', 'status')
+            cursor = query_value(queries, 'cursor_after')
+            rows = sorted((j for j in jobs.values() if j['status'] == status), key=lambda j: j['$id'])
+            rows = [j for j in rows if cursor is None or j['$id'] > cursor]
+            return {'total': min(len(rows), 5000), 'rows': rows[:query_value(queries, 'limit')]}
+        return {'total': len(meters), 'rows': meters}
+
+    def upsert_rows(database_id, collection_id, rows):
+        for row in rows:
+            jobs[row['$id']] = row
+        return {'total': len(rows), 'rows': rows}
+
+    MockTablesDB.return_value.list_rows.side_effect = list_rows
+    MockTablesDB.return_value.upsert_rows.side_effect = upsert_rows
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning job queue test for trigger function...")
+    result = main(MockContext({"from": "2026-01-05", "to": "2026-01-06", "queue": True}))
+    assert result['status_code'] == 200, result
+    assert result['data']['jobs_enqueued'] == 6 and result['data']['queue_workers'] == 2, result['data']
+    assert sorted(jobs) == sorted(f'meter_{i}_2026010{d}' for i in range(3) for d in (5, 6)), sorted(jobs)
+    assert all(j['status'] == 'pending' and j['attempts'] == 0 for j in jobs.values())
+    calls = mock_functions_instance.create_execution.call_args_list
+    assert len(calls) == 2 and all(json.loads(c.kwargs['body']) == {"jobs": True} and c.kwargs['xasync'] for c in calls)
+
+    # Enqueueing the same day again only requeues failed jobs; done and running ones
+    # are left alone unless a reset is requested
+    jobs['meter_0_20260105'].update(status='done', attempts=1)
+    jobs['meter_1_20260105'].update(status='running', attempts=1, claimed_by='worker_1')
+    jobs['meter_2_20260105'].update(status='failed', attempts=3)
+    result = main(MockContext({"date": "2026-01-05", "queue": True}))
+    assert result['data']['jobs_enqueued'] == 1, result['data']
+    assert len(jobs) == 6 and jobs['meter_0_20260105']['status'] == 'done' and jobs['meter_1_20260105']['claimed_by'] == 'worker_1'
+    assert jobs['meter_2_20260105']['status'] == 'pending' and jobs['meter_2_20260105']['attempts'] == 0
+
+    jobs['meter_1_20260105']['status'] = 'failed'
+    status = main(MockContext({"queue_status": True}))['data']
+    assert status['jobs'] == {'pending': 4, 'running': 0, 'done': 1, 'failed': 1} and status['left'] == 4, status
+
+    result = main(MockContext({"date": "2026-01-05", "queue": True, "reset": True}))
+    assert result['data']['jobs_enqueued'] == 3 and jobs['meter_0_20260105']['status'] == 'pending', result['data']
+
+    # Counts past Appwrite's capped total are scanned
+    jobs.update({f'bulk_{i:05d}': {'$id': f'bulk_{i:05d}', 'status': 'done'} for i in range(6200)})
+    status = main(MockContext({"queue_status": True}))['data']
+    assert status['jobs']['done'] == 6200 and status['jobs']['pending'] == 6, status
+
+    assert main(MockContext({"date": "2026-01-05", "queue": True, "shards": 2}))['status_code'] == 400
+    del os.environ['APPWRITE_JOBS_COLLECTION_ID']
+    del os.environ['TRIGGER_QUEUE_WORKERS']
+    print("SUCCESS: queue writes deduplicated jobs, starts workers and reports what is left.")
+
+@patch('plan.Query', FakeQuery())
+@patch('main.Query', FakeQuery())
+@patch('main.TablesDB')
+@patch('main.Functions')
+def test_dry_run(MockFunctions, MockTablesDB):
+    os.environ['APPWRITE_RAW_COLLECTION_ID'] = 'test_raw'
+    meters = [{'$id': f'meter_{i:03d}', 'device-id': f'dev_{i:03d}'} for i in range(250)]
+    counted = []
+    rows_per_meter = [10]
+
+    def list_rows(database_id, collection_id, queries=None):
+        if collection_id == 'test_raw':
+            chunk = query_value(queries, 'equal', 'meters')
+            counted.append((query_value(queries, 'greater_than_equal'), len(chunk)))
+            return {'total': min(len(chunk) * rows_per_meter[0], 5000), 'rows': [{'$id': 'raw_0'}]}
+        cursor = query_value(queries, 'cursor_after')
+        rows = [m for m in meters if cursor is None or m['$id'] > cursor][:100]
+        return {'total': len(meters), 'rows': rows}
+
+    mock_tables_instance = MockTablesDB.return_value
+    mock_tables_instance.list_rows.side_effect = list_rows
+    mock_functions_instance = MockFunctions.return_value
+
+    print("\nRunning dry run test for trigger function...")
+    timing = {"latency_ms": 10, "execution_overhead_ms": 100}
+    result = main(MockContext(dict(timing, **{"from": "2026-01-05", "to": "2026-01-06", "dry_run": True})))
+    assert result['status_code'] == 200, result
+    plan = result['data']
+    assert (plan['devices'], plan['pages_fetched'], plan['raw_rows'], plan['batches'], plan['executions']) == (250, 3, 5000, 3, 3), plan
+    # Each day is counted per chunk of 100 meters, as the workers scan them
+    assert counted == [(day, size) for day in ('2026-01-05T00:00:00', '2026-01-06T00:00:00') for size in (100, 100, 50)], counted
+    assert plan['raw_rows_capped'] is False and plan['raw_rows_sampled'] is False and 'lower bounds' not in plan['message'], plan
+    # Per execution: two raw pages, then a compare read and a write for each day
+    assert plan['round_trips'] == {'trigger': 6, 'workers': 18, 'total': 24}, plan['round_trips']
+    assert (plan['execution_ms'], plan['projected_wall_ms']) == (160, 190), plan
+
+    # Other batching, a queue and shards are priced without writing or executing anything
+    plan = main(MockContext(dict(timing, **{"date": "2026-01-05", "dry_run": True, "batch_size": 50})))['data']
+    assert plan['executions'] == 5 and plan['batch_size'] == 50, plan
+    plan = main(MockContext(dict(timing, **{"from": "2026-01-05", "to": "2026-01-06", "dry_run": True, "queue": True})))['data']
+    assert (plan['mode'], plan['executions'], plan['round_trips']) == ('queue', 4, {'trigger': 19, 'workers': 59, 'total': 78}), plan
+    plan = main(MockContext(dict(timing, **{"from": "2026-01-05", "to": "2026-01-06", "dry_run": True, "shards": 2})))['data']
+    assert (plan['mode'], plan['shards'], plan['round_trips']) == ('shards', 2, {'trigger': 4, 'workers': 30, 'total': 34}), plan
+
+    # Days are counted in the default meter timezone, and a chunk at Appwrite's cap is flagged
+    os.environ['METER_TIMEZONE'] = 'Europe/Berlin'
+    rows_per_meter[0] = 60
+    del counted[:]
+    plan = main(MockContext(dict(timing, **{"date": "2026-01-05", "dry_run": True})))['data']
+    del os.environ['METER_TIMEZONE']
+    assert [day for day, _ in counted] == ['2026-01-04T23:00:00'] * 3, counted
+    assert plan['raw_rows'] == 5000 + 5000 + 3000, plan
+    assert plan['raw_rows_capped'] is True and 'lower bounds' in plan['message'], plan
+
+    # A fleet of more than ten chunks is extrapolated from ten of them
+    meters[:] = [{'$id': f'meter_{i:04d}', 'device-id': f'dev_{i:04d}'} for i in range(2000)]
+    rows_per_meter[0] = 24
+    del counted[:]
+    plan = main(MockContext(dict(timing, **{"date": "2026-01-05", "dry_run": True})))['data']
+    assert len(counted) == 10 and plan['raw_rows'] == 2000 * 24, (counted, plan)
+    assert plan['raw_rows_capped'] is False and plan['raw_rows_sampled'] is True and 'extrapolated' in plan['message'], plan
+    assert not mock_functions_instance.create_execution.called
+    assert not mock_tables_instance.upsert_row.called and not mock_tables_instance.upsert_rows.called
+
+    assert main(MockContext({"date": "2026-01-05", "dry_run": True, "concurrency": 0}))['status_code'] == 400
+    del os.environ['APPWRITE_RAW_COLLECTION_ID']
+    print("SUCCESS: dry_run estimates executions, round-trips and wall time without side effects.")
+
 if __name__ == "__main__":
     test_function()
+    test_batch_size()
+    test_pagination()
+    test_retry_and_failures()
+    test_execution_results()
+    test_backfill_range()
+    test_reconcile()
+    test_changed_only()
+    test_timezones()
+    test_sharded()
+    test_job_queue()
+    test_dry_run()